@@ -0,0 +1,290 @@
+"""
+Client Telegram finto per i benchmark: espone i metodi di pyrogram.Client usati dagli handler di core.py,
+registra ogni chiamata e può simulare la latenza della rete. Non apre connessioni.
+
+I messaggi e i membri restituiti sono veri oggetti di pyrogram.types, così gli handler (mention, link,
+forward, delete, ...) si comportano come con il client reale.
+"""
+import asyncio
+import inspect
+import itertools
+import logging
+import random
+import time
+from collections import Counter
+from datetime import datetime
+
+from pyrogram import StopPropagation, ContinuePropagation
+from pyrogram.enums import ChatType, ChatMemberStatus, MessageMediaType, MessageEntityType
+from pyrogram.errors import UserNotParticipant
+from pyrogram.handlers import MessageHandler, CallbackQueryHandler, ChatMemberUpdatedHandler
+from pyrogram.types import Chat, ChatMember, ChatMemberUpdated, User, Message, MessageEntity, CallbackQuery, Photo, \
+    Thumbnail
+
+log = logging.getLogger(__name__)
+
+# tipo di handler che riceve ciascun tipo di aggiornamento
+HANDLER_TYPES = {
+    Message: MessageHandler,
+    CallbackQuery: CallbackQueryHandler,
+    ChatMemberUpdated: ChatMemberUpdatedHandler
+}
+
+
+def make_user(user_id: int, username: str | None = None, first_name: str | None = None, is_bot: bool = False) -> User:
+    return User(id=user_id, username=username, first_name=first_name or f"Utente {user_id}", is_bot=is_bot)
+
+
+def make_photo(file_id: str) -> Photo:
+    size = Thumbnail(file_id=file_id, file_unique_id=file_id, width=1280, height=720, file_size=100000)
+    try:
+        return Photo(sizes=[size], date=datetime.now())
+    except TypeError:
+        # versioni di pyrogram in cui Photo ha i campi del file direttamente
+        return Photo(file_id=file_id, file_unique_id=file_id, width=1280, height=720, file_size=100000,
+                     date=datetime.now())
+
+
+class FakeClient:
+    """
+    :param latency: secondi di attesa simulati per ogni chiamata
+    :param jitter: variazione casuale massima (in secondi) aggiunta alla latenza
+    :param first_message_id: primo ID dei messaggi creati dal client (alzalo per non scontrarsi con ID registrati)
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, first_message_id: int = 1000):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self.call_time = Counter()
+        self.me = make_user(1, username="scambi_bot", first_name="Scambi Bot")
+        self.chats: dict[int, Chat] = {}
+        self.members: dict[int, dict[int, ChatMember]] = {}
+        self.messages: dict[tuple[int, int], Message] = {}
+        self._message_ids = itertools.count(first_message_id)
+        self._callback_ids = itertools.count(1)
+        # handler registrati con add_handler, per gruppo in ordine crescente come nel Dispatcher di pyrogram
+        self.groups: dict[int, list] = {}
+        self.dispatch_errors = 0
+        # usati da Handler.check per i filtri sincroni
+        self.executor = None
+
+    @property
+    def loop(self):
+        return asyncio.get_running_loop()
+
+    async def _rpc(self, method: str):
+        start = time.perf_counter()
+        self.calls[method] += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        await asyncio.sleep(delay)
+        self.call_time[method] += time.perf_counter() - start
+
+    # --- costruzione dello stato ---
+
+    def add_chat(self, chat_id: int, chat_type: ChatType = ChatType.SUPERGROUP, title: str | None = None) -> Chat:
+        chat = Chat(id=chat_id, type=chat_type, title=title or f"Chat {chat_id}")
+        self.chats[chat_id] = chat
+        return chat
+
+    def chat(self, chat_id: int) -> Chat:
+        return self.chats.get(chat_id) or self.add_chat(
+            chat_id, ChatType.PRIVATE if chat_id > 0 else ChatType.SUPERGROUP
+        )
+
+    def add_member(self, chat_id: int, user: User,
+                   status: ChatMemberStatus = ChatMemberStatus.MEMBER) -> ChatMember:
+        member = ChatMember(client=self, status=status, user=user, chat=self.chat(chat_id))
+        self.members.setdefault(chat_id, {})[user.id] = member
+        return member
+
+    def make_message(self, chat_id: int, user: User, text: str | None = None, caption: str | None = None,
+                     photo: bool = False, thread_id: int | None = None, message_id: int | None = None,
+                     text_mentions: list[tuple[int, int, User]] | None = None) -> Message:
+        """
+        Un messaggio in arrivo. Se il testo (o la didascalia) inizia con un comando, message.command viene
+        riempito come fa filters.command.
+        :param message_id: ID del messaggio (di norma ne viene scelto uno nuovo)
+        :param text_mentions: menzioni senza username, come (offset, lunghezza, utente)
+        """
+        content = text if text is not None else caption
+        command = None
+        if content and content[0] in ".!/":
+            command = content[1:].split()
+            command[0] = command[0].split("@")[0].lower()
+        entities = [
+            MessageEntity(type=MessageEntityType.TEXT_MENTION, offset=offset, length=length, user=mentioned)
+            for offset, length, mentioned in text_mentions or []
+        ] or None
+        message = Message(
+            client=self,
+            id=message_id if message_id is not None else next(self._message_ids),
+            chat=self.chat(chat_id),
+            from_user=user,
+            date=datetime.now(),
+            text=text,
+            caption=caption,
+            entities=entities if text is not None else None,
+            caption_entities=entities if text is None else None,
+            photo=make_photo(f"photo-{chat_id}-{user.id}") if photo else None,
+            media=MessageMediaType.PHOTO if photo else None,
+            command=command,
+            message_thread_id=thread_id
+        )
+        self.messages[(chat_id, message.id)] = message
+        return message
+
+    def make_callback_query(self, message: Message, user: User, data: str) -> CallbackQuery:
+        return CallbackQuery(
+            client=self,
+            id=str(next(self._callback_ids)),
+            from_user=user,
+            chat_instance=str(message.chat.id),
+            message=message,
+            data=data
+        )
+
+    def make_chat_member_updated(self, chat_id: int, user: User, old: tuple[ChatMemberStatus, User] | None,
+                                 new: tuple[ChatMemberStatus, User] | None) -> ChatMemberUpdated:
+        """
+        Un cambio di stato di un membro; lo stato nuovo viene anche applicato ai membri del client.
+        :param old: (stato, utente) prima del cambio
+        :param new: (stato, utente) dopo il cambio
+        """
+        chat = self.chat(chat_id)
+        old_member = ChatMember(client=self, status=old[0], user=old[1], chat=chat) if old else None
+        new_member = self.add_member(chat_id, new[1], status=new[0]) if new else None
+        return ChatMemberUpdated(client=self, chat=chat, from_user=user, date=datetime.now(),
+                                 old_chat_member=old_member, new_chat_member=new_member)
+
+    def _store(self, chat_id: int, **fields) -> Message:
+        message = Message(client=self, id=next(self._message_ids), chat=self.chat(int(chat_id)), from_user=self.me,
+                          date=datetime.now(), **fields)
+        self.messages[(message.chat.id, message.id)] = message
+        return message
+
+    # --- registrazione e smistamento degli handler ---
+
+    def add_handler(self, handler, group: int = 0):
+        self.groups.setdefault(group, []).append(handler)
+        self.groups = dict(sorted(self.groups.items()))
+        return handler, group
+
+    async def dispatch(self, update):
+        """
+        Passa un aggiornamento agli handler registrati seguendo le regole del Dispatcher di pyrogram: in ogni
+        gruppo viene eseguito il primo handler i cui filtri corrispondono, StopPropagation ferma tutto e
+        ContinuePropagation passa all'handler successivo dello stesso gruppo. Le eccezioni vengono contate.
+        """
+        handler_type = HANDLER_TYPES.get(type(update), type(None))
+        try:
+            for group in self.groups.values():
+                for handler in group:
+                    if not isinstance(handler, handler_type):
+                        continue
+                    try:
+                        if not await handler.check(self, update):
+                            continue
+                    except Exception as e:
+                        log.exception(e)
+                        continue
+                    try:
+                        if inspect.iscoroutinefunction(handler.callback):
+                            await handler.callback(self, update)
+                        else:
+                            await self.loop.run_in_executor(self.executor, handler.callback, self, update)
+                    except StopPropagation:
+                        raise
+                    except ContinuePropagation:
+                        continue
+                    except Exception:
+                        self.dispatch_errors += 1
+                    break
+        except StopPropagation:
+            pass
+
+    # --- metodi di pyrogram.Client usati dal bot ---
+
+    async def get_me(self):
+        await self._rpc("get_me")
+        return self.me
+
+    async def get_chat_member(self, chat_id: int | str, user_id: int | str):
+        await self._rpc("get_chat_member")
+        members = self.members.get(int(chat_id), {})
+        if user_id == "me":
+            return ChatMember(client=self, status=ChatMemberStatus.ADMINISTRATOR, user=self.me)
+        if isinstance(user_id, int) or str(user_id).isnumeric():
+            member = members.get(int(user_id))
+        else:
+            username = str(user_id).removeprefix("@").lower()
+            member = next((m for m in members.values() if (m.user.username or "").lower() == username), None)
+        if member is None:
+            raise UserNotParticipant()
+        return member
+
+    async def get_chat_members(self, chat_id: int | str, query: str = "", limit: int = 0, filter=None):
+        await self._rpc("get_chat_members")
+        for member in list(self.members.get(int(chat_id), {}).values()):
+            if filter is not None and filter.name == "ADMINISTRATORS" and member.status not in (
+                    ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+                continue
+            yield member
+
+    async def get_messages(self, chat_id: int | str, message_ids: int | list[int], **kwargs):
+        await self._rpc("get_messages")
+        if isinstance(message_ids, int):
+            return self.messages.get((int(chat_id), message_ids)) or Message(id=message_ids, empty=True)
+        return [self.messages.get((int(chat_id), i)) or Message(id=i, empty=True) for i in message_ids]
+
+    async def send_message(self, chat_id: int | str, text: str, reply_markup=None, **kwargs):
+        await self._rpc("send_message")
+        return self._store(chat_id, text=text, reply_markup=reply_markup)
+
+    async def send_photo(self, chat_id: int | str, photo, caption: str | None = None, reply_markup=None, **kwargs):
+        await self._rpc("send_photo")
+        file_id = photo if isinstance(photo, str) else f"uploaded-{next(self._message_ids)}"
+        return self._store(chat_id, caption=caption, photo=make_photo(file_id), media=MessageMediaType.PHOTO,
+                           reply_markup=reply_markup)
+
+    async def forward_messages(self, chat_id: int | str, from_chat_id: int | str, message_ids: int | list[int],
+                               **kwargs):
+        await self._rpc("forward_messages")
+        ids = [message_ids] if isinstance(message_ids, int) else list(message_ids)
+        forwarded = []
+        for message_id in ids:
+            original = self.messages.get((int(from_chat_id), message_id))
+            forwarded.append(self._store(
+                chat_id,
+                text=original.text if original else None,
+                caption=original.caption if original else None,
+                photo=original.photo if original else None,
+                media=original.media if original else None
+            ))
+        return forwarded[0] if isinstance(message_ids, int) else forwarded
+
+    async def edit_message_text(self, chat_id: int | str, message_id: int, text: str, reply_markup=None, **kwargs):
+        await self._rpc("edit_message_text")
+        message = self.messages.get((int(chat_id), message_id)) or self._store(chat_id)
+        message.text, message.reply_markup = text, reply_markup
+        return message
+
+    async def edit_message_caption(self, chat_id: int | str, message_id: int, caption: str, reply_markup=None,
+                                   **kwargs):
+        await self._rpc("edit_message_caption")
+        message = self.messages.get((int(chat_id), message_id)) or self._store(chat_id)
+        message.caption, message.reply_markup = caption, reply_markup
+        return message
+
+    async def delete_messages(self, chat_id: int | str, message_ids: int | list[int], **kwargs):
+        await self._rpc("delete_messages")
+        ids = [message_ids] if isinstance(message_ids, int) else list(message_ids)
+        return sum(self.messages.pop((int(chat_id), i), None) is not None for i in ids)
+
+    async def answer_callback_query(self, callback_query_id: str, text: str | None = None, **kwargs):
+        await self._rpc("answer_callback_query")
+        return True
+
+    async def leave_chat(self, chat_id: int | str, **kwargs):
+        await self._rpc("leave_chat")
+        return True
@@ -0,0 +1,217 @@
+"""
+Benchmark degli handler di core.py con un client Telegram finto (benchmarks/fake_telegram.py) e un database
+Postgres locale.
+
+Uso (dalla radice del repository, con DB_HOST, DB_USER, DB_PASS e DB_NAME nel .env o nell'ambiente):
+    python benchmarks/handler_bench.py [--updates 500] [--concurrency 20] [--latency-ms 30] [--users 200]
+                                       [--handlers exchange user_points ...] [--cleanup]
+
+⚠️ Gli handler scrivono davvero nel database (scambi, regali, punti): usa un database di prova.
+Gli utenti sintetici hanno ID a partire da BENCH_USER_BASE; con --cleanup le loro righe vengono cancellate
+alla fine.
+
+Per ogni handler stampa aggiornamenti al secondo, latenza p50/p99, errori e chiamate a Telegram per
+aggiornamento. La coda dei messaggi in uscita non viene avviata, quindi le chiamate a Telegram sono eseguite
+dentro l'handler e la latenza simulata pesa sulla sua durata.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "modules"), os.path.dirname(os.path.abspath(__file__))]
+os.makedirs("logs", exist_ok=True)
+
+from dotenv import load_dotenv  # noqa: E402
+from pyrogram.enums import ChatMemberStatus  # noqa: E402
+
+from fake_telegram import FakeClient, make_user  # noqa: E402
+from globals import bot_data  # noqa: E402
+import core  # noqa: E402
+from modules.confirmations import load_confirmations  # noqa: E402
+from modules.database import init_pool, close_pool, run_migrations, load_table_columns, load_points_cache, \
+    acquire  # noqa: E402
+from modules.loggers import stop_logging  # noqa: E402
+from modules.router import CallbackData  # noqa: E402
+from modules.utils import load_admins  # noqa: E402
+
+GROUP_ID = -1001000000001
+DEPOSIT_CHAT_ID = -1001000000002
+NOTIFICATION_CHAT_ID = -1001000000003
+BENCH_USER_BASE = 9_000_000_000
+# amministratore del gruppo finto (utils.load_admins lo trova con get_chat_members), serve per /scambi
+ADMIN_ID = BENCH_USER_BASE - 1
+
+HANDLERS = ("exchange", "request_gift", "accept_gift", "user_points", "user_exchanges")
+
+
+def configure_environment():
+    load_dotenv(os.path.join(ROOT, ".env"))
+    for name, value in (("GROUP_ID", GROUP_ID), ("GIFT_GROUP_ID", GROUP_ID), ("DEPOSIT_CHAT_ID", DEPOSIT_CHAT_ID),
+                        ("NOTIFICATION_CHAT_ID", NOTIFICATION_CHAT_ID)):
+        os.environ[name] = str(value)
+    bot_data.update({"group_id": GROUP_ID, "owner_id": ADMIN_ID, "admin_id": ADMIN_ID})
+
+
+def populate(client: FakeClient, count: int):
+    client.add_chat(GROUP_ID, title="Gruppo di prova")
+    users = [make_user(BENCH_USER_BASE + i, username=f"bench_user_{i}") for i in range(count)]
+    for user in users:
+        client.add_member(GROUP_ID, user)
+    admin = make_user(ADMIN_ID, username="bench_admin")
+    client.add_member(GROUP_ID, admin, status=ChatMemberStatus.ADMINISTRATOR)
+    return users, admin
+
+
+def exchange_calls(client: FakeClient, users, admin, updates: int):
+    calls = []
+    for i in range(updates):
+        sender, recipient = users[i % len(users)], users[(i * 7 + 1) % len(users)]
+        if sender is recipient:
+            recipient = users[(i + 1) % len(users)]
+        message = client.make_message(GROUP_ID, sender, caption=f"/feedback @{recipient.username} benchmark {i}",
+                                      photo=True)
+        calls.append(lambda m=message: core.exchange(client, m))
+    return calls
+
+
+def request_gift_calls(client: FakeClient, users, admin, updates: int):
+    calls = []
+    for i in range(updates):
+        message = client.make_message(GROUP_ID, users[i % len(users)], caption="/request", photo=True)
+        calls.append(lambda m=message: core.request_gift(client, m))
+    return calls
+
+
+async def accept_gift_calls(client: FakeClient, users, admin, updates: int):
+    # preparo una richiesta di regalo per ogni aggiornamento (fuori dal tempo misurato)
+    requesters = [users[i % len(users)] for i in range(updates)]
+    for requester in dict.fromkeys(requesters):
+        await core.request_gift(client, client.make_message(GROUP_ID, requester, caption="/request", photo=True))
+    requests = []
+    for message in list(client.messages.values()):
+        for row in (message.reply_markup.inline_keyboard if message.reply_markup else []):
+            for button in row:
+                if (button.callback_data or "").startswith("accept_gift_for_"):
+                    requests.append((message, button.callback_data))
+    calls = []
+    for i, (message, data) in enumerate(requests):
+        giver = users[(i * 3 + 1) % len(users)]
+        query = client.make_callback_query(message, giver, data)
+        calls.append(lambda q=query, d=data: core.accept_gift(
+            client, q, CallbackData(action="accept_gift_for", args=[d.rsplit("_", 1)[1]])
+        ))
+    return calls
+
+
+def user_points_calls(client: FakeClient, users, admin, updates: int):
+    calls = []
+    for i in range(updates):
+        target = users[(i * 5) % len(users)]
+        text = "/punti" if i % 2 else f"/punti @{target.username}"
+        message = client.make_message(GROUP_ID, users[i % len(users)], text=text)
+        calls.append(lambda m=message: core.user_points(client, m))
+    return calls
+
+
+def user_exchanges_calls(client: FakeClient, users, admin, updates: int):
+    calls = []
+    for i in range(updates):
+        target = users[(i * 5) % len(users)]
+        text = f"/scambi @{target.username}" if i % 2 else f"/scambi {target.id}"
+        message = client.make_message(GROUP_ID, admin, text=text)
+        calls.append(lambda m=message: core.user_exchanges(client, m))
+    return calls
+
+
+SCENARIOS = {
+    "exchange": exchange_calls,
+    "request_gift": request_gift_calls,
+    "accept_gift": accept_gift_calls,
+    "user_points": user_points_calls,
+    "user_exchanges": user_exchanges_calls,
+}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def measure(calls, concurrency: int):
+    """
+    Esegue le chiamate con al massimo ``concurrency`` handler attivi insieme.
+    :return: (latenze in secondi, durata totale, errori)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def run(call):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await call()
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(call) for call in calls))
+    return latencies, time.perf_counter() - start, errors
+
+
+async def cleanup():
+    async with acquire() as conn:
+        await conn.execute("DELETE FROM exchanges WHERE member_1 >= $1 OR member_2 >= $1;", BENCH_USER_BASE)
+        await conn.execute("DELETE FROM gifts WHERE user_id >= $1 OR gifted_by_id >= $1;", BENCH_USER_BASE)
+        await conn.execute("DELETE FROM main_table WHERE user_id >= $1;", BENCH_USER_BASE)
+        await conn.execute("DELETE FROM users WHERE user_id >= $1;", BENCH_USER_BASE)
+
+
+async def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--updates", type=int, default=500, help="aggiornamenti per handler")
+    arg_parser.add_argument("--concurrency", type=int, default=20, help="handler eseguiti insieme")
+    arg_parser.add_argument("--latency-ms", type=float, default=30, help="latenza simulata di ogni chiamata")
+    arg_parser.add_argument("--jitter-ms", type=float, default=10, help="variazione casuale della latenza")
+    arg_parser.add_argument("--users", type=int, default=200, help="utenti sintetici nel gruppo")
+    arg_parser.add_argument("--handlers", nargs="+", choices=HANDLERS, default=list(HANDLERS))
+    arg_parser.add_argument("--cleanup", action="store_true", help="cancella le righe degli utenti sintetici")
+    args = arg_parser.parse_args()
+
+    configure_environment()
+    await init_pool()
+    await run_migrations()
+    await load_table_columns()
+    await load_points_cache()
+    await load_confirmations()
+
+    print(f"{'handler':<16}{'updates':>8}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}{'rpc/upd':>9}")
+    try:
+        for name in args.handlers:
+            client = FakeClient(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000)
+            users, admin = populate(client, args.users)
+            await load_admins(client)
+            calls = SCENARIOS[name](client, users, admin, args.updates)
+            if asyncio.iscoroutine(calls):
+                calls = await calls
+            client.calls.clear()
+
+            latencies, elapsed, errors = await measure(calls, args.concurrency)
+            rpc = sum(client.calls.values()) / max(len(calls), 1)
+            print(f"{name:<16}{len(calls):>8}{len(calls) / elapsed:>10.1f}{percentile(latencies, 0.5) * 1000:>10.1f}"
+                  f"{percentile(latencies, 0.99) * 1000:>10.1f}{errors:>8}{rpc:>9.2f}")
+    finally:
+        if args.cleanup:
+            await cleanup()
+        await close_pool()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
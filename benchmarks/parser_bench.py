@@ -0,0 +1,59 @@
+"""
+Micro-benchmark del parser delle didascalie (modules/parser.py).
+
+Uso (dalla radice del repository):
+    python benchmarks/parser_bench.py [--number 20000]
+
+Per ogni didascalia del corpus stampa il tempo medio di parse_caption; i tempi devono restare
+piatti al crescere della lunghezza del feedback.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "modules")]
+
+from modules.parser import parse_caption, is_valid_username  # noqa: E402
+
+# didascalie reali (anonimizzate) mandate nel gruppo con /feedback
+CORPUS = [
+    "/feedback @mario_rossi tutto ok, velocissimo",
+    "/feedback @giulia98 scambio perfetto, consigliatissima! 🔥",
+    "!feedback @Lu_Ca_2000 top",
+    ".feedback 123456789 gentilissimo e preciso",
+    "/feedback 5012345678 tutto ok",
+    '/feedback <a href="tg://user?id=6543210987">Marco</a> affidabile, carte arrivate in 2 giorni',
+    "/feedback @mario_rossi",
+    "/feedback",
+    "/feedback @utente_molto_lungo_con_underscore " + "ottimo scambio, " * 40,
+    "/feedback   @spazi_multipli     feedback con spazi multipli",
+    "/feedback @abc ok",
+    "feedback @mario_rossi senza prefisso",
+    "/feedback @mario_rossi " + "🃏" * 200,
+]
+
+USERNAMES = ["@mario_rossi", "@Mario", "@abc", "mario_rossi", "@giulia98", "@a1234567890123456789012345678901"]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--number", type=int, default=20000, help="ripetizioni per didascalia")
+    args = arg_parser.parse_args()
+
+    print(f"{'ns/parse':>10}  {'len':>5}  caption")
+    total = 0.0
+    for caption in CORPUS:
+        elapsed = timeit.timeit(lambda: parse_caption(caption), number=args.number)
+        total += elapsed
+        shown = caption if len(caption) <= 60 else caption[:57] + "..."
+        print(f"{elapsed / args.number * 1e9:>10.0f}  {len(caption):>5}  {shown!r}")
+    print(f"\nparse_caption: {total / (args.number * len(CORPUS)) * 1e9:.0f} ns/parse in media")
+
+    elapsed = timeit.timeit(lambda: [is_valid_username(u) for u in USERNAMES], number=args.number)
+    print(f"is_valid_username: {elapsed / (args.number * len(USERNAMES)) * 1e9:.0f} ns/check in media")
+
+
+if __name__ == "__main__":
+    main()
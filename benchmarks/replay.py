@@ -0,0 +1,227 @@
+"""
+Riproduce una registrazione di aggiornamenti reali (bot.py con RECORD_UPDATES=file.jsonl[.gz]) passandola agli
+handler registrati da main.add_handlers, con il client Telegram finto di benchmarks/fake_telegram.py e un database
+Postgres locale.
+
+Uso (dalla radice del repository, con DB_HOST, DB_USER, DB_PASS e DB_NAME nel .env o nell'ambiente):
+    python benchmarks/replay.py updates.jsonl.gz [--speed 1|10|0] [--workers 8] [--latency-ms 30] [--outbox]
+
+--speed 1 rispetta gli intervalli registrati, 10 li accorcia di dieci volte, 0 manda tutto il più in fretta
+possibile. Come il Dispatcher di pyrogram, gli aggiornamenti finiscono in una coda servita da --workers task.
+
+⚠️ Gli handler scrivono davvero nel database con gli ID degli utenti registrati: usa un database di prova.
+Gli utenti sono membri del gruppo solo se compaiono nella registrazione (come mittenti o nei cambi di stato):
+chi viene solo menzionato risulta fuori dal gruppo.
+
+Alla fine stampa aggiornamenti al secondo, latenza dall'arrivo in coda alla fine degli handler, ritardo massimo
+rispetto ai tempi registrati, errori e chiamate a Telegram per aggiornamento, poi la latenza di ogni handler.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "modules"), os.path.dirname(os.path.abspath(__file__))]
+os.makedirs("logs", exist_ok=True)
+
+from dotenv import load_dotenv  # noqa: E402
+from pyrogram.enums import ChatType, ChatMemberStatus  # noqa: E402
+
+from fake_telegram import FakeClient, make_user  # noqa: E402
+from handler_bench import DEPOSIT_CHAT_ID, NOTIFICATION_CHAT_ID, percentile  # noqa: E402
+from globals import bot_data  # noqa: E402
+import main as bot  # noqa: E402
+from modules.confirmations import load_confirmations  # noqa: E402
+from modules.database import init_pool, close_pool, run_migrations, load_table_columns, \
+    load_points_cache  # noqa: E402
+from modules.loggers import stop_logging  # noqa: E402
+from modules.metrics import handler_latency, handler_errors  # noqa: E402
+from modules.outbox import start_outbox, drain_outbox  # noqa: E402
+from modules.utils import load_admins  # noqa: E402
+from modules.recorder import read_recording, KIND_MESSAGE, KIND_CALLBACK_QUERY, KIND_CHAT_MEMBER  # noqa: E402
+
+# i messaggi creati durante la riproduzione partono da qui, lontano dagli ID registrati
+REPLAY_MESSAGE_BASE = 10 ** 10
+INACTIVE = ("left", "banned")
+
+
+def configure_environment(group_id: int):
+    load_dotenv(os.path.join(ROOT, ".env"))
+    # la riproduzione non deve finire in una nuova registrazione
+    os.environ.pop("RECORD_UPDATES", None)
+    for name, value in (("GROUP_ID", group_id), ("GIFT_GROUP_ID", group_id)):
+        os.environ[name] = str(value)
+    os.environ.setdefault("DEPOSIT_CHAT_ID", str(DEPOSIT_CHAT_ID))
+    os.environ.setdefault("NOTIFICATION_CHAT_ID", str(NOTIFICATION_CHAT_ID))
+    bot_data.update({
+        "group_id": group_id,
+        "owner_id": int(os.getenv("OWNER_ID", 0)),
+        "admin_id": int(os.getenv("ADMIN_ID", 0))
+    })
+
+
+class Users:
+    """
+    Gli utenti della registrazione, un solo oggetto User per ID.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+
+    def get(self, fields):
+        if fields is None:
+            return None
+        user_id, username, first_name, is_bot = fields
+        if user_id not in self.by_id:
+            self.by_id[user_id] = make_user(user_id, username=username, first_name=first_name, is_bot=is_bot)
+        return self.by_id[user_id]
+
+
+def populate(client: FakeClient, users: Users, lines: list[dict], group_id: int):
+    """
+    Crea le chat registrate e rende membri del gruppo gli utenti che vi compaiono, con lo stato che avevano
+    prima del loro primo cambio di stato.
+    """
+    client.add_chat(group_id)
+    seen = set()
+    for line in lines:
+        for chat in (line.get("c"), line.get("m", {}).get("c")):
+            if chat is not None and chat[0] not in client.chats:
+                client.add_chat(chat[0], ChatType(chat[1]), title=chat[2])
+        if line["k"] == KIND_CHAT_MEMBER:
+            old = line.get("o")
+            user_id = (old or line["n"])[1][0]
+            if user_id not in seen and old is not None and old[0] not in INACTIVE:
+                client.add_member(group_id, users.get(old[1]), status=ChatMemberStatus(old[0]))
+            seen.add(user_id)
+        elif (line.get("c") or line["m"]["c"])[0] == group_id and "u" in line and line["u"][0] not in seen:
+            client.add_member(group_id, users.get(line["u"]))
+            seen.add(line["u"][0])
+
+
+def build_message(client: FakeClient, users: Users, fields: dict):
+    return client.make_message(
+        fields["c"][0],
+        users.get(fields.get("u")),
+        text=fields.get("x"),
+        caption=fields.get("p"),
+        photo=bool(fields.get("f")),
+        thread_id=fields.get("r"),
+        message_id=fields["id"],
+        text_mentions=[(offset, length, users.get(user)) for offset, length, user in fields.get("e", [])]
+    )
+
+
+def build_update(client: FakeClient, users: Users, line: dict):
+    if line["k"] == KIND_MESSAGE:
+        return build_message(client, users, line)
+    if line["k"] == KIND_CALLBACK_QUERY:
+        message = build_message(client, users, line["m"])
+        return client.make_callback_query(message, users.get(line["u"]), line.get("d"))
+    if line["k"] == KIND_CHAT_MEMBER:
+        old, new = line.get("o"), line.get("n")
+        return client.make_chat_member_updated(
+            line["c"][0],
+            users.get(line.get("u")),
+            (ChatMemberStatus(old[0]), users.get(old[1])) if old else None,
+            (ChatMemberStatus(new[0]), users.get(new[1])) if new else None
+        )
+    return None
+
+
+async def replay(client: FakeClient, users: Users, lines: list[dict], speed: float, workers: int):
+    """
+    Mette in coda gli aggiornamenti ai tempi registrati divisi per ``speed`` (tutti subito se 0).
+    Ogni aggiornamento viene costruito quando arriva il suo momento, così i cambi di stato dei membri valgono
+    solo per gli aggiornamenti successivi.
+    :return: (latenze in secondi, durata totale, ritardo massimo rispetto ai tempi registrati)
+    """
+    queue = asyncio.Queue()
+    latencies = []
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            update, queued = item
+            await client.dispatch(update)
+            latencies.append(time.perf_counter() - queued)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    first = lines[0]["t"] if lines else 0
+    start, lag = time.perf_counter(), 0.0
+    for line in lines:
+        if speed > 0:
+            delay = start + (line["t"] - first) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+        if (update := build_update(client, users, line)) is not None:
+            queue.put_nowait((update, time.perf_counter()))
+    for _ in tasks:
+        queue.put_nowait(None)
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - start, lag
+
+
+async def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("recording", help="file scritto con RECORD_UPDATES")
+    arg_parser.add_argument("--speed", type=float, default=1, help="1 = tempo reale, 10 = dieci volte, 0 = massimo")
+    arg_parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 0) + 4),
+                            help="task che servono la coda (come i workers di pyrogram)")
+    arg_parser.add_argument("--latency-ms", type=float, default=30, help="latenza simulata di ogni chiamata")
+    arg_parser.add_argument("--jitter-ms", type=float, default=10, help="variazione casuale della latenza")
+    arg_parser.add_argument("--outbox", action="store_true",
+                            help="avvia la coda dei messaggi in uscita invece di eseguire le chiamate negli handler")
+    args = arg_parser.parse_args()
+
+    header, lines = read_recording(args.recording)
+    lines = list(lines)
+    if header.get("group_id") is None:
+        sys.exit("la registrazione non indica il gruppo (GROUP_ID)")
+    configure_environment(int(header["group_id"]))
+
+    await init_pool()
+    await run_migrations()
+    await load_table_columns()
+    await load_points_cache()
+    await load_confirmations()
+
+    client = FakeClient(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                        first_message_id=REPLAY_MESSAGE_BASE)
+    users = Users()
+    populate(client, users, lines, bot_data["group_id"])
+    await load_admins(client)
+    await bot.add_handlers(client)
+    outbox = start_outbox() if args.outbox else []
+
+    try:
+        latencies, elapsed, lag = await replay(client, users, lines, args.speed, args.workers)
+        if outbox:
+            await drain_outbox()
+    finally:
+        for task in outbox:
+            task.cancel()
+        await close_pool()
+        stop_logging()
+
+    kinds = Counter(line["k"] for line in lines)
+    print(f"recorded {header.get('started')}: {len(lines)} updates "
+          f"({kinds[KIND_MESSAGE]} messages, {kinds[KIND_CALLBACK_QUERY]} callback queries, "
+          f"{kinds[KIND_CHAT_MEMBER]} member updates), speed {args.speed:g}×")
+    print(f"{'updates':>8}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'lag ms':>10}{'errors':>8}{'rpc/upd':>9}")
+    rpc = sum(client.calls.values()) / max(len(lines), 1)
+    print(f"{len(latencies):>8}{len(latencies) / elapsed:>10.1f}{percentile(latencies, 0.5) * 1000:>10.1f}"
+          f"{percentile(latencies, 0.99) * 1000:>10.1f}{lag * 1000:>10.1f}{client.dispatch_errors:>8}{rpc:>9.2f}")
+
+    print(f"\n{'handler':<24}{'calls':>8}{'p50 ≤ms':>10}{'p99 ≤ms':>10}{'errors':>8}")
+    for name, histogram in sorted(handler_latency.items(), key=lambda item: item[1].sum, reverse=True):
+        print(f"{name:<24}{histogram.count:>8}{histogram.quantile(0.5) * 1000:>10g}"
+              f"{histogram.quantile(0.99) * 1000:>10g}{handler_errors.get(name, 0):>8}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
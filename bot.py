@@ -0,0 +1,22 @@
+"""
+Avvia il bot: python bot.py, dalla cartella che contiene il .env.
+
+A livello di modulo questo file non importa nulla. I processi che disegnano i grafici (modules/charts.py) partono
+con spawn, che importa in ciascuno il __main__ del bot come __mp_main__: se il bot partisse da modules/main.py,
+ogni processo ripeterebbe gli import di main.py, aprirebbe i propri handler su logs/*.log e avvierebbe un altro
+thread dei log. Da qui, invece, i processi caricano solo modules.drawing.
+"""
+if __name__ == "__main__":
+    import asyncio
+    import os
+    import sys
+
+    # main.py e core.py importano globals e core senza il prefisso modules.
+    sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "modules"))
+
+    from dotenv import load_dotenv
+
+    import main
+
+    load_dotenv(".env")
+    asyncio.run(main.main())
@@ -0,0 +1,56 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from globals import CHART_WORKERS
+# noinspection PyUnusedImports
+from modules.drawing import CHART_EXCHANGES, CHART_POINTS, CHART_TOP, CHART_KINDS, draw
+
+# i grafici vengono disegnati in processi separati, così matplotlib non blocca l'event loop
+_executor: ProcessPoolExecutor | None = None
+# ultimo grafico mandato per tipo: (ID dell'ultimo scambio quando è stato disegnato, file_id su Telegram)
+_sent: dict[str, tuple[int, str]] = {}
+
+
+async def render_chart(kind: str, data) -> bytes:
+    """
+    Disegna un grafico in un processo separato.
+    :param kind: CHART_EXCHANGES, CHART_POINTS o CHART_TOP
+    :param data: i dati del grafico (vedi core.chart)
+    :return: l'immagine PNG
+    """
+    global _executor
+    if _executor is None:
+        # spawn e non fork: a questo punto il processo ha già altri thread (log, pyrogram) e un fork li
+        # lascerebbe a metà. Spawn però importa nei processi il __main__ del bot (come __mp_main__): per questo il
+        # bot parte da bot.py, che a livello di modulo non importa nulla, e i processi caricano solo
+        # modules.drawing. Se partissero gli import di main.py, ogni processo aprirebbe i propri handler su
+        # logs/*.log e avvierebbe un altro thread dei log
+        _executor = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return await asyncio.get_running_loop().run_in_executor(_executor, draw, kind, data)
+
+
+def get_sent_chart(kind: str, last_exchange_id: int) -> str | None:
+    """
+    :return: il file_id del grafico già mandato, se i dati non sono cambiati da allora
+    """
+    sent = _sent.get(kind)
+    return sent[1] if sent is not None and sent[0] == last_exchange_id else None
+
+
+def remember_chart(kind: str, last_exchange_id: int, file_id: str):
+    _sent[kind] = (last_exchange_id, file_id)
+
+
+def invalidate_charts():
+    """
+    Dimentica i grafici mandati. Serve quando i dati cambiano senza un nuovo scambio (es. uno scambio cancellato).
+    """
+    _sent.clear()
+
+
+def shutdown_charts():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+from typing import NamedTuple
+
+from pyrogram.types import Message
+
+from globals import CONFIRMATION_TIMEOUT
+from modules.database import get_confirmations, save_confirmation, delete_confirmations
+from modules.loggers import bot_logger
+from modules.parser import normalize_username
+
+
+class Confirmation(NamedTuple):
+    chat_id: int
+    message_id: int
+    sender_id: int
+    target_username: str
+    caption: str | None
+    created_at: datetime
+
+
+# richieste di conferma in attesa, indicizzate per destinatario (username senza '@', minuscolo)
+_by_target: dict[str, Confirmation] = {}
+
+
+def _target_key(username: str):
+    return normalize_username(username)
+
+
+def _is_expired(confirmation: Confirmation, now: datetime | None = None):
+    now = now or datetime.now(tz=timezone.utc)
+    return now - confirmation.created_at > timedelta(seconds=CONFIRMATION_TIMEOUT)
+
+
+def _index(confirmation: Confirmation):
+    _unindex(confirmation.target_username)
+    _by_target[confirmation.target_username] = confirmation
+
+
+def _unindex(target: str):
+    return _by_target.pop(target, None)
+
+
+async def load_confirmations():
+    """
+    Carica dal database le richieste di conferma ancora valide. Chiamata all'avvio.
+    """
+    _by_target.clear()
+    expired = []
+    for row in await get_confirmations():
+        confirmation = Confirmation(**dict(row))
+        if _is_expired(confirmation):
+            expired.append(confirmation.target_username)
+        else:
+            _index(confirmation)
+    if expired:
+        await delete_confirmations(expired)
+    bot_logger.info(f"Loaded {len(_by_target)} pending confirmations ({len(expired)} expired).")
+
+
+async def add_confirmation(message: Message, target: str):
+    """
+    Registra la richiesta di conferma per lo scambio dichiarato in ``message`` con l'utente ``target``.
+    """
+    confirmation = Confirmation(
+        chat_id=message.chat.id,
+        message_id=message.id,
+        sender_id=message.from_user.id,
+        target_username=_target_key(target),
+        caption=message.caption,
+        created_at=datetime.now(tz=timezone.utc)
+    )
+    _index(confirmation)
+    await save_confirmation(confirmation._asdict())
+    return confirmation
+
+
+def get_confirmation(target: str) -> Confirmation | None:
+    confirmation = _by_target.get(_target_key(target))
+    if confirmation is None or _is_expired(confirmation):
+        return None
+    return confirmation
+
+
+async def remove_confirmation(target: str):
+    confirmation = _unindex(_target_key(target))
+    if confirmation is not None:
+        await delete_confirmations([confirmation.target_username])
+    return confirmation
+
+
+async def evict_expired_confirmations():
+    now = datetime.now(tz=timezone.utc)
+    expired = [target for target, confirmation in _by_target.items() if _is_expired(confirmation, now)]
+    for target in expired:
+        _unindex(target)
+    if expired:
+        await delete_confirmations(expired)
+        bot_logger.info(f"Evicted {len(expired)} expired confirmations.")
+
+
+async def confirmations_sweeper(interval: float = 60):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await evict_expired_confirmations()
+        except Exception as e:
+            bot_logger.error(f"error evicting expired confirmations: {e}")
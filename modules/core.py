@@ -1,25 +1,51 @@
+import io
 import locale
 import os
-import re
-from datetime import datetime
 
-import pytz
 from pyrogram import Client
 from pyrogram.enums import ParseMode, ChatMemberStatus, ChatType
 from pyrogram.errors import RPCError
-from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, ChatMemberUpdated
+from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, ChatMemberUpdated, \
+    ChatMember
 
 # NON È VERO: SONO USATE COME GLOBALS
 # noinspection PyUnusedImports
-from globals import SOGLIA, THREAD_ID, THREAD_LINK, bot_data, MANUTENZIONE, GROUP_LINK
+from globals import SOGLIA, THREAD_ID, THREAD_LINK, bot_data, MANUTENZIONE, GROUP_LINK, EPHEMERAL_TTL, \
+    LEADERBOARD_SIZE, CHART_DAYS, CHART_TOP_SIZE
 from modules.database import add_to_table, get_item_infos, decrease_user_points, set_as_cancelled, \
-    get_user_exchanges, get_user_points, retrieve_user, execute_query_for_value, get_user_gifts
-from modules.loggers import db_logger, bot_logger
+    get_user_exchanges_page, get_user_points, retrieve_user, execute_query_for_value, get_user_gifts, \
+    load_table_columns, record_exchange, get_leaderboard, get_user_rank, get_points_distribution, \
+    get_exchanges_per_day, get_last_exchange_id
+from modules.charts import CHART_KINDS, CHART_EXCHANGES, CHART_POINTS, CHART_TOP, render_chart, get_sent_chart, \
+    remember_chart, invalidate_charts
+from modules.confirmations import add_confirmation, get_confirmation, remove_confirmation
+from modules.ephemeral import send_expiring
+from modules.loggers import db_logger, bot_logger, log_queue_stats
+from modules.metrics import handler_latency, handler_errors, query_latency, query_errors, rpc_calls, \
+    render_prometheus
+from modules.outbox import enqueue, PRIORITY_CONFIRMATION, PRIORITY_REPLY, PRIORITY_NOTIFICATION, outbox_stats, \
+    outbox_depth
+from modules.parser import parse_caption
+from modules.render import SearchedUser, pack_messages, render_exchange, render_gift, member_handle, \
+    fitting_count, FOOTER
+from modules.router import CallbackData
 from modules.utils import save_persistence, safe_delete, is_admin, safety_check, delete_user_unaccepted_requests, \
-    check_request_requirements, add_fucking_at
+    check_request_requirements, get_chat_member, cache_member, invalidate_member, resolve_members, \
+    ingress_stats, observe_user, add_fucking_at, member_cache, observe_admin_change
 
 
 async def intercept_user_join(client: Client, chat_member: ChatMemberUpdated):
+    if chat_member.old_chat_member:
+        invalidate_member(
+            chat_id=chat_member.chat.id,
+            user_id=chat_member.old_chat_member.user.id,
+            username=chat_member.old_chat_member.user.username
+        )
+    if chat_member.new_chat_member:
+        invalidate_member(chat_id=chat_member.chat.id, user_id=chat_member.new_chat_member.user.id)
+        cache_member(chat_id=chat_member.chat.id, member=chat_member.new_chat_member)
+    observe_admin_change(chat_member)
+
     if (
             chat_member.new_chat_member and
             not (
@@ -39,18 +65,19 @@ async def intercept_user_join(client: Client, chat_member: ChatMemberUpdated):
 
 
 async def intercept_user_message(client: Client, message: Message):
-    if not await safety_check(client, message):
+    """
+    Primo stadio per tutti i messaggi del gruppo: i comandi proseguono verso i relativi handler, tutto il resto
+    viene solo annotato (l'utente finisce nella tabella 'users' con la scrittura a blocchi successiva) e scartato.
+    """
+    text = message.text or message.caption
+    if text and text[0] in ".!/":
+        ingress_stats["commands"] += 1
         return
-    if message.from_user.username is not None:
-        res = await add_to_table(
-            table_name="users",
-            content={
-                "user_id": message.from_user.id,
-                "username": message.from_user.username
-            }
-        )
-        if res is None:
-            db_logger.error(f"error adding user {message.from_user.id} to table")
+
+    ingress_stats["fast_path"] += 1
+    if message.from_user is not None:
+        observe_user(message.from_user.id, message.from_user.username)
+    message.stop_propagation()
 
 
 async def start(client: Client, message: Message):
@@ -72,7 +99,11 @@ async def start(client: Client, message: Message):
                 "parte l'utente specificato."
                 "\n  <code>[.!/]punti [ID/@username]</code> – Mostra i <b>punti attuali</b> dell'utente specificato."
                 "\n  <code>[.!/]regali [ID/@username]</code>  – Visualizza <b>i regali chiesti e donati</b> "
-                "dall'utente specificato.\n\n"
+                "dall'utente specificato."
+                "\n  <code>[.!/]classifica</code> – Mostra la <b>classifica</b> per scambi totali e punti attuali."
+                "\n  <code>[.!/]grafico [scambi/punti/top]</code> – Disegna un <b>grafico</b> dell'attività del gruppo."
+                "\n  <code>[.!/]stats</code> – Mostra <b>tempi di risposta</b> e chiamate del bot."
+                "\n  <code>[.!/]schema</code> – Ricarica la <b>cache dello schema</b> del database.\n\n"
                 f"🏆 <b>Soglia Punti Attuale</b> – <code>{SOGLIA}</code>\n\n"
                 "🚧 <b>Modalità Manutenzione</b> – "
                 f"{'🟡 <code>Attiva</code>' if MANUTENZIONE else '🟢 <code>Disattiva</code>'}\n\n"
@@ -125,20 +156,17 @@ async def send_confirmation_request(client: Client, message: Message, user: str,
         text = (f"⏳ <b>Attesa Conferma</b>\n\n🔹️Questo regalo <u>necessita di conferma</u> da parte dell'utente "
                 f"{user}.")
 
-    if "confirmations" not in bot_data:
-        bot_data["confirmations"] = {}
-
-    if (user.replace("@", "") in bot_data["confirmations"] and
-            "gift" in bot_data["confirmations"][user.replace("@", "")]):
+    if (pending := get_confirmation(user)) is not None:
         try:
             confirm_message = await client.get_messages(
-                chat_id=message.chat.id,
-                message_ids=bot_data["confirmations"][user.replace("@", "")]["gift"].id
+                chat_id=pending.chat_id,
+                message_ids=pending.message_id
             )
         except Exception:
             pass
         else:
-            await confirm_message.reply_text(
+            await enqueue(
+                confirm_message.reply_text,
                 text=f"⚠️ L'utente {'@' + user.replace("@", "")} deve <b>ancora confermare un'altro regalo</b>.\n\n"
                      f"🆘 Se il messaggio della richiesta di conferma è stato rimosso o non produce alcun effetto, "
                      f"chiedi ad un admin di cancellare il messaggio cui sto rispondendo, poi riformula la "
@@ -149,15 +177,18 @@ async def send_confirmation_request(client: Client, message: Message, user: str,
             return
 
     try:
-        await message.reply_text(
+        await enqueue(
+            message.reply_text,
             text=text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            priority=PRIORITY_CONFIRMATION,
+            wait=True
         )
     except Exception as e:
         bot_logger.error(f"error sending confirmation request: {e}")
         return
 
-    bot_data["confirmations"][user.replace("@", "")] = {"gift": message}
+    await add_confirmation(message=message, target=user)
     return
 
 
@@ -178,30 +209,27 @@ async def exchange(client: Client, message: Message):
     if message.caption is None:
         await safe_delete(message)
         text = "⚠️ Ricordati di allegare uno <b>screenshot</b>."
-        await send_message_with_close_button(client=client, message=message, text=text)
+        await send_message_with_close_button(client=client, message=message, text=text, ttl=EPHEMERAL_TTL)
         return
 
-    pattern = r"[/.!](\w+)(?:\s+(@\w+|(\d{7,})|<a\s+href=\"tg://user\?id=(\d{7,})\">.*?</a>))?\s*(.*)?"
-
-    match = re.match(pattern, message.caption)
-
-    _, mentioned = match.group(1), (match.group(2) or None)
-    if mentioned is None:
+    parsed = parse_caption(message.caption)
+    if parsed is None or parsed.target is None:
         await safe_delete(message)
         text = "⚠️ Indica l'<b>utente</b> con cui hai effettuato lo scambio."
-        await send_message_with_close_button(client=client, message=message, text=text)
+        await send_message_with_close_button(client=client, message=message, text=text, ttl=EPHEMERAL_TTL)
         return
 
-    user = match.group(3) or match.group(4) or match.group(2)
-    feedback = match.group(5) or None
+    user = parsed.target
+    feedback = parsed.feedback
     if feedback is None:
         await safe_delete(message)
         text = "⚠️ Aggiungi un <b>feedback</b> per assegnare lo scambio."
-        await send_message_with_close_button(client=client, message=message, text=text)
+        await send_message_with_close_button(client=client, message=message, text=text, ttl=EPHEMERAL_TTL)
         return
 
     try:
-        recipient = await client.get_chat_member(
+        recipient = await get_chat_member(
+            client=client,
             chat_id=message.chat.id,
             user_id=user
         )
@@ -213,7 +241,8 @@ async def exchange(client: Client, message: Message):
                 return
             else:
                 try:
-                    recipient = await client.get_chat_member(
+                    recipient = await get_chat_member(
+                        client=client,
                         chat_id=int(os.getenv("GROUP_ID")),
                         user_id=dict(recipient[0])["user_id"]
                     )
@@ -229,7 +258,8 @@ async def exchange(client: Client, message: Message):
         await send_message_with_close_button(
             client=client,
             message=message,
-            text="⚠️ <b>Warning</b>\n\n▪️ Tagga l'altro membro con cui hai effettuato lo scambio."
+            text="⚠️ <b>Warning</b>\n\n▪️ Tagga l'altro membro con cui hai effettuato lo scambio.",
+            ttl=EPHEMERAL_TTL
         )
         return
 
@@ -238,7 +268,8 @@ async def exchange(client: Client, message: Message):
         await send_message_with_close_button(
             client=client,
             message=message,
-            text="⚠️ <b>Warning</b>\n\n▪️ L'utente non è nel gruppo."
+            text="⚠️ <b>Warning</b>\n\n▪️ L'utente non è nel gruppo.",
+            ttl=EPHEMERAL_TTL
         )
         return
 
@@ -247,7 +278,8 @@ async def exchange(client: Client, message: Message):
         await send_message_with_close_button(
             client=client,
             message=message,
-            text="⚠️ <b>Warning</b>\n\n▪️ Non puoi assegnare punti a utenti bannati."
+            text="⚠️ <b>Warning</b>\n\n▪️ Non puoi assegnare punti a utenti bannati.",
+            ttl=EPHEMERAL_TTL
         )
         return
 
@@ -256,52 +288,24 @@ async def exchange(client: Client, message: Message):
         await send_message_with_close_button(
             client=client,
             message=message,
-            text="⚠️ <b>Warning</b>\n\n▪️ Hai taggato un bot."
+            text="⚠️ <b>Warning</b>\n\n▪️ Hai taggato un bot.",
+            ttl=EPHEMERAL_TTL
         )
         return
 
-    forwarded = await message.forward(chat_id=int(os.getenv("DEPOSIT_CHAT_ID")))
-
-    old_sender_points = await get_user_points(sender.id)
-    old_recipient_points = await get_user_points(recipient.user.id)
+    forwarded = await enqueue(message.forward, chat_id=int(os.getenv("DEPOSIT_CHAT_ID")), wait=True)
 
-    points_sender = await add_to_table(
-        table_name="main_table",
-        content={
-            "user_id": sender.id,
-            "username": sender.username
-        }
-    )
-
-    if old_sender_points and points_sender:
-        db_logger.debug(f"Aggiornamento punti utente {sender.id}: {old_sender_points} -> {points_sender}")
-
-    points_recipient = await add_to_table(
-        table_name="main_table",
-        content={
-            "user_id": recipient.user.id,
-            "username": recipient.user.username
-        }
+    recorded = await record_exchange(
+        sender={"user_id": sender.id, "username": sender.username},
+        recipient={"user_id": recipient.user.id, "username": recipient.user.username},
+        feedback=feedback,
+        screenshot=forwarded.link
     )
+    points_sender = recorded["points_sender"]
+    points_recipient = recorded["points_recipient"]
+    added_id = recorded["exchange_id"]
 
-    if old_recipient_points and points_recipient:
-        db_logger.debug(f"Aggiornamento punti utente {recipient.user.id}: {old_recipient_points} -> {points_recipient}")
-
-    added_id = await add_to_table(
-        table_name="exchanges",
-        content={
-            "member_1": sender.id,
-            "member_2": recipient.user.id,
-            "username_1": sender.username,
-            "username_2": recipient.user.username,
-            "feedback": feedback,
-            "screenshot": forwarded.link,
-            "exchange_time": datetime.now(tz=pytz.timezone("Europe/Rome")).replace(tzinfo=None)
-        }
-    )
-
-    if points_sender is not None and points_recipient is not None and added_id is not None:
-        db_logger.info(msg=f"Wrote Database Correctly (id #{added_id}).")
+    db_logger.info(msg=f"Wrote Database Correctly (id #{added_id}).")
 
     if points_sender == 0:
         if added_id not in bot_data:
@@ -310,10 +314,12 @@ async def exchange(client: Client, message: Message):
             client=client,
             chat_id=int(os.getenv("NOTIFICATION_CHAT_ID")),
             message=message,
+            priority=PRIORITY_NOTIFICATION,
+            wait=True,
             text=f"🎯 L'utente {sender.mention} ha ottenuto {SOGLIA} punti."
         )
         bot_data[int(added_id)]["member_1_gift_notification"] = sent_message.id
-        await save_persistence(bot_data)
+        await save_persistence(bot_data, int(added_id))
 
     if points_recipient == 0:
         if added_id not in bot_data:
@@ -322,10 +328,12 @@ async def exchange(client: Client, message: Message):
             client=client,
             chat_id=int(os.getenv("NOTIFICATION_CHAT_ID")),
             message=message,
+            priority=PRIORITY_NOTIFICATION,
+            wait=True,
             text=f"🎯 L'utente {recipient.user.mention} ha ottenuto {SOGLIA} punti."
         )
         bot_data[int(added_id)]["member_2_gift_notification"] = sent_message.id
-        await save_persistence(bot_data)
+        await save_persistence(bot_data, int(added_id))
 
     text = f"✅ <b>Scambio Registrato Correttamente</b>\n\n"
     if points_sender == 0:
@@ -349,7 +357,8 @@ async def exchange(client: Client, message: Message):
         ]
     ]
 
-    await client.send_message(
+    await enqueue(
+        client.send_message,
         chat_id=message.chat.id,
         text=text,
         parse_mode=ParseMode.HTML,
@@ -381,7 +390,8 @@ async def request_gift(client: Client, message: Message):
 
     if message.message_thread_id is not None and message.message_thread_id != 1:
         await safe_delete(message)
-        await client.send_message(
+        await enqueue(
+            client.send_message,
             chat_id=message.chat.id,
             text = f"ℹ️ Ciao {message.from_user.mention}. Questa non è la chat adibita alla richiesta di regali.\n\n"
                    f"🧭 <b>Per poter formulare una richiesta, recati nel <a href=\"{GROUP_LINK}\">gruppo</a></b>.",
@@ -402,6 +412,7 @@ async def request_gift(client: Client, message: Message):
             message=message,
             text=text,
             # thread_id=THREAD_ID
+            ttl=EPHEMERAL_TTL
         )
         return
 
@@ -413,13 +424,15 @@ async def request_gift(client: Client, message: Message):
             message=message,
             text=text,
             # thread_id=THREAD_ID
+            ttl=EPHEMERAL_TTL
         )
         return
 
     await delete_user_unaccepted_requests(user=message.from_user.id)
 
     if not await check_request_requirements(user_id=message.from_user.id):
-        await client.send_message(
+        await enqueue(
+            client.send_message,
             chat_id=message.chat.id,
             text=f"⚠️ <b>Warning</b>\n\n🔸 <b>{message.from_user.mention} ha già ricevuto 2 regali</b>. "
                  "Per poterne chiedere un altro, deve prima farne almeno uno.",
@@ -431,7 +444,8 @@ async def request_gift(client: Client, message: Message):
         await safe_delete(message)
         return
 
-    await message.forward(int(os.getenv("DEPOSIT_CHAT_ID")))
+    # aspetto l'inoltro: subito dopo il messaggio viene cancellato
+    await enqueue(message.forward, chat_id=int(os.getenv("DEPOSIT_CHAT_ID")), wait=True)
     await safe_delete(message)
 
     added_id = await add_to_table(
@@ -446,7 +460,8 @@ async def request_gift(client: Client, message: Message):
         }
     )
 
-    message = await client.send_photo(
+    message = await enqueue(
+        client.send_photo,
         photo=message.photo.file_id,
         chat_id=message.chat.id,
         caption=f"🃏 <b>Richiesta Regalo</b>\n\n🔹 {message.from_user.mention} sta richiedendo un <b>nuovo regalo</b>.",
@@ -455,6 +470,7 @@ async def request_gift(client: Client, message: Message):
             [InlineKeyboardButton("🚮 Chiudi – Solo Admin", callback_data="close_admin")]
         ]),
         # message_thread_id=THREAD_ID
+        wait=True
     )
 
     await execute_query_for_value(
@@ -463,7 +479,7 @@ async def request_gift(client: Client, message: Message):
     )
 
 
-async def accept_gift(client: Client, callback_query: CallbackQuery):
+async def accept_gift(client: Client, callback_query: CallbackQuery, data: CallbackData):
     global bot_data
     global MANUTENZIONE
 
@@ -471,7 +487,7 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
         await maintenance(client=client, message=callback_query.message)
         return
 
-    gift_id = callback_query.data.split("_")[-1]
+    gift_id = data.args[-1]
 
     gift = await get_item_infos(table="gifts", identifier=gift_id)
 
@@ -520,11 +536,12 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
     if gift is None:
         return
 
-    if callback_query.data.startswith("accept_gift_for_"):
+    if data.action == "accept_gift_for":
         if (user_requesting := gift["user_id"]) == (gifting_by_id := int(callback_query.from_user.id)):
             return
         try:
-            user_requesting = await client.get_chat_member(
+            user_requesting = await get_chat_member(
+                client=client,
                 chat_id=callback_query.message.chat.id,
                 user_id=user_requesting
             )
@@ -562,7 +579,8 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
             ]
         ]
 
-        await client.send_photo(
+        await enqueue(
+            client.send_photo,
             photo=callback_query.message.photo.file_id,
             chat_id=callback_query.message.chat.id,
             caption=f"❓ <b>Accettazione Richiesta</b>\n\n🎖 {callback_query.from_user.mention} sta accettando la richiesta "
@@ -577,20 +595,18 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
 
         await safe_delete(callback_query.message)
 
-    elif "accepting" in callback_query.data and "gift" in callback_query.data:
+    elif data.action == "accepting":
         if not await is_admin(callback_query.from_user.id):
             return
 
-        listed = callback_query.data.split("_")
-        listed.pop(0)
-        listed.pop(1)
         listed = {
-            "accepting": int(listed[0]),
+            "accepting": int(data.args[0]),
             "requesting": gift["user_id"]
         }
 
         try:
-            user_requesting = await client.get_chat_member(
+            user_requesting = await get_chat_member(
+                client=client,
                 chat_id=callback_query.message.chat.id,
                 user_id=gift["user_id"]
             )
@@ -609,7 +625,8 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
             return
 
         try:
-            user_accepting = await client.get_chat_member(
+            user_accepting = await get_chat_member(
+                client=client,
                 chat_id=callback_query.message.chat.id,
                 user_id=listed["accepting"]
             )
@@ -628,7 +645,8 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
             return
 
         if not await check_request_requirements(user_id=listed["requesting"]):
-            await client.send_message(
+            await enqueue(
+                client.send_message,
                 chat_id=callback_query.message.chat.id,
                 text=f"⚠️ <b>Warning</b>\n\n🔸 Non è possibile accettare questo regalo perché "
                      f"nel frattempo <b>{user_requesting.user.mention} ha raggiunto il limite di 2 regali</b>. "
@@ -664,7 +682,8 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
             ]
         ]
 
-        await client.edit_message_caption(
+        await enqueue(
+            client.edit_message_caption,
             chat_id=callback_query.message.chat.id,
             message_id=callback_query.message.id,
             caption=f"✅ <b>Regalo Approvato</b>\n\n"
@@ -674,13 +693,14 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
             parse_mode=ParseMode.HTML
         )
 
-    elif callback_query.data.startswith("abort_"):
+    elif data.action == "abort":
         user_id = callback_query.from_user.id
         if not await is_admin(user_id):
             return
 
         try:
-            user_requesting = await client.get_chat_member(
+            user_requesting = await get_chat_member(
+                client=client,
                 chat_id=callback_query.message.chat.id,
                 user_id=gift["user_id"]
             )
@@ -688,7 +708,8 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
             bot_logger.error(f"Errore durante il reperimento delle informazioni dell'utente {gift["user_id"]}: {e}")
             return
 
-        await client.edit_message_text(
+        await enqueue(
+            client.edit_message_text,
             chat_id=callback_query.message.chat.id,
             message_id=callback_query.message.id,
             text=f"🃏 <b>Richiesta Regalo</b>\n\n🔹 {user_requesting.user.mention} sta richiedendo "
@@ -700,25 +721,28 @@ async def accept_gift(client: Client, callback_query: CallbackQuery):
         )
 
 
-async def cancel_gift(client: Client, callback_query: CallbackQuery):
+async def cancel_gift(client: Client, callback_query: CallbackQuery, data: CallbackData):
     if not await is_admin(callback_query.from_user.id):
         return
 
-    gift_id = int(callback_query.data.split("_")[-1])
+    gift_id = int(data.args[0])
     gift_infos = await get_item_infos(table="gifts", identifier=gift_id)
 
-    sender = await client.get_chat_member(
+    sender = await get_chat_member(
+        client=client,
         chat_id=callback_query.message.chat.id,
         user_id=("@" + gift_infos["username"]) if gift_infos["username"] else int(gift_infos["user_id"])
     )
 
-    recipient = await client.get_chat_member(
+    recipient = await get_chat_member(
+        client=client,
         chat_id=callback_query.message.chat.id,
         user_id=("@" + gift_infos["gifted_by_username"]) if gift_infos["gifted_by_username"] else int(gift_infos["gifted_by_id"])
     )
 
     await set_as_cancelled(table="gifts", identifier=gift_id)
-    await client.send_message(
+    await enqueue(
+        client.send_message,
         chat_id=callback_query.message.chat.id,
         text=f"🌪 Regalo da {sender.user.mention} a {recipient.user.mention} <b>cancellato</b> correttamente.",
         reply_markup=InlineKeyboardMarkup([
@@ -730,32 +754,36 @@ async def cancel_gift(client: Client, callback_query: CallbackQuery):
     await safe_delete(callback_query.message)
 
 
-async def confirm_exchange(client: Client, callback_query: CallbackQuery):
+async def confirm_exchange(client: Client, callback_query: CallbackQuery, data: CallbackData):
     global MANUTENZIONE
     if MANUTENZIONE:
         await maintenance(client=client, message=callback_query.message)
         return
 
+    sender_id, target = data.args
     if (callback_query.from_user.username is None or
-            callback_query.from_user.username != callback_query.data.split("_", maxsplit=3)[-1]):
+            callback_query.from_user.username.lower() != target.lower()):
+        return
+
+    confirmation = get_confirmation(target)
+    if confirmation is None or confirmation.sender_id != int(sender_id):
+        bot_logger.error(msg="confirm_exchange: message not found")
+        return
+    try:
+        message = await client.get_messages(chat_id=confirmation.chat_id, message_ids=confirmation.message_id)
+    except RPCError as e:
+        bot_logger.error(f"confirm_exchange: error retrieving message {confirmation.message_id}: {e}")
         return
-    message = None
-    for el in bot_data["confirmations"]:
-        message = bot_data["confirmations"][el]
-        if message.from_user.id == int(callback_query.data.split("_", maxsplit=3)[-2]):
-            break
-        message = None
-
-    if message is None:
-        bot_data.error(msg="confirm_exchange: message not found")
+    if message is None or message.empty:
+        bot_logger.error(f"confirm_exchange: message {confirmation.message_id} no longer exists")
+        await remove_confirmation(target)
         return
-    message = bot_data["confirmations"][callback_query.data.split("_", maxsplit=3)[-1]]
-    forwarded = await message.forward(chat_id=int(os.getenv("DEPOSIT_CHAT_ID")))
+    forwarded = await enqueue(message.forward, chat_id=int(os.getenv("DEPOSIT_CHAT_ID")), wait=True)
     sender = message.from_user
     recipient = callback_query.from_user
 
     await add_to_table(
-        table_name="user",
+        table_name="users",
         content={
             "user_id": recipient.id,
             "username": recipient.username
@@ -764,45 +792,20 @@ async def confirm_exchange(client: Client, callback_query: CallbackQuery):
 
     await callback_query.message.delete()
 
-    pattern = r"[/.!](\w+)(?:\s+(@\w+|(\d{7,})|<a\s+href=\"tg://user\?id=(\d{7,})\">.*?</a>))?\s*(.*)?"
-
-    match = re.match(pattern, message.caption)
-
     # ho già controllato se feedback è None (non lo è)
+    feedback = parse_caption(confirmation.caption).feedback
 
-    feedback = match.group(5)
-
-    points_sender = await add_to_table(
-        table_name="main_table",
-        content={
-            "user_id": sender.id,
-            "username": sender.username
-        }
-    )
-
-    points_recipient = await add_to_table(
-        table_name="main_table",
-        content={
-            "user_id": recipient.id,
-            "username": recipient.username
-        }
+    recorded = await record_exchange(
+        sender={"user_id": sender.id, "username": sender.username},
+        recipient={"user_id": recipient.id, "username": recipient.username},
+        feedback=feedback,
+        screenshot=forwarded.link
     )
+    points_sender = recorded["points_sender"]
+    points_recipient = recorded["points_recipient"]
+    added_id = recorded["exchange_id"]
 
-    added_id = await add_to_table(
-        table_name="exchanges",
-        content={
-            "member_1": sender.id,
-            "member_2": recipient.id,
-            "username_1": sender.username,
-            "username_2": recipient.username,
-            "feedback": feedback,
-            "screenshot": forwarded.link,
-            "exchange_time": datetime.now(tz=pytz.timezone("Europe/Rome")).replace(tzinfo=None)
-        }
-    )
-
-    if points_sender is not None and points_recipient is not None and added_id is not None:
-        db_logger.info(msg=f"Wrote Database Correctly (id #{added_id}).")
+    db_logger.info(msg=f"Wrote Database Correctly (id #{added_id}).")
 
     if points_sender == 0:
         if added_id not in bot_data:
@@ -811,10 +814,12 @@ async def confirm_exchange(client: Client, callback_query: CallbackQuery):
             client=client,
             chat_id=int(os.getenv("NOTIFICATION_CHAT_ID")),
             message=message,
+            priority=PRIORITY_NOTIFICATION,
+            wait=True,
             text=f"🎯 L'utente {sender.mention} ha ottenuto {SOGLIA} punti."
         )
         bot_data[int(added_id)]["member_1_gift_notification"] = sent_message.id
-        await save_persistence(bot_data)
+        await save_persistence(bot_data, int(added_id))
 
     if points_recipient == 0:
         if added_id not in bot_data:
@@ -823,10 +828,12 @@ async def confirm_exchange(client: Client, callback_query: CallbackQuery):
             client=client,
             chat_id=int(os.getenv("NOTIFICATION_CHAT_ID")),
             message=message,
+            priority=PRIORITY_NOTIFICATION,
+            wait=True,
             text=f"🎯 L'utente {recipient.mention} ha ottenuto {SOGLIA} punti."
         )
         bot_data[int(added_id)]["member_2_gift_notification"] = sent_message.id
-        await save_persistence(bot_data)
+        await save_persistence(bot_data, int(added_id))
 
     text = f"✅ <b>Scambio Registrato Correttamente</b>\n\n"
     if points_sender == 0:
@@ -850,18 +857,19 @@ async def confirm_exchange(client: Client, callback_query: CallbackQuery):
         ]
     ]
 
-    await client.send_message(
+    await enqueue(
+        client.send_message,
         chat_id=message.chat.id,
         text=text,
         parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-    del bot_data["confirmations"][callback_query.from_user.username.replace('@', '')]
+    await remove_confirmation(target)
     await safe_delete(message)
 
 
-async def cancel_exchange(client: Client, callback_query: CallbackQuery):
+async def cancel_exchange(client: Client, callback_query: CallbackQuery, data: CallbackData):
     global MANUTENZIONE
 
     if not await is_admin(callback_query.from_user.id):
@@ -871,7 +879,7 @@ async def cancel_exchange(client: Client, callback_query: CallbackQuery):
         await maintenance(client=client, message=callback_query.message)
         return
 
-    exchange_infos = await get_item_infos(table="exchanges", identifier=callback_query.data.split("_")[-1])
+    exchange_infos = await get_item_infos(table="exchanges", identifier=data.args[0])
     if exchange_infos.get("cancelled", None):
         return
 
@@ -879,6 +887,7 @@ async def cancel_exchange(client: Client, callback_query: CallbackQuery):
     points_sender = await decrease_user_points(exchange_infos["member_1"])
     points_recipient = await decrease_user_points(exchange_infos["member_2"])
     await set_as_cancelled(table="exchanges", identifier=exchange_infos["id"])
+    invalidate_charts()
 
     if points_sender is None:
         db_logger.error(f"{exchange_infos['member_1']} non trovato!")
@@ -898,12 +907,14 @@ async def cancel_exchange(client: Client, callback_query: CallbackQuery):
             message_ids=bot_data[int(exchange_infos["id"])]["member_2_gift_notification"]
         )
 
-    member_1 = await client.get_chat_member(
+    member_1 = await get_chat_member(
+        client=client,
         chat_id=callback_query.message.chat.id,
         user_id=exchange_infos["member_1"]
     )
 
-    member_2 = await client.get_chat_member(
+    member_2 = await get_chat_member(
+        client=client,
         chat_id=callback_query.message.chat.id,
         user_id=exchange_infos["member_2"]
     )
@@ -921,7 +932,15 @@ async def send_message_with_close_button(client: Client,
                                          message: Message | None,
                                          text: str,
                                          chat_id=None,
-                                         thread_id=None):
+                                         thread_id=None,
+                                         priority: int = PRIORITY_REPLY,
+                                         wait: bool = False,
+                                         ttl: float | None = None):
+    """
+    Manda un messaggio con il pulsante "🚮 Chiudi", passando dalla coda dei messaggi in uscita.
+    :param wait: se True aspetta l'invio e restituisce il messaggio, altrimenti ritorna subito None
+    :param ttl: se indicato, il messaggio viene cancellato automaticamente dopo ttl secondi
+    """
     if message is None and chat_id is None:
         bot_logger.error("almeno uno tra 'message' e 'chat_id' deve essere definito")
         raise RPCError("almeno uno tra 'message' e 'chat_id' deve essere definito")
@@ -930,14 +949,29 @@ async def send_message_with_close_button(client: Client,
             InlineKeyboardButton("🚮 Chiudi", callback_data=f"close")
         ]
     ]
-    message = await client.send_message(
+    if ttl is not None:
+        return await enqueue(
+            send_expiring,
+            client.send_message,
+            chat_id=int(chat_id) if chat_id is not None else message.chat.id,
+            text=text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            message_thread_id=thread_id,
+            ttl=ttl,
+            priority=priority,
+            wait=wait
+        )
+    return await enqueue(
+        client.send_message,
         chat_id=int(chat_id) if chat_id is not None else message.chat.id,
         text=text,
         parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup(keyboard),
-        message_thread_id=thread_id
+        message_thread_id=thread_id,
+        priority=priority,
+        wait=wait
     )
-    return message
 
 
 async def user_exchanges(client: Client, message: Message):
@@ -979,7 +1013,8 @@ async def user_exchanges(client: Client, message: Message):
         return
 
     try:
-        tagged = await client.get_chat_member(
+        tagged = await get_chat_member(
+            client=client,
             chat_id=int(os.getenv("GROUP_ID")),
             user_id=int(user) if user.isnumeric() else str(user)
         )
@@ -994,9 +1029,9 @@ async def user_exchanges(client: Client, message: Message):
     except Exception:
         tagged = None
 
-    res = await get_user_exchanges(user=str(tagged.user.id) if tagged is not None else str(user).removeprefix('@'))
+    page = await exchanges_page(client=client, user=str(tagged.user.id) if tagged is not None else user, tagged=tagged)
 
-    if res == -1:
+    if page == -1:
         await send_message_with_close_button(
             client=client,
             message=message,
@@ -1006,7 +1041,7 @@ async def user_exchanges(client: Client, message: Message):
 
     user_text = user if not user.isnumeric() else f'<code>{user}</code>'
 
-    if len(res) == 0:
+    if page is None:
         await send_message_with_close_button(
             client=client,
             message=message,
@@ -1014,166 +1049,97 @@ async def user_exchanges(client: Client, message: Message):
         )
         return
 
-    text = f"🔎 <b>Scambi di {tagged.user.mention if tagged is not None else user} ({len(res)})</b>\n"
-    for count, el in enumerate(res, start=1):
-        try:
-            sender = await client.get_chat_member(
-                chat_id=int(os.getenv("GROUP_ID")),
-                user_id=dict(el)['member_1']
-            )
-        except Exception:
-            sender = None
-        try:
-            recipient = await client.get_chat_member(
-                chat_id=int(os.getenv("GROUP_ID")),
-                user_id=dict(el)['member_2']
-            )
-        except Exception:
-            recipient = None
-        if count % 6 != 0:
-            text += f"\n🧩. <b>Scambio {dict(el)['id']}</b>\n\n\t🔹 <u>Sender</u> – "
-            if sender is not None and (sender.status.name != "LEFT" and sender.status.name != "BANNED"):
-                text += f"{sender.user.mention} (<code>{dict(el)['member_1']}</code>)"
-            else:
-                text += f"<code>{dict(el)['member_1']}</code>"
-            if tagged is not None:
-                if sender is not None:
-                    if tagged.user.id == sender.user.id:
-                        text += " 🔖"
-                else:
-                    if tagged.user.id == int(dict(el)['member_1']):
-                        text += " 🔖"
-            else:
-                if sender is not None:
-                    if user.isnumeric():
-                        if int(user) == sender.user.id:
-                            text += " 🔖"
-                    else:
-                        if sender.user.username is not None:
-                            if user == sender.user.username:
-                                text += " 🔖"
-                        elif user == '@' + dict(el)['username_1']:
-                            text += " 🔖"
-                else:
-                    if user.isnumeric():
-                        if int(user) == int(dict(el)['member_1']):
-                            text += " 🔖"
-                    else:
-                        if user == '@' + dict(el)['username_1']:
-                            text += " 🔖"
-
-            text += "\n\t🔸 <u>Recipient</u> – "
-            if recipient is not None and (recipient.status.name != "LEFT" and recipient.status.name != "BANNED"):
-                text += f"{recipient.user.mention} (<code>{dict(el)['member_2']}</code>)"
-            else:
-                text += f"<code>{dict(el)['member_2']}</code>"
-            if tagged is not None:
-                if recipient is not None:
-                    if tagged.user.id == recipient.user.id:
-                        text += " 🔖"
-                else:
-                    if tagged.user.id == int(dict(el)['member_2']):
-                        text += " 🔖"
-            else:
-                if recipient is not None:
-                    if user.isnumeric():
-                        if int(user) == recipient.user.id:
-                            text += " 🔖"
-                    else:
-                        if recipient.user.username is not None:
-                            if user == recipient.user.username:
-                                text += " 🔖"
-                        elif user == '@' + dict(el)['username_2']:
-                            text += " 🔖"
-                else:
-                    if user.isnumeric():
-                        if int(user) == int(dict(el)['member_2']):
-                            text += " 🔖"
-                    else:
-                        if user == '@' + dict(el)['username_2']:
-                            text += " 🔖"
-            text += f"\n\t🔹 <u>Feedback</u> – <i>{dict(el)['feedback']}</i>"
-            text += f"\n\t🔸 <u>Screenshot</u> – 🔗 <a href=\"{dict(el)['screenshot']}\">Link</a>"
-            text += f"\n\t🔹 <u>Exchange Time</u> – {dict(el)['exchange_time'].strftime('%a %d %b %Y, %H:%M')}"
-            text += f"\n\t🔸 <u>Cancelled</u> – <code>{dict(el)['cancelled']}</code>\n"
-        else:
-            await send_message_with_close_button(
-                client=client,
-                message=message,
-                text=text + "\n\n🆘 Usa il tuo <b>bot di moderazione</b> per maggiori info sugli utenti citati."
-            )
-            text = f"\n🧩. <b>Scambio {dict(el)['id']}</b>\n\n\t🔹 <u>Sender</u> – "
-            if sender is not None and (sender.status.name != "LEFT" and sender.status.name != "BANNED"):
-                text += f"{sender.user.mention} (<code>{dict(el)['member_1']}</code>)"
-            else:
-                text += f"<code>{dict(el)['member_1']}</code>"
-            if tagged is not None:
-                if sender is not None:
-                    if tagged.user.id == sender.user.id:
-                        text += " 🔖"
-                else:
-                    if tagged.user.id == dict(el)['member_1']:
-                        text += " 🔖"
-            else:
-                if sender is not None:
-                    if user.isnumeric():
-                        if user == sender.user.id:
-                            text += " 🔖"
-                    else:
-                        if sender.user.username is not None:
-                            if user == sender.user.username:
-                                text += " 🔖"
-                        elif user == '@' + dict(el)['username_1']:
-                            text += " 🔖"
-                else:
-                    if user.isnumeric():
-                        if int(user) == dict(el)['member_1']:
-                            text += " 🔖"
-                    else:
-                        if user == '@' + dict(el)['username_1']:
-                            text += " 🔖"
-
-            text += "\n\t🔸 <u>Recipient</u> – "
-            if recipient is not None and (recipient.status.name != "LEFT" and recipient.status.name != "BANNED"):
-                text += f"{recipient.user.mention} (<code>{dict(el)['member_2']}</code>)"
-            else:
-                text += f"<code>{dict(el)['member_2']}</code>"
-            if tagged is not None:
-                if recipient is not None:
-                    if tagged.user.id == recipient.user.id:
-                        text += " 🔖"
-                else:
-                    if tagged.user.id == dict(el)['member_2']:
-                        text += " 🔖"
-            else:
-                if recipient is not None:
-                    if user.isnumeric():
-                        if user == recipient.user.id:
-                            text += " 🔖"
-                    else:
-                        if recipient.user.username is not None:
-                            if user == recipient.user.username:
-                                text += " 🔖"
-                        elif user == '@' + dict(el)['username_2']:
-                            text += " 🔖"
-                else:
-                    if user.isnumeric():
-                        if int(user) == dict(el)['member_2']:
-                            text += " 🔖"
-                    else:
-                        if user == '@' + dict(el)['username_2']:
-                            text += " 🔖"
-            text += f"\n\t🔹 <u>Feedback</u> – <i>{dict(el)['feedback']}</i>"
-            text += f"\n\t🔸 <u>Screenshot</u> – 🔗 <a href=\"{dict(el)['screenshot']}\">Link</a>"
-            text += f"\n\t🔹 <u>Exchange Time</u> – {dict(el)['exchange_time'].strftime('%a %d %b %Y, %H:%M')}"
-            text += f"\n\t🔸 <u>Cancelled</u> – <code>{dict(el)['cancelled']}</code>\n"
+    text, keyboard = page
+    await enqueue(
+        client.send_message,
+        chat_id=message.chat.id,
+        text=text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-    await send_message_with_close_button(
+
+async def browse_exchanges(client: Client, callback_query: CallbackQuery, data: CallbackData):
+    if not await is_admin(callback_query.from_user.id):
+        return
+
+    direction, cursor, user = data.args
+    try:
+        tagged = await get_chat_member(
+            client=client,
+            chat_id=int(os.getenv("GROUP_ID")),
+            user_id=int(user) if user.isnumeric() else user
+        )
+    except Exception:
+        tagged = None
+
+    locale.setlocale(locale.LC_TIME, 'it_IT.UTF-8')
+
+    page = await exchanges_page(client=client, user=user, tagged=tagged, cursor=int(cursor), newer=direction == "n")
+    if page == -1:
+        await callback_query.answer("❌ Non è stato possibile interrogare il database.")
+        return
+    if page is None:
+        await callback_query.answer("ℹ️ Non ci sono altri scambi.")
+        return
+
+    text, keyboard = page
+    await enqueue(
+        client.edit_message_text,
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.id,
+        text=text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def exchanges_page(client: Client, user: str, tagged: ChatMember | None, cursor: int | None = None,
+                         newer: bool = False):
+    """
+    Prepara una pagina di /scambi, che sta sempre in un solo messaggio.
+    :param user: ID o @username dell'utente cercato
+    :param tagged: il membro cercato, se è stato trovato nel gruppo
+    :param cursor: ID dello scambio da cui partire (escluso), None per la pagina più recente
+    :param newer: se True mostra gli scambi più recenti di cursor, altrimenti quelli più vecchi
+    :return: (testo, tastiera), None se non ci sono scambi, -1 se non è stato possibile interrogare il database
+    """
+    lookup = user if user.isnumeric() else user.removeprefix('@')
+    rows, has_more = await get_user_exchanges_page(user=lookup, cursor=cursor, newer=newer)
+    if rows == -1:
+        return -1
+    if len(rows) == 0:
+        return None
+    # le pagine mostrano anche gli scambi annullati: il numero nell'intestazione è il totale di /punti
+    points = await get_user_points(user=lookup)
+    count = f" (🎰 Totale: {points[0]['total']})" if points != -1 and len(points) > 0 else ""
+
+    members = await resolve_members(
         client=client,
-        message=message,
-        text=text + "\n\n🆘 Usa il tuo <b>bot di moderazione</b> per maggiori info sugli utenti citati."
+        chat_id=int(os.getenv("GROUP_ID")),
+        users=[el['member_1'] for el in rows] + [el['member_2'] for el in rows]
     )
 
+    searched = SearchedUser(tagged=tagged, user=user)
+    header = f"🔎 <b>Scambi di {tagged.user.mention if tagged is not None else user}{count}</b>\n"
+    entries = [render_exchange(el, members, searched) for el in rows]
+
+    # se gli scambi non stanno in un messaggio ne mostro meno, tenendo i più vicini al cursore
+    if (shown := max(fitting_count([header] + entries) - 1, 1)) < len(rows):
+        has_more = True
+        rows, entries = (rows[-shown:], entries[-shown:]) if newer else (rows[:shown], entries[:shown])
+
+    has_newer, has_older = (has_more, True) if newer else (cursor is not None, has_more)
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton("◀", callback_data=f"exchanges_page_n_{rows[0]['id']}_{user}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton("▶", callback_data=f"exchanges_page_o_{rows[-1]['id']}_{user}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🚮 Chiudi", callback_data="close")])
+
+    return header + "".join(entries) + FOOTER, keyboard
+
 
 async def user_points(client: Client, message: Message):
     global MANUTENZIONE
@@ -1187,7 +1153,8 @@ async def user_points(client: Client, message: Message):
             await send_message_with_close_button(
                 client=client,
                 message=message,
-                text="❌ Non sei admin. Puoi usare <code>/punti</code> nel gruppo per conoscere il tuo punteggio."
+                text="❌ Non sei admin. Puoi usare <code>/punti</code> nel gruppo per conoscere il tuo punteggio.",
+                ttl=EPHEMERAL_TTL
             )
             return
         res = await get_user_points(message.from_user.id)
@@ -1195,7 +1162,8 @@ async def user_points(client: Client, message: Message):
             await send_message_with_close_button(
                 client=client,
                 message=message,
-                text="⚠️ Non ti ho trovato nel database (🎯 <b>0</b> punti)."
+                text="⚠️ Non ti ho trovato nel database (🎯 <b>0</b> punti).",
+                ttl=EPHEMERAL_TTL
             )
             return
 
@@ -1206,7 +1174,8 @@ async def user_points(client: Client, message: Message):
         await send_message_with_close_button(
             client=client,
             message=message,
-            text=text
+            text=text,
+            ttl=EPHEMERAL_TTL
         )
         return
 
@@ -1216,7 +1185,8 @@ async def user_points(client: Client, message: Message):
         user = message.command[1]
 
     try:
-        tagged = await client.get_chat_member(
+        tagged = await get_chat_member(
+            client=client,
             chat_id=int(os.getenv("GROUP_ID")),
             user_id=int(user) if user.isnumeric() else str(user)
         )
@@ -1225,7 +1195,8 @@ async def user_points(client: Client, message: Message):
         await send_message_with_close_button(
             client=client,
             message=message,
-            text=f"⚠️ Non ho potuto trovare l'utente <code>{user}</code>. Riprova."
+            text=f"⚠️ Non ho potuto trovare l'utente <code>{user}</code>. Riprova.",
+            ttl=EPHEMERAL_TTL
         )
         return
     except Exception:
@@ -1245,7 +1216,8 @@ async def user_points(client: Client, message: Message):
         await send_message_with_close_button(
             client=client,
             message=message,
-            text=text
+            text=text,
+            ttl=EPHEMERAL_TTL
         )
         return
 
@@ -1279,7 +1251,54 @@ async def user_points(client: Client, message: Message):
     await send_message_with_close_button(
         client=client,
         message=message,
-        text=text
+        text=text,
+        ttl=EPHEMERAL_TTL
+    )
+
+
+async def leaderboard(client: Client, message: Message):
+    global MANUTENZIONE
+    if MANUTENZIONE:
+        await maintenance(client=client, message=message)
+        return
+
+    await safe_delete(message)
+    if not await safety_check(client, message) and not await is_admin(message.from_user.id):
+        if message.chat.type == ChatType.PRIVATE:
+            await send_message_with_close_button(
+                client=client,
+                message=message,
+                text="❌ Non sei admin. Puoi usare <code>/classifica</code> nel gruppo per vedere la classifica.",
+                ttl=EPHEMERAL_TTL
+            )
+        # in un gruppo estraneo safety_check ha già avvisato le admin e fatto uscire il bot
+        return
+
+    text = "🏆 <b>Classifica</b>\n"
+    for field, title in (("total", "🎰 <u>Scambi Totali</u>"), ("points", "🎯 <u>Punti Attuali</u>")):
+        text += f"\n{title}\n"
+        rows = get_leaderboard(field=field, limit=LEADERBOARD_SIZE)
+        if len(rows) == 0:
+            text += "  <i>Nessun utente in classifica.</i>\n"
+        for position, row in enumerate(rows, start=1):
+            name = add_fucking_at(row['username']) if row['username'] else f"<code>{row['user_id']}</code>"
+            text += f"  {position}. {name} – <b>{row[field]}</b>\n"
+
+    total_rank = get_user_rank(user_id=message.from_user.id, field="total")
+    if total_rank is None:
+        text += "\n📍 Non sei ancora in classifica."
+    else:
+        # l'utente è in classifica, quindi la sua riga è nella cache dei punti
+        own = (await get_user_points(message.from_user.id))[0]
+        points_rank = get_user_rank(user_id=message.from_user.id, field="points")
+        text += (f"\n📍 La tua posizione: <b>#{total_rank}</b> per scambi totali (<b>{own['total']}</b>), "
+                 f"<b>#{points_rank}</b> per punti attuali (<b>{own['points']}</b>).")
+
+    await send_message_with_close_button(
+        client=client,
+        message=message,
+        text=text,
+        ttl=EPHEMERAL_TTL
     )
 
 
@@ -1322,7 +1341,8 @@ async def user_gifts(client: Client, message: Message):
         return
 
     try:
-        tagged = await client.get_chat_member(
+        tagged = await get_chat_member(
+            client=client,
             chat_id=int(os.getenv("GROUP_ID")),
             user_id=int(user) if user.isnumeric() else str(user)
         )
@@ -1352,7 +1372,7 @@ async def user_gifts(client: Client, message: Message):
 
     user_text = user if not user.isnumeric() else f'<code>{user}</code>'
 
-    if len(res["requested"]) == 0 and len(res["given"]):
+    if len(res["requested"]) == 0 and len(res["given"]) == 0:
         await send_message_with_close_button(
             client=client,
             message=message,
@@ -1360,270 +1380,232 @@ async def user_gifts(client: Client, message: Message):
         )
         return
 
-    text = f"🔎 <b>Regali di {tagged.user.mention if tagged is not None else user}</b>\n\n"
+    # risolvo prima tutti gli utenti citati, una volta sola e in parallelo
+    members = await resolve_members(
+        client=client,
+        chat_id=int(os.getenv("GROUP_ID")),
+        users=[
+            '@' + gift['gifted_by_username'] if gift['gifted_by_username'] else gift['gifted_by_id']
+            for gift in res["requested"] if gift['gifted_by_id']
+        ] + [gift['username'] or gift['user_id'] for gift in res["given"]]
+    )
 
-    tot_requested = len(res["requested"])
+    parts = [f"🔎 <b>Regali di {tagged.user.mention if tagged is not None else user}</b>\n\n"]
 
-    text += f"⬅ <b>Richiesti</b> (<code>{tot_requested}</code>)\n"
+    parts.append(f"⬅ <b>Richiesti</b> (<code>{len(res['requested'])}</code>)\n")
+    if len(res["requested"]) == 0:
+        parts.append("\nℹ Nessun regalo richiesto.\n\n")
+    for gift in res["requested"]:
+        if gift['gifted_by_id']:
+            identifier = '@' + gift['gifted_by_username'] if gift['gifted_by_username'] else gift['gifted_by_id']
+            giver = member_handle(members[identifier], gift['gifted_by_id'], gift['gifted_by_username'])
+        else:
+            giver = "<i>Non (ancora) ricevuto</i>"
+        parts.append(render_gift(
+            gift=gift,
+            requester=member_handle(tagged, gift['user_id'], gift['username']),
+            giver=giver
+        ))
+
+    parts.append(f"\n\n➡ <b>Donati</b> (<code>{len(res['given'])}</code>)\n")
+    if len(res["given"]) == 0:
+        parts.append("\nℹ Nessun regalo donato.\n")
+    for gift in res["given"]:
+        parts.append(render_gift(
+            gift=gift,
+            requester=member_handle(members[gift['username'] or gift['user_id']], gift['user_id'], gift['username']),
+            giver=member_handle(tagged, gift['gifted_by_id'], gift['gifted_by_username'])
+        ))
+
+    for chunk in pack_messages(parts):
+        await send_message_with_close_button(
+            client=client,
+            message=message,
+            text=chunk
+        )
+
+
+async def chart(client: Client, message: Message):
+    global MANUTENZIONE
+    if MANUTENZIONE:
+        await maintenance(client=client, message=message)
+        return
+
+    await safe_delete(message)
+    if not await safety_check(client, message) or not await is_admin(message.from_user.id):
+        await send_message_with_close_button(
+            client=client,
+            message=message,
+            text="❌ Non sei admin."
+        )
+        return
+
+    if len(message.command) <= 1 or message.command[1].lower() not in CHART_KINDS:
+        await send_message_with_close_button(
+            client=client,
+            message=message,
+            text="⚠️ Devi specificare il grafico.\n\n"
+                 "<b>Grafici</b>:\n"
+                 f"\t<code>/grafico {CHART_EXCHANGES}</code> – scambi al giorno\n"
+                 f"\t<code>/grafico {CHART_POINTS}</code> – distribuzione dei punti\n"
+                 f"\t<code>/grafico {CHART_TOP}</code> – utenti con più scambi"
+        )
+        return
+
+    kind = message.command[1].lower()
+    last_exchange_id = await get_last_exchange_id()
+    if last_exchange_id == -1:
+        await send_message_with_close_button(
+            client=client,
+            message=message,
+            text="❌ Non è stato possibile interrogare il database."
+        )
+        return
 
-    if tot_requested == 0:
-        text += "\nℹ Nessun regalo richiesto.\n\n"
+    caption = f"📊 <b>Grafico</b> – <code>{kind}</code> (ultimo scambio: <code>{last_exchange_id}</code>)"
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🚮 Chiudi", callback_data="close")]])
+
+    # i dati non sono cambiati: rimando l'immagine già caricata su Telegram
+    if (file_id := get_sent_chart(kind, last_exchange_id)) is not None:
+        await enqueue(
+            client.send_photo,
+            chat_id=message.chat.id,
+            photo=file_id,
+            caption=caption,
+            reply_markup=keyboard
+        )
+        return
+
+    if kind == CHART_EXCHANGES:
+        data = await get_exchanges_per_day(days=CHART_DAYS)
+        if data == -1:
+            await send_message_with_close_button(
+                client=client,
+                message=message,
+                text="❌ Non è stato possibile interrogare il database."
+            )
+            return
+    elif kind == CHART_POINTS:
+        data = get_points_distribution()
     else:
-        for count, el in enumerate(requested := res["requested"], start=1):
-            gift = dict(el)
-            if gift.get("gifted_by_id", None):
-                identifier = '@' + gift['gifted_by_username'] if gift['gifted_by_username'] else gift['gifted_by_id']
-                try:
-                    recipient = await client.get_chat_member(
-                        chat_id=int(os.getenv("GROUP_ID")),
-                        user_id=identifier
-                    )
-                except Exception:
-                    recipient = None
-            else:
-                recipient = False  # Regalo non ancora ricevuto
-
-            if count % 6 != 0:
-                text += f"\n       🎁. <b>Regalo {gift['id']}</b>\n       🔹 <u>Richiesto Da</u> – "
-                if tagged is not None and (tagged.status.name != "LEFT" and tagged.status.name != "BANNED"):
-                    if tagged.status.name != "LEFT" and tagged.status.name != "BANNED":
-                        if tagged.user.username:
-                            mention = add_fucking_at(tagged.user.username)
-                        else:
-                            mention = tagged.user.first_name
-                        text += f"{mention} (<code>{gift['user_id']}</code>)"
-                else:
-                    gift_username = '@' + gift['username']
-                    gift_id = gift['user_id']
-                    if gift_username:
-                        text += f"{gift_username} (<code>{gift_id}</code>)"
-                    else:
-                        text += f"<code>{gift_id}</code>"
-
-                text += "\n       🔸 <u>Donato Da</u> – "
-
-                if recipient is False:
-                    text += "<i>Non (ancora) ricevuto</i>\n"
-                elif recipient is None:
-                    if r := gift.get("gifted_by_username", None):
-                        text += f"{'@' + r} (<code>{gift.get('gifted_by_id')}</code>)\n"
-                    else:
-                        text += f"<code>{gift.get('gifted_by_id')}</code>\n"
-                else:
-                    if recipient.status.name != "LEFT" and recipient.status.name != "BANNED":
-                        if recipient.user.username:
-                            mention = add_fucking_at(recipient.user.username)
-                        else:
-                            mention = recipient.user.first_name
-                        text += f"{mention} (<code>{recipient.user.id}</code>)\n"
-                    else:
-                        gifted_username = '@' + gift['gifted_by_username']
-                        gifted_id = gift['gifted_by_id']
-                        if gifted_username:
-                            text += f"{gifted_username} (<code>{gifted_id}</code>)\n"
-                        else:
-                            text += f"<code>{gifted_id}</code>\n"
-
-                text += f"       ❔ <u>Richiesta</u> – 🔗 <a href=\"{gift['request_link']}\">Link</a>\n"
-                if recipient is not False:
-                    gifting_time = gift['gifted_at'].strftime('%a %d %b %Y, %H:%M')
-                else:
-                    gifting_time = "<code>None</code>\n"
-                text += f"       📆 <u>Regalo in Data</u> – {gifting_time}\n"
-                text += f"       ♻ <u>Cancellato</u> – <code>{gift['cancelled']}</code>\n"
-            else:
-                await send_message_with_close_button(
-                    client=client,
-                    message=message,
-                    text=text + "\n\n🆘 Usa il tuo <b>bot di moderazione</b> per maggiori info sugli utenti citati."
-                )
-                text = f"ㅤㅤ🎁. <b>Regalo {gift['id']}</b>\n       🔹 <u>Richiesto Da</u> – "
-                if tagged is not None and (tagged.status.name != "LEFT" and tagged.status.name != "BANNED"):
-                    mention = add_fucking_at(tagged.user.username) if tagged.user.username else tagged.user.first_name
-                    text += f"{mention} (<code>{gift['user_id']}</code>)"
-                else:
-                    gift_username = '@' + gift['username']
-                    gift_id = gift['user_id']
-                    if gift_username:
-                        text += f"{gift_username} (<code>{gift_id}</code>)"
-                    else:
-                        text += f"<code>{gift_id}</code>"
-
-                text += "\n       🔸 <u>Donato Da</u> – "
-
-                if recipient is False:
-                    text += "<i>Non (ancora) ricevuto</i>\n"
-                elif recipient is None:
-                    if r := gift.get("gifted_by_username", None):
-                        text += f"{'@' + r} (<code>{gift.get('gifted_by_id')}</code>)\n"
-                    else:
-                        text += f"<code>{gift.get('gifted_by_id')}</code>\n"
-                else:
-                    if recipient.status.name != "LEFT" and recipient.status.name != "BANNED":
-                        if recipient.user.username:
-                            mention = add_fucking_at(recipient.user.username)
-                        else:
-                            mention = recipient.user.first_name
-                        text += f"{mention} (<code>{recipient.user.id}</code>)\n"
-                    else:
-                        gifted_username = '@' + gift['gifted_by_username']
-                        gifted_id = gift['gifted_by_id']
-                        if gifted_username:
-                            text += f"{gifted_username} (<code>{gifted_id}</code>)\n"
-                        else:
-                            text += f"<code>{gifted_id}</code>\n"
-
-                text += f"       ❔ <u>Richiesta</u> – 🔗 <a href=\"{gift['request_link']}\">Link</a>\n"
-                if recipient is not False:
-                    gifting_time = gift['gifted_at'].strftime('%a %d %b %Y, %H:%M')
-                else:
-                    gifting_time = "<code>None</code>\n"
-                text += f"       📆 <u>Regalo in Data</u> – {gifting_time}\n"
-                text += f"       ♻ <u>Cancellato</u> – <code>{gift['cancelled']}</code>\n"
-
-    tot_given = len(res["given"])
-
-    text += f"\n\n➡ <b>Donati</b> (<code>{tot_given}</code>)\n"
-
-    if tot_given == 0:
-        text += "\nℹ Nessun regalo donato.\n"
+        data = [
+            (add_fucking_at(row['username']) if row['username'] else str(row['user_id']), row['total'])
+            for row in get_leaderboard(field="total", limit=CHART_TOP_SIZE)
+        ]
+
+    try:
+        image = io.BytesIO(await render_chart(kind, data))
+    except Exception as e:
+        bot_logger.error(f"error rendering chart {kind}: {e}")
+        await send_message_with_close_button(
+            client=client,
+            message=message,
+            text="❌ Non è stato possibile disegnare il grafico."
+        )
+        return
+    image.name = f"{kind}.png"
+
+    sent = await enqueue(
+        client.send_photo,
+        chat_id=message.chat.id,
+        photo=image,
+        caption=caption,
+        reply_markup=keyboard,
+        wait=True
+    )
+    remember_chart(kind, last_exchange_id, sent.photo.file_id)
+
+
+def collect_metrics() -> str:
+    """
+    Testo del file delle metriche: quelle di modules.metrics più lo stato di code e cache.
+    """
+    return render_prometheus(
+        extra_gauges={
+            "scambi_outbox_queue_depth": ("priority", outbox_depth()),
+            "scambi_member_cache": ("stat", member_cache.stats()),
+            "scambi_log_queue": ("stat", log_queue_stats())
+        },
+        extra_counters={
+            "scambi_outbox_calls_total": ("result", outbox_stats),
+            "scambi_ingress_messages_total": ("path", ingress_stats)
+        }
+    )
+
+
+def _latency_lines(histograms: dict, errors: dict, limit: int = 10) -> str:
+    text = ""
+    # prima quelli che hanno occupato più tempo in totale
+    for name, histogram in sorted(histograms.items(), key=lambda item: item[1].sum, reverse=True)[:limit]:
+        text += (f"  <code>{name}</code> – {histogram.count}× · p50 ≤{histogram.quantile(0.5) * 1000:g}ms · "
+                 f"p99 ≤{histogram.quantile(0.99) * 1000:g}ms · ❌ {errors.get(name, 0)}\n")
+    return text or "  <i>Nessun dato.</i>\n"
+
+
+async def stats(client: Client, message: Message):
+    await safe_delete(message)
+    if not await safety_check(client, message) or not await is_admin(message.from_user.id):
+        return
+
+    text = "📈 <b>Statistiche</b>\n\n⏱ <u>Handler</u>\n"
+    text += _latency_lines(handler_latency, handler_errors)
+    text += "\n🗄 <u>Database</u>\n"
+    text += _latency_lines(query_latency, query_errors)
+    text += "\n📡 <u>Chiamate a Telegram</u>\n"
+    for method, count in sorted(rpc_calls.items(), key=lambda item: item[1], reverse=True)[:10]:
+        text += f"  <code>{method}</code> – {count}\n"
+    depth = outbox_depth()
+    text += (f"\n📤 <u>Coda in uscita</u> – in attesa: {sum(depth.values())} "
+             f"({', '.join(f'{name} {count}' for name, count in depth.items())}) · "
+             f"inviate {outbox_stats['sent']} · fallite {outbox_stats['failed']} · "
+             f"FloodWait {outbox_stats['flood_waits']}")
+
+    await send_message_with_close_button(
+        client=client,
+        message=message,
+        text=text
+    )
+
+
+async def refresh_schema(client: Client, message: Message):
+    await safe_delete(message)
+    if not await safety_check(client, message) or not await is_admin(message.from_user.id):
+        return
+
+    try:
+        columns = await load_table_columns()
+    except Exception as e:
+        bot_logger.error(f"error refreshing schema cache: {e}")
+        text = "❌ Non è stato possibile interrogare il database."
     else:
-        for count, el in enumerate(given := res["given"], start=1):
-            gift = dict(el)
-            # Tutti questi regali hanno per forza almeno 'gifted_by_id'
-            try:
-                identifier = '@' + gift['username'] if gift['username'] else gift['user_id']
-                recipient = await client.get_chat_member(
-                    chat_id=int(os.getenv("GROUP_ID")),
-                    user_id=gift['username'] or gift['user_id']
-                )
-            except Exception:
-                recipient = None
-
-            if count % 6 != 0:
-                text += f"\n       🎁. <b>Regalo {gift['id']}</b>\n       🔹 <u>Richiesto Da</u> – "
-                if recipient is not None and (recipient.status.name != "LEFT" and recipient.status.name != "BANNED"):
-                    if recipient.user.username:
-                        mention = add_fucking_at(recipient.user.username)
-                    else:
-                        mention = recipient.user.first_name
-                    text += f"{mention} (<code>{recipient.user.id}</code>)"
-                else:
-                    gift_username = '@' + gift['username']
-                    gift_id = gift['user_id']
-                    if gift_username:
-                        text += f"{gift_username} (<code>{gift_id}</code>)"
-                    else:
-                        text += f"<code>{gift_id}</code>"
-
-                text += "\n       🔸 <u>Donato Da</u> – "
-
-                if tagged is None:
-                    if r := gift.get("gifted_by_username", None):
-                        text += f"{'@' + r} (<code>{gift.get('gifted_by_id')}</code>)\n"
-                    else:
-                        text += f"<code>{gift.get('gifted_by_id')}</code>\n"
-                else:
-                    if tagged.status.name != "LEFT" and tagged.status.name != "BANNED":
-                        if tagged.user.username:
-                            mention = add_fucking_at(tagged.user.username)
-                        else:
-                            mention = tagged.user.first_name
-                        text += f"{mention} (<code>{gift['user_id']}</code>)\n"
-                    else:
-                        gifted_username = '@' + gift['gifted_by_username']
-                        gifted_id = gift['gifted_by_id']
-                        if gifted_username:
-                            text += f"{gifted_username} (<code>{gifted_id}</code>)\n"
-                        else:
-                            text += f"<code>{gifted_id}</code>\n"
-
-                text += f"       ❔ <u>Richiesta</u> – 🔗 <a href=\"{gift['request_link']}\">Link</a>\n"
-                if recipient is not False:
-                    gifting_time = gift['gifted_at'].strftime('%a %d %b %Y, %H:%M')
-                else:
-                    gifting_time = "<code>None</code>"
-                text += f"       📆 <u>Regalo in Data</u> – {gifting_time}\n"
-                text += f"       ♻ <u>Cancellato</u> – <code>{gift['cancelled']}</code>\n"
-            else:
-                await send_message_with_close_button(
-                    client=client,
-                    message=message,
-                    text=text + "\n\n🆘 Usa il tuo <b>bot di moderazione</b> per maggiori info sugli utenti citati."
-                )
-                text = f"ㅤㅤ🎁. <b>Regalo {gift['id']}</b>\n       🔹 <u>Richiesto Da</u> – "
-                if recipient is not None and (recipient.status.name != "LEFT" and recipient.status.name != "BANNED"):
-                    if recipient.user.username:
-                        mention = add_fucking_at(recipient.user.username)
-                    else:
-                        mention = recipient.user.first_name
-                    text += f"{mention} (<code>{recipient.user.id}</code>)"
-                else:
-                    gift_username = '@' + gift['username']
-                    gift_id = gift['user_id']
-                    if gift_username:
-                        text += f"{gift_username} (<code>{gift_id}</code>)"
-                    else:
-                        text += f"<code>{gift_id}</code>"
-
-                text += "\n       🔸 <u>Donato Da</u> – "
-
-                if tagged is None:
-                    if r := gift.get("gifted_by_username", None):
-                        text += f"{'@' + r} (<code>{gift.get('gifted_by_id')}</code>)\n"
-                    else:
-                        text += f"<code>{gift.get('gifted_by_id')}</code>\n"
-                else:
-                    if tagged.status.name != "LEFT" and tagged.status.name != "BANNED":
-                        if tagged.status.name != "LEFT" and tagged.status.name != "BANNED":
-                            if tagged.user.username:
-                                mention = add_fucking_at(tagged.user.username)
-                            else:
-                                mention = tagged.user.first_name
-                            text += f"{mention} (<code>{gift['user_id']}</code>)\n"
-                    else:
-                        gifted_username = '@' + gift['gifted_by_username']
-                        gifted_id = gift['gifted_by_id']
-                        if gifted_username:
-                            text += f"{gifted_username} (<code>{gifted_id}</code>)\n"
-                        else:
-                            text += f"<code>{gifted_id}</code>\n"
-
-                text += f"       ❔ <u>Richiesta</u> – 🔗 <a href=\"{gift['request_link']}\">Link</a>\n"
-                if recipient is not False:
-                    gifting_time = gift['gifted_at'].strftime('%a %d %b %Y, %H:%M')
-                else:
-                    gifting_time = "<code>None</code>"
-                text += f"       📆 <u>Regalo in Data</u> – {gifting_time}\n"
-                text += f"       ♻ <u>Cancellato</u> – <code>{gift['cancelled']}</code>\n"
+        text = "🗄 <b>Cache dello schema aggiornata</b>\n\n"
+        for table, table_columns in columns.items():
+            text += f"🔹 <code>{table}</code> – {len(table_columns)} colonne\n"
 
     await send_message_with_close_button(
         client=client,
         message=message,
-        text=text + "\n\n🆘 Usa il tuo <b>bot di moderazione</b> per maggiori info sugli utenti citati."
+        text=text
     )
 
+
 # serve per evitare eccezioni
 # noinspection PyUnusedLocal
-async def close_message(client: Client, callback_query: CallbackQuery):
-    global bot_data
-    if callback_query.data.startswith("close_admin"):
+async def close_message(client: Client, callback_query: CallbackQuery, data: CallbackData):
+    if data.action in ("close_admin", "close_admin_gift"):
         if not await is_admin(callback_query.from_user.id):
             return
-        if user := (callback_query.data.split("_", maxsplit=3)[-1]):
-            if "confirmations" in bot_data and user in bot_data["confirmations"]:
-                del bot_data["confirmations"][user]
+        if data.args and (user := data.args[0]):
+            await remove_confirmation(user)
         await safe_delete(callback_query.message)
         return
-    elif callback_query.data.startswith("confirm_and_close"):
+    elif data.action == "confirm_and_close":
         if await is_admin(callback_query.from_user.id):
             await safe_delete(callback_query.message)
         return
 
-    list_el = callback_query.data.split("_")
-
-    if list_el[-1].isnumeric():
-        if callback_query.from_user.id == int(list_el[-1]):
+    if data.args and data.args[-1].isnumeric():
+        if callback_query.from_user.id == int(data.args[-1]):
             await safe_delete(callback_query.message)
     else:
         await safe_delete(callback_query.message)
@@ -1,60 +1,170 @@
+import asyncio
 import os
+import sys
+import time
+from types import CodeType
+from contextlib import asynccontextmanager
 
 import asyncpg
 import json
-import re
+import pytz
+from datetime import datetime
 
-from loggers import db_logger, bot_logger
-from globals import SOGLIA
+from modules.loggers import db_logger, bot_logger
+from modules.metrics import timed_query
+from modules.parser import is_valid_username, normalize_username
+from modules.ranking import Ranking
+from globals import SOGLIA, EXCHANGES_PAGE_SIZE
+
+# pool condiviso, creato in main.post_init e chiuso allo spegnimento
+_pool: asyncpg.Pool | None = None
+_pool_watchdog: asyncio.Task | None = None
+# connessioni attualmente in prestito: id -> (istante di acquisizione, codice e riga del chiamante)
+_borrowed: dict[int, tuple[float, CodeType, int]] = {}
+
+
+class PoolTimeoutError(asyncpg.exceptions.PostgresError):
+    """
+    Nessuna connessione libera entro DB_POOL_ACQUIRE_TIMEOUT. È una PostgresError, così le funzioni del modulo
+    la gestiscono come gli altri errori del database (-1, False, ...).
+    """
+
+
+# tabelle scritte con add_to_table: l'ordine delle colonne è letto una volta sola all'avvio
+CACHED_TABLES = ("main_table", "exchanges", "gifts", "users")
+_table_columns: dict[str, list[str]] = {}
+
+# righe di main_table per user_id, più un indice username normalizzato -> user_id. Caricate all'avvio e aggiornate in
+# write-through da add_to_table('main_table'), record_exchange e decrease_user_points
+_points_cache: dict[int, dict] = {}
+_points_by_username: dict[str, int] = {}
+# classifiche di /classifica, aggiornate insieme alla cache dei punti
+_rankings = {field: Ranking(field) for field in ("total", "points")}
+
+# migrazioni numerate (NNNN_nome.sql), applicate in ordine all'avvio e registrate in schema_migrations
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+# chiave dell'advisory lock che serializza più istanze avviate insieme
+MIGRATIONS_LOCK_ID = 7262253
 
 
 async def is_username_valid(username: str):
-    if not username:
-        return False
+    return is_valid_username(username)
 
-    pattern = r"^@[a-z][a-z0-9_]{5,}$"
-    return bool(re.match(pattern, username))
 
+def _user_lookup(user: int | str, id_column: str, username_column: str) -> tuple[str, int | str]:
+    """
+    Come cercare un utente per ID o per username: gli username sono confrontati in forma normalizzata,
+    così la ricerca usa l'indice su normalize_username(colonna).
+    :return: (espressione SQL da confrontare con il parametro, valore del parametro)
+    """
+    if isinstance(user, int) or user.isnumeric():
+        return id_column, int(user)
+    return f"normalize_username({username_column})", normalize_username(str(user))
 
+
+@timed_query
 async def is_table_empty():
-    conn = await connect_to_database()
+    async with acquire() as conn:
+        try:
+            count = await conn.fetchval("SELECT count(*) FROM persistence;")
+        except asyncpg.exceptions.PostgresError as err:
+            db_logger.error(err)
+            raise
+        else:
+            if count == 1:
+                res = await conn.fetch("SELECT data FROM persistence;")
+                if len(json.loads(next(res[0].values()))["jsondata"]) == 0:
+                    # noinspection SqlWithoutWhere
+                    await conn.execute("DELETE FROM persistence;")
+                    return True
+            return count == 0
+
+
+def _list_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        version, _, name = filename.partition("_")
+        if filename.endswith(".sql") and version.isnumeric():
+            migrations.append((int(version), name.removesuffix(".sql"), os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+@timed_query
+async def run_migrations():
+    """
+    Applica le migrazioni non ancora registrate in schema_migrations, ognuna nella sua transazione.
+    Chiamata all'avvio, prima di leggere lo schema.
+    :return: versioni applicate
+    """
+    applied = []
+    async with acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1);", MIGRATIONS_LOCK_ID)
+        try:
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INTEGER PRIMARY KEY, "
+                "name TEXT NOT NULL, "
+                "applied_at TIMESTAMPTZ NOT NULL DEFAULT now());"
+            )
+            done = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations;")}
+            for version, name, path in _list_migrations():
+                if version in done:
+                    continue
+                with open(path, encoding="utf-8") as f:
+                    sql = f.read()
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2);", version, name)
+                applied.append(version)
+                db_logger.info(f"Migrazione {version:04d} ({name}) applicata.")
+        except asyncpg.exceptions.PostgresError as err:
+            db_logger.error(f"Migrazione fallita: {err}")
+            raise
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1);", MIGRATIONS_LOCK_ID)
+    return applied
+
+
+@timed_query
+async def load_table_columns(tables: tuple[str, ...] = CACHED_TABLES):
+    """
+    Legge dal catalogo l'ordine delle colonne delle tabelle indicate e lo salva in cache.
+    Chiamata all'avvio e dal comando admin /schema.
+    :param tables: nomi delle tabelle da (ri)caricare
+    :return: dizionario {tabella: [colonne ordinate]}
+    """
+    query = """
+    SELECT table_name, column_name
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = ANY($1::text[])
+    ORDER BY table_name, ordinal_position;
+    """
     try:
-        count = await conn.fetchval("SELECT count(*) FROM persistence;")
+        async with acquire() as conn:
+            result = await conn.fetch(query, list(tables))
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
         raise
-    else:
-        if count == 1:
-            res = await conn.fetch("SELECT data FROM persistence;")
-            if len(json.loads(next(res[0].values()))["jsondata"]) == 0:
-                # noinspection SqlWithoutWhere
-                await conn.execute("DELETE FROM persistence;")
-                return True
-        await conn.close()
-        return count == 0
+    columns = {table: [] for table in tables}
+    for row in result:
+        columns[row['table_name']].append(row['column_name'])
+    _table_columns.update(columns)
+    db_logger.info(f"Cache dello schema aggiornata: {', '.join(f'{t} ({len(c)})' for t, c in columns.items())}")
+    return columns
 
 
-async def get_columns_order(conn, table_name: str):
+def get_columns_order(table_name: str):
     """
-    Recupera l'ordine delle colonne dal database.
-    :param conn: connessione al database
+    Recupera l'ordine delle colonne dalla cache dello schema, senza interrogare il database.
     :param table_name: nome della tabella
     :return: lista dei nomi delle colonne ordinate
     """
-    query = """
-    SELECT column_name
-    FROM information_schema.columns
-    WHERE table_name = $1
-    ORDER BY ordinal_position;
-    """
-    try:
-        result = await conn.fetch(query, table_name)
-        return [row['column_name'] for row in result]
-    except Exception as e:
-        db_logger.error(e)
-        raise
+    if not _table_columns.get(table_name):
+        raise asyncpg.exceptions.DataError(f"Tabella {table_name} non presente nella cache dello schema")
+    return _table_columns[table_name]
 
 
+@timed_query
 async def add_to_table(table_name: str, content: dict):
     """
     Aggiunge entry al database. Se l'utente esiste, aggiorna punti e username.
@@ -62,61 +172,150 @@ async def add_to_table(table_name: str, content: dict):
 
     :param table_name: il nome della tabella
     :param content: dizionario del tipo {'colonna1': valore1, ...}
-    :return: {'reset': True} se punti sono stati azzerati, altrimenti {'reset': False}
+    :return: per main_table i punti della riga restituita da RETURNING (user_id, username, points, total), che
+        aggiorna anche la cache tramite _cache_points (0 se sono stati azzerati); per le altre tabelle l'id
+        restituito da RETURNING, None se l'username non è valido
     """
-    conn = await connect_to_database()
-    try:
-        columns_order = await get_columns_order(conn, table_name)
-        ordered_content = {col: content[col] for col in columns_order if col in content}
-        if not ordered_content:
-            raise asyncpg.exceptions.DataError('Colonne non valide')
+    async with acquire() as conn:
+        try:
+            columns_order = get_columns_order(table_name)
+            ordered_content = {col: content[col] for col in columns_order if col in content}
+            if not ordered_content:
+                raise asyncpg.exceptions.DataError('Colonne non valide')
+
+            columns = list(ordered_content.keys())
+            values = list(ordered_content.values())
+
+            query = (
+                f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                f"VALUES ({', '.join([f'${i + 1}' for i in range(len(values))])}) "
+            )
 
-        columns = list(ordered_content.keys())
-        values = list(ordered_content.values())
+            if table_name == "main_table":
+                query += (
+                    f"ON CONFLICT (user_id) DO UPDATE SET "
+                    f"points = CASE WHEN {table_name}.points + 1 >= {str(SOGLIA)} THEN 0 ELSE {table_name}.points + 1 END, "
+                    f"total = {table_name}.total + 1,"
+                    f"username = EXCLUDED.username "
+                    f"RETURNING user_id, username, points, total"
+                )
+            elif table_name == "exchanges":
+                query += "RETURNING id"
 
-        query = (
-            f"INSERT INTO {table_name} ({', '.join(columns)}) "
-            f"VALUES ({', '.join([f'${i + 1}' for i in range(len(values))])}) "
-        )
+            elif table_name == "gifts":
+                query += "RETURNING id"
 
-        if table_name == "main_table":
-            query += (
-                f"ON CONFLICT (user_id) DO UPDATE SET "
-                f"points = CASE WHEN {table_name}.points + 1 >= {str(SOGLIA)} THEN 0 ELSE {table_name}.points + 1 END, "
-                f"total = {table_name}.total + 1,"
-                f"username = EXCLUDED.username "
-                f"RETURNING points"
-            )
-        elif table_name == "exchanges":
-            query += "RETURNING id"
+            elif table_name == "users":
+                if not await is_username_valid(content['username']):
+                    db_logger.error(f"Username non valido: {content['username']}")
+                    return None
+                query += "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username RETURNING user_id"
 
-        elif table_name == "gifts":
-            query += "RETURNING id"
+            if table_name == "main_table":
+                return _cache_points(await conn.fetchrow(query, *values))["points"]
 
-        elif table_name == "users":
-            if not await is_username_valid(content['username']):
-                db_logger.error(f"Username non valido: {content['username']}")
-                return None
-            query += f"ON CONFLICT (user_id) DO UPDATE SET username = {content['username']} RETURNING user_id"
+            result = await conn.fetchval(query, *values)
+            return result
 
-        result = await conn.fetchval(query, *values)
-        return result
+        except Exception as e:
+            db_logger.error(f"Errore durante l'inserimento in {table_name}: {e}")
+            bot_logger.error("Errore nel database. Vedi i log del database.")
+            raise
 
-    except Exception as e:
-        db_logger.error(f"Errore durante l'inserimento in {table_name}: {e}")
+
+@timed_query
+async def record_exchange(sender: dict, recipient: dict, feedback: str, screenshot: str):
+    """
+    Registra uno scambio con un'unica istruzione (quindi in modo atomico): aggiorna i punti di entrambi i membri
+    e inserisce la riga in 'exchanges'.
+
+    :param sender: dizionario del tipo {'user_id': ..., 'username': ...} di chi ha mandato il feedback
+    :param recipient: dizionario del tipo {'user_id': ..., 'username': ...} dell'altro membro
+    :param feedback: testo del feedback
+    :param screenshot: link allo screenshot inoltrato nella chat di deposito
+    :return: {'points_sender': ..., 'points_recipient': ..., 'exchange_id': ...}
+    """
+    query = """
+    WITH points_sender AS (
+        INSERT INTO main_table AS m (user_id, username) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET
+            points = CASE WHEN m.points + 1 >= $7 THEN 0 ELSE m.points + 1 END,
+            total = m.total + 1,
+            username = EXCLUDED.username
+        RETURNING user_id, username, points, total
+    ), points_recipient AS (
+        INSERT INTO main_table AS m (user_id, username) VALUES ($3, $4)
+        ON CONFLICT (user_id) DO UPDATE SET
+            points = CASE WHEN m.points + 1 >= $7 THEN 0 ELSE m.points + 1 END,
+            total = m.total + 1,
+            username = EXCLUDED.username
+        RETURNING user_id, username, points, total
+    ), exchange AS (
+        INSERT INTO exchanges (member_1, member_2, username_1, username_2, feedback, screenshot, exchange_time)
+        VALUES ($1, $3, $2, $4, $5, $6, $8)
+        RETURNING id
+    )
+    SELECT points_sender.user_id AS sender_id, points_sender.username AS sender_username,
+           points_sender.points AS sender_points, points_sender.total AS sender_total,
+           points_recipient.user_id AS recipient_id, points_recipient.username AS recipient_username,
+           points_recipient.points AS recipient_points, points_recipient.total AS recipient_total,
+           exchange.id AS exchange_id
+    FROM points_sender, points_recipient, exchange;
+    """
+    try:
+        async with acquire() as conn:
+            row = await conn.fetchrow(
+                query,
+                sender["user_id"], sender["username"],
+                recipient["user_id"], recipient["username"],
+                feedback, screenshot, SOGLIA,
+                datetime.now(tz=pytz.timezone("Europe/Rome")).replace(tzinfo=None)
+            )
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(f"Errore durante la registrazione dello scambio {sender['user_id']} -> "
+                        f"{recipient['user_id']}: {err}")
         bot_logger.error("Errore nel database. Vedi i log del database.")
         raise
-    finally:
-        await conn.close()
+    for member in ("sender", "recipient"):
+        _cache_points({
+            "user_id": row[f"{member}_id"],
+            "username": row[f"{member}_username"],
+            "points": row[f"{member}_points"],
+            "total": row[f"{member}_total"]
+        })
+    points_sender, points_recipient = row["sender_points"], row["recipient_points"]
+    db_logger.debug(f"Scambio #{row['exchange_id']}: punti {sender['user_id']} -> {points_sender}, "
+                    f"{recipient['user_id']} -> {points_recipient}")
+    return {"points_sender": points_sender, "points_recipient": points_recipient, "exchange_id": row["exchange_id"]}
+
+
+@timed_query
+async def upsert_users(users: list[tuple[int, str]]):
+    """
+    Inserisce o aggiorna più utenti con un solo executemany.
+    :param users: lista di tuple (user_id, username)
+    """
+    try:
+        async with acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO users (user_id, username) VALUES ($1, $2) "
+                "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username "
+                "WHERE users.username IS DISTINCT FROM EXCLUDED.username;",
+                users
+            )
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(f"Errore durante l'aggiornamento di {len(users)} utenti: {err}")
+        raise
 
 
+@timed_query
 async def retrieve_user(username: str):
-    conn = await connect_to_database()
     try:
-        res = await conn.fetch(
-            "SELECT user_id FROM users WHERE username = $1;",
-            username
-        )
+        async with acquire() as conn:
+            res = await conn.fetch(
+                "SELECT user_id FROM users WHERE normalize_username(username) = $1;",
+                normalize_username(username)
+            )
         if len(res) == 0:
             return False
         return res
@@ -125,109 +324,243 @@ async def retrieve_user(username: str):
         return False
 
 
+@timed_query
 async def decrease_user_points(user_id: int):
-    conn = await connect_to_database()
+    old_points = await get_user_points(user_id)
+    async with acquire() as conn:
+        try:
+            row = await conn.fetchrow(
+                "UPDATE main_table "
+                f"SET points = CASE WHEN points = 0 THEN {str(SOGLIA)} ELSE points - 1 END, "
+                "total = total - 1 "
+                "WHERE user_id = $1 RETURNING user_id, username, points, total;",
+                user_id
+            )
+            points = _cache_points(row)["points"] if row is not None else None
+            db_logger.debug(f"Aggiornamento punti {user_id} (riduzione): {old_points} -> {points}")
+            return points
+        except asyncpg.exceptions.PostgresError as err:
+            db_logger.error(err)
+            raise
+
+
+@timed_query
+async def get_user_exchanges_page(user: int | str, cursor: int | None = None, newer: bool = False,
+                                  limit: int = EXCHANGES_PAGE_SIZE):
+    """
+    Recupera una pagina di scambi di un utente con paginazione keyset sull'ID (niente OFFSET).
+    :param user: ID o username dell'utente
+    :param cursor: ID dello scambio da cui partire (escluso), None per la pagina più recente
+    :param newer: se True restituisce gli scambi più recenti di cursor, altrimenti quelli più vecchi
+    :param limit: numero massimo di scambi nella pagina
+    :return: (scambi in ordine di ID decrescente, True se ce ne sono altri nella stessa direzione),
+        oppure (-1, False) in caso di errore
+    """
+    columns = [_user_lookup(user, f"member_{n}", f"username_{n}")[0] for n in (1, 2)]
+    _, key = _user_lookup(user, "member_1", "username_1")
+    comparison, order = (">", "ASC") if newer else ("<", "DESC")
+    cursor_condition = f"AND id {comparison} $3 " if cursor is not None else ""
+    # un ramo per colonna, così ognuno usa il proprio indice e legge al più limit + 1 righe
+    branches = [
+        f"(SELECT * FROM exchanges WHERE {column} = $1 {cursor_condition}ORDER BY id {order} LIMIT $2)"
+        for column in columns
+    ]
+    query = f"SELECT * FROM ({' UNION ALL '.join(branches)}) AS page ORDER BY id {order} LIMIT $2"
+    args = [key, limit + 1] + ([cursor] if cursor is not None else [])
     try:
-        old_points = await get_user_points(user_id)
-        points = await conn.fetchval(
-            "UPDATE main_table "
-            f"SET points = CASE WHEN points = 0 THEN {str(SOGLIA)} ELSE points - 1 END, "
-            "total = total - 1 "
-            "WHERE user_id = $1 RETURNING points;",
-            user_id
-        )
-        db_logger.debug(f"Aggiornamento punti {user_id} (riduzione): {old_points} -> {points}")
-        return points
+        async with acquire() as conn:
+            res = await conn.fetch(query, *args)
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
-        raise
-    finally:
-        await conn.close()
+        return -1, False
+    rows = list(res[:limit])
+    if newer:
+        rows.reverse()
+    return rows, len(res) > limit
 
 
-async def get_user_exchanges(user: int | str):
-    conn = await connect_to_database()
-    if isinstance(user, int) or user.isnumeric():
-        user = int(user)
-        query = f"SELECT * FROM exchanges WHERE member_1 = $1 OR member_2 = $1"
-    else:
-        user=str(user)
-        query = f"SELECT * FROM exchanges WHERE username_1 = $1 OR username_2 = $1"
+@timed_query
+async def get_user_points(user: int | str):
+    column, user = _user_lookup(user, "user_id", "username")
+    cached = _points_cache.get(user if isinstance(user, int) else _points_by_username.get(user))
+    query = f"SELECT user_id, username, points, total FROM main_table WHERE {column} = $1"
+    if cached is not None:
+        return [dict(cached)]
     try:
-        res = await conn.fetch(query, user)
+        async with acquire() as conn:
+            res = await conn.fetch(query, user)
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
         return -1
     else:
+        for row in res:
+            _cache_points(row)
         return res
 
 
-async def get_user_points(user: int | str):
-    conn = await connect_to_database()
-    if isinstance(user, int) or user.isnumeric():
-        user = int(user)
-        query = f"SELECT * FROM main_table WHERE user_id = $1"
-    else:
-        user = str(user)
-        query = f"SELECT * FROM main_table WHERE username = $1"
+@timed_query
+async def load_points_cache():
+    """
+    Carica in memoria tutta main_table, così /punti risponde senza interrogare il database.
+    """
     try:
-        res = await conn.fetch(query, user)
+        async with acquire() as conn:
+            rows = await conn.fetch("SELECT user_id, username, points, total FROM main_table;")
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(err)
+        raise
+    _points_cache.clear()
+    _points_by_username.clear()
+    for row in rows:
+        _cache_points(row, rank=False)
+    for ranking in _rankings.values():
+        ranking.rebuild(_points_cache.values())
+    db_logger.info(f"Cache dei punti caricata ({len(_points_cache)} utenti).")
+
+
+def _cache_points(row, rank: bool = True) -> dict:
+    row = dict(row)
+    old = _points_cache.get(row["user_id"])
+    old_key = normalize_username(old["username"]) if old is not None and old["username"] is not None else None
+    if old_key is not None and _points_by_username.get(old_key) == row["user_id"]:
+        del _points_by_username[old_key]
+    _points_cache[row["user_id"]] = row
+    if row["username"] is not None:
+        _points_by_username[normalize_username(row["username"])] = row["user_id"]
+    if rank:
+        for ranking in _rankings.values():
+            ranking.update(row["user_id"], old, row)
+    return row
+
+
+def get_leaderboard(field: str, limit: int) -> list[dict]:
+    """
+    I primi utenti per ``field`` ('total' o 'points'), letti dalla classifica in memoria.
+    :return: righe di main_table (user_id, username, points, total) in ordine di classifica
+    """
+    return [_points_cache[user_id] for user_id in _rankings[field].top(limit)]
+
+
+def get_user_rank(user_id: int, field: str) -> int | None:
+    """
+    :return: la posizione dell'utente per ``field``, None se non è in main_table
+    """
+    row = _points_cache.get(int(user_id))
+    return _rankings[field].rank(row[field]) if row is not None else None
+
+
+def get_points_distribution() -> list[int]:
+    """
+    :return: quanti utenti hanno 0, 1, ..., SOGLIA punti, letti dalla cache dei punti
+    """
+    counts = [0] * (SOGLIA + 1)
+    for row in _points_cache.values():
+        counts[min(max(row["points"], 0), SOGLIA)] += 1
+    return counts
+
+
+@timed_query
+async def get_exchanges_per_day(days: int):
+    """
+    :return: lista di (giorno, scambi non cancellati) degli ultimi ``days`` giorni, -1 in caso di errore
+    """
+    try:
+        async with acquire() as conn:
+            res = await conn.fetch(
+                "SELECT exchange_time::date AS day, count(*) AS exchanges FROM exchanges "
+                "WHERE cancelled = FALSE AND exchange_time >= current_date - $1::integer "
+                "GROUP BY day ORDER BY day;",
+                days
+            )
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(err)
+        return -1
+    return [(row["day"], row["exchanges"]) for row in res]
+
+
+@timed_query
+async def get_last_exchange_id():
+    """
+    :return: l'ID dell'ultimo scambio registrato (0 se non ce ne sono), -1 in caso di errore
+    """
+    try:
+        async with acquire() as conn:
+            return await conn.fetchval("SELECT COALESCE(max(id), 0) FROM exchanges;")
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
         return -1
-    else:
-        return res
 
 
+@timed_query
 async def get_user_gifts(user: int | str, all_: bool = False):
-    conn = await connect_to_database()
-    gifts = {}
-    # richiesti
-    if isinstance(user, int) or user.isnumeric():
-        user = int(user)
-        query = ("SELECT * FROM gifts "
-                 "WHERE user_id = $1 "
-                 f"{'AND gifted_by_id IS NOT NULL ' if not all_ else ''} "
-                 f"{'AND cancelled = FALSE ' if not all_ else ''}"
-                 "ORDER BY gifted_at DESC")
-    else:
-        user = str(user)
-        query = (f"SELECT * FROM gifts "
-                 f"WHERE username = $1 "
-                 f"{'AND gifted_by_id IS NOT NULL ' if not all_ else ''} "
-                 "AND cancelled = FALSE ORDER BY gifted_at DESC")
+    """
+    Regali richiesti e donati da un utente, con una sola query.
+    :param user: ID o username dell'utente
+    :param all_: se True include anche i regali cancellati e le richieste non ancora accettate
+    :return: {"requested": [...], "given": [...]}, ordinati per gifted_at decrescente, oppure -1 in caso di errore
+    """
+    requester, user = _user_lookup(user, "user_id", "username")
+    giver, _ = _user_lookup(user, "gifted_by_id", "gifted_by_username")
+    requested_filter = "" if all_ else "AND gifted_by_id IS NOT NULL AND cancelled = FALSE "
+    query = (f"SELECT 'requested' AS role, * FROM gifts WHERE {requester} = $1 {requested_filter}"
+             f"UNION ALL "
+             f"SELECT 'given' AS role, * FROM gifts WHERE {giver} = $1 AND cancelled = FALSE "
+             f"ORDER BY gifted_at DESC")
     try:
-        gifts["requested"] = await conn.fetch(query, user)
+        async with acquire() as conn:
+            res = await conn.fetch(query, user)
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
         return -1
+    gifts = {"requested": [], "given": []}
+    for row in res:
+        gifts[row["role"]].append(row)
+    return gifts
 
-    # donati
-    if isinstance(user, int) or user.isnumeric():
-        user = int(user)
-        query = f"SELECT * FROM gifts WHERE gifted_by_id = $1 AND cancelled = FALSE ORDER BY gifted_at DESC"
-    else:
-        user = str(user)
-        query = f"SELECT * FROM gifts WHERE gifted_by_username = $1 AND cancelled = FALSE ORDER BY gifted_at DESC"
+
+@timed_query
+async def delete_unaccepted_gifts(user: int | str):
+    """
+    Cancella le richieste di regalo dell'utente che nessuno ha ancora accettato.
+    """
+    column, user = _user_lookup(user, "user_id", "username")
     try:
-        gifts["given"] = await conn.fetch(query, user)
+        async with acquire() as conn:
+            await conn.execute(f"DELETE FROM gifts WHERE gifted_by_id IS NULL AND {column} = $1;", user)
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(err)
+
+
+@timed_query
+async def can_request_gift(user_id: int):
+    """
+    Un utente non può chiedere regali se ne ha ricevuti almeno 2 dall'ultimo che ha donato.
+    Conta i regali direttamente nel database, senza trasferire righe.
+    :return: True o False, -1 in caso di errore
+    """
+    query = ("WITH last_given AS ("
+             "SELECT MAX(gifted_at) AS gifted_at FROM gifts WHERE gifted_by_id = $1 AND cancelled = FALSE"
+             ") "
+             "SELECT COUNT(*) < 2 FROM gifts, last_given "
+             "WHERE gifts.user_id = $1 AND gifts.gifted_by_id IS NOT NULL AND gifts.cancelled = FALSE "
+             "AND (last_given.gifted_at IS NULL OR gifts.gifted_at > last_given.gifted_at)")
+    try:
+        async with acquire() as conn:
+            return await conn.fetchval(query, user_id)
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
         return -1
-    else:
-        return gifts
-    finally:
-        await conn.close()
 
 
+@timed_query
 async def execute_query_for_value(query: str, for_value: bool):
-    conn = await connect_to_database()
     try:
-        if for_value:
-            res = await conn.fetchval(query)
-        else:
-            res = None
-            await conn.execute(query)
+        async with acquire() as conn:
+            if for_value:
+                res = await conn.fetchval(query)
+            else:
+                res = None
+                await conn.execute(query)
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
         return False
@@ -237,29 +570,29 @@ async def execute_query_for_value(query: str, for_value: bool):
         return True
 
 
+@timed_query
 async def set_as_cancelled(table: str, identifier: int | str):
     if table != "exchanges" and table != "gifts":
         raise Exception(f"Table {table} non valida. Deve essere 'exchanges' o 'gifts'.")
 
-    conn = await connect_to_database()
-    try:
-        query = f"UPDATE {table} SET cancelled = true WHERE id = $1"
-        await conn.execute(query, identifier)
-    except asyncpg.exceptions.PostgresError as err:
-        db_logger.error(err)
-        raise
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            query = f"UPDATE {table} SET cancelled = true WHERE id = $1"
+            await conn.execute(query, identifier)
+        except asyncpg.exceptions.PostgresError as err:
+            db_logger.error(err)
+            raise
 
 
+@timed_query
 async def get_item_infos(table: str, identifier: int | str):
     if table != "exchanges" and table != "gifts":
         raise Exception(f"Table {table} non valida. Deve essere 'exchanges' o 'gifts'.")
-    conn = await connect_to_database()
     try:
-        raw = await conn.fetchrow(
-            query=f"SELECT * FROM {table} WHERE id={str(identifier)};",
-        )
+        async with acquire() as conn:
+            raw = await conn.fetchrow(
+                query=f"SELECT * FROM {table} WHERE id={str(identifier)};",
+            )
     except asyncpg.exceptions.PostgresError as err:
         db_logger.error(err)
         return None
@@ -269,20 +602,123 @@ async def get_item_infos(table: str, identifier: int | str):
             return False
         else:
             return {key: raw[key] for key in dict(raw)}
-    finally:
-        await conn.close()
 
 
-async def connect_to_database():
+@timed_query
+async def get_confirmations():
+    try:
+        async with acquire() as conn:
+            return await conn.fetch("SELECT * FROM confirmations;")
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(err)
+        raise
+
+
+@timed_query
+async def save_confirmation(confirmation: dict):
+    """
+    Salva (o sostituisce) la richiesta di conferma in attesa per confirmation['target_username'].
+    :param confirmation: dizionario con le colonne della tabella 'confirmations'
+    """
+    try:
+        async with acquire() as conn:
+            await conn.execute(
+                "INSERT INTO confirmations (target_username, chat_id, message_id, sender_id, caption, created_at) "
+                "VALUES ($1, $2, $3, $4, $5, $6) "
+                "ON CONFLICT (target_username) DO UPDATE SET chat_id = EXCLUDED.chat_id, "
+                "message_id = EXCLUDED.message_id, sender_id = EXCLUDED.sender_id, caption = EXCLUDED.caption, "
+                "created_at = EXCLUDED.created_at;",
+                confirmation["target_username"], confirmation["chat_id"], confirmation["message_id"],
+                confirmation["sender_id"], confirmation["caption"], confirmation["created_at"]
+            )
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(err)
+        raise
+
+
+@timed_query
+async def delete_confirmations(target_usernames: list[str]):
+    try:
+        async with acquire() as conn:
+            await conn.execute("DELETE FROM confirmations WHERE target_username = ANY($1::text[]);", target_usernames)
+    except asyncpg.exceptions.PostgresError as err:
+        db_logger.error(err)
+
+
+async def init_pool():
+    """
+    Crea il pool di connessioni condiviso. Le dimensioni e i timeout sono configurabili con le variabili
+    d'ambiente DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_ACQUIRE_TIMEOUT e DB_POOL_LEAK_TIMEOUT (secondi).
+    """
+    global _pool, _pool_watchdog
+    if _pool is not None:
+        return _pool
     try:
-        conn = await asyncpg.connect(
+        _pool = await asyncpg.create_pool(
             host=os.getenv("DB_HOST"),
             user=os.getenv("DB_USER"),
             password=os.getenv("DB_PASS"),
-            database=os.getenv("DB_NAME")
+            database=os.getenv("DB_NAME"),
+            min_size=int(os.getenv("DB_POOL_MIN_SIZE", 2)),
+            max_size=int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+            max_inactive_connection_lifetime=300
         )
-    except asyncpg.exceptions.PostgresError as err:
+    except (asyncpg.exceptions.PostgresError, OSError) as err:
         db_logger.error(err)
         raise
-    else:
-        return conn
+    _pool_watchdog = asyncio.create_task(_watch_borrowed_connections())
+    db_logger.info(f"Pool creato (min {_pool.get_min_size()}, max {_pool.get_max_size()}).")
+    return _pool
+
+
+async def close_pool():
+    global _pool, _pool_watchdog
+    if _pool_watchdog is not None:
+        _pool_watchdog.cancel()
+        _pool_watchdog = None
+    if _pool is None:
+        return
+    if _borrowed:
+        db_logger.warning(f"Chiusura del pool con {len(_borrowed)} connessioni ancora in prestito.")
+    try:
+        await asyncio.wait_for(_pool.close(), timeout=float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 10)))
+    except asyncio.TimeoutError:
+        db_logger.error("Timeout durante la chiusura del pool, chiusura forzata.")
+        _pool.terminate()
+    _pool = None
+    db_logger.info("Pool chiuso.")
+
+
+@asynccontextmanager
+async def acquire():
+    """
+    Prende in prestito una connessione dal pool e la restituisce all'uscita dal blocco ``async with``.
+    Le connessioni trattenute oltre DB_POOL_LEAK_TIMEOUT vengono segnalate nei log.
+    """
+    if _pool is None:
+        raise asyncpg.exceptions.InterfaceError("Pool non inizializzato: chiamare init_pool() prima.")
+    try:
+        conn = await _pool.acquire(timeout=float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 10)))
+    except asyncio.TimeoutError:
+        db_logger.error(f"Timeout nell'acquisizione di una connessione ({len(_borrowed)} in prestito).")
+        raise PoolTimeoutError(f"nessuna connessione libera ({len(_borrowed)} in prestito)") from None
+    # chi ha aperto il blocco ``async with`` (sopra ci sono __aenter__ e questo generatore): il testo viene
+    # composto solo se la connessione viene segnalata
+    caller = sys._getframe(2)
+    _borrowed[id(conn)] = (time.monotonic(), caller.f_code, caller.f_lineno)
+    try:
+        yield conn
+    finally:
+        del _borrowed[id(conn)]
+        await _pool.release(conn)
+
+
+async def _watch_borrowed_connections():
+    leak_timeout = float(os.getenv("DB_POOL_LEAK_TIMEOUT", 30))
+    while True:
+        await asyncio.sleep(leak_timeout)
+        now = time.monotonic()
+        for since, code, lineno in list(_borrowed.values()):
+            if now - since > leak_timeout:
+                db_logger.warning(f"Possibile leak: connessione in prestito da {now - since:.0f}s a "
+                                  f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno}).")
@@ -0,0 +1,48 @@
+import io
+
+# eseguito nei processi di modules/charts.py: non importa nulla del bot, così chi lo carica non apre i file di log
+# e non avvia thread
+
+CHART_EXCHANGES = "scambi"
+CHART_POINTS = "punti"
+CHART_TOP = "top"
+CHART_KINDS = (CHART_EXCHANGES, CHART_POINTS, CHART_TOP)
+
+
+def draw(kind: str, data) -> bytes:
+    """
+    Disegna un grafico. Gira nei processi di modules/charts.py.
+    :param kind: CHART_EXCHANGES, CHART_POINTS o CHART_TOP
+    :param data: i dati del grafico (vedi core.chart)
+    :return: l'immagine PNG
+    """
+    # importati qui: servono solo nei processi che disegnano, non in quello del bot
+    import numpy as np
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 4.5), dpi=150, layout="constrained")
+    ax = fig.subplots()
+    if kind == CHART_EXCHANGES:
+        days = [day for day, _ in data]
+        ax.bar(days, [count for _, count in data], color="#3b82f6")
+        ax.set_title("Scambi al giorno")
+        ax.set_ylabel("Scambi")
+        fig.autofmt_xdate()
+    elif kind == CHART_POINTS:
+        positions = np.arange(len(data))
+        ax.bar(positions, data, color="#f59e0b")
+        ax.set_xticks(positions)
+        ax.set_title("Distribuzione dei punti")
+        ax.set_xlabel("Punti attuali")
+        ax.set_ylabel("Utenti")
+    elif kind == CHART_TOP:
+        names = [name for name, _ in data][::-1]
+        ax.barh(np.arange(len(names)), [total for _, total in data][::-1], color="#10b981", tick_label=names)
+        ax.set_title("Utenti con più scambi")
+        ax.set_xlabel("Scambi totali")
+    else:
+        raise ValueError(f"Grafico {kind} non valido")
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
@@ -0,0 +1,67 @@
+import asyncio
+import heapq
+import time
+from typing import Callable
+
+from pyrogram import Client
+from pyrogram.types import Message
+
+from globals import EPHEMERAL_SWEEP_INTERVAL
+from modules.loggers import bot_logger
+from modules.outbox import enqueue, PRIORITY_NOTIFICATION
+
+# Telegram accetta al massimo 100 messaggi per chiamata a delete_messages
+DELETE_BATCH_SIZE = 100
+
+# messaggi da cancellare, come (scadenza, chat_id, message_id), ordinati per scadenza
+_expiring: list[tuple[float, int, int]] = []
+
+
+def expire_message(message: Message, ttl: float):
+    """
+    Programma la cancellazione di un messaggio fra ttl secondi.
+    """
+    heapq.heappush(_expiring, (time.monotonic() + ttl, message.chat.id, message.id))
+
+
+async def send_expiring(call: Callable, *args, ttl: float, **kwargs):
+    """
+    Manda un messaggio con call (es. client.send_message) e ne programma la cancellazione.
+    Pensata per essere messa in coda con outbox.enqueue, così chi manda non deve aspettare l'ID del messaggio.
+    """
+    message = await call(*args, **kwargs)
+    expire_message(message, ttl)
+    return message
+
+
+def pop_expired(now: float | None = None) -> dict[int, list[int]]:
+    """
+    Toglie dalla coda i messaggi scaduti.
+    :return: {chat_id: [message_id, ...]}
+    """
+    now = time.monotonic() if now is None else now
+    expired = {}
+    while _expiring and _expiring[0][0] <= now:
+        _, chat_id, message_id = heapq.heappop(_expiring)
+        expired.setdefault(chat_id, []).append(message_id)
+    return expired
+
+
+async def delete_expired(client: Client):
+    for chat_id, message_ids in pop_expired().items():
+        for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+            await enqueue(
+                client.delete_messages,
+                chat_id=chat_id,
+                message_ids=message_ids[start:start + DELETE_BATCH_SIZE],
+                priority=PRIORITY_NOTIFICATION
+            )
+
+
+async def ephemeral_sweeper(client: Client, interval: float = EPHEMERAL_SWEEP_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await delete_expired(client)
+        except Exception as e:
+            bot_logger.error(f"error deleting expired messages: {e}")
@@ -3,4 +3,56 @@ SOGLIA = 15
 THREAD_ID = 480884
 THREAD_LINK = "https://t.me/c/2063162360/480884"
 GROUP_LINK = "https://t.me/+6C-G0sLnCYZjYzE0"
-MANUTENZIONE = False
\ No newline at end of file
+MANUTENZIONE = False
+
+# cache dei membri del gruppo (get_chat_member)
+MEMBER_CACHE_TTL = 300
+MEMBER_CACHE_SIZE = 2048
+# richieste get_chat_member contemporanee durante /scambi e /regali
+MEMBER_RESOLVE_CONCURRENCY = 8
+
+# secondi tra due scritture degli utenti visti nel gruppo
+USER_OBSERVATION_INTERVAL = 30
+
+# secondi entro cui le modifiche a bot_data vengono raccolte in un'unica scrittura
+PERSISTENCE_DEBOUNCE = 2
+
+# secondi dopo cui una richiesta di conferma di uno scambio scade
+CONFIRMATION_TIMEOUT = 24 * 60 * 60
+
+# scambi mostrati al massimo in una pagina di /scambi
+EXCHANGES_PAGE_SIZE = 10
+
+# coda dei messaggi in uscita: limiti di Telegram (messaggi al secondo) globali e per singola chat
+OUTBOX_GLOBAL_RATE = 25
+OUTBOX_GLOBAL_BURST = 30
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 5
+OUTBOX_WORKERS = 4
+# tentativi dopo un FloodWait prima di rinunciare a una chiamata
+OUTBOX_MAX_RETRIES = 3
+
+# secondi dopo cui i messaggi temporanei del bot (avvisi, risposte a /punti) vengono cancellati
+EPHEMERAL_TTL = 60
+# secondi tra due passate di cancellazione dei messaggi temporanei scaduti
+EPHEMERAL_SWEEP_INTERVAL = 5
+
+# utenti mostrati in ciascuna classifica di /classifica
+LEADERBOARD_SIZE = 10
+
+# /grafico: giorni mostrati nel grafico degli scambi, utenti nel grafico dei migliori, processi che disegnano
+CHART_DAYS = 30
+CHART_TOP_SIZE = 15
+CHART_WORKERS = 1
+
+# metriche: file in formato Prometheus (text exposition) riscritto ogni METRICS_INTERVAL secondi
+METRICS_FILE = "logs/metrics.prom"
+METRICS_INTERVAL = 60
+
+# secondi tra due ricaricamenti degli amministratori del gruppo (in mezzo bastano gli aggiornamenti ChatMemberUpdated)
+ADMIN_REFRESH_INTERVAL = 600
+
+# registrazione degli aggiornamenti (variabile d'ambiente RECORD_UPDATES): righe scritte prima di svuotare il buffer
+# e righe in attesa del thread che scrive, oltre le quali gli aggiornamenti non vengono registrati
+RECORDER_FLUSH_EVERY = 100
+RECORDER_QUEUE_SIZE = 10000
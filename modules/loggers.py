@@ -1,16 +1,84 @@
+import atexit
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# record in attesa di essere scritti su file: oltre questo limite vengono scartati
+LOG_QUEUE_SIZE = 10000
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler che non blocca mai il chiamante: se la coda è piena il record viene scartato e contato.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(QueueListener):
+    """
+    QueueListener che allo stop aspetta un posto libero per il segnale di fine invece di fallire con queue.Full
+    quando la coda è piena: il thread del listener continua a svuotarla.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(log_queue)
+
+# i file vengono scritti (e ruotati) dal thread del listener, mai dall'event loop
+db_file_handler = RotatingFileHandler(os.path.join("logs", "database.log"), maxBytes=10000000, backupCount=0)
+db_file_handler.setFormatter(formatter)
+db_file_handler.addFilter(logging.Filter("dblogger"))
+
+bot_file_handler = RotatingFileHandler(os.path.join("logs", "bot.log"), maxBytes=10000000, backupCount=0)
+bot_file_handler.setFormatter(formatter)
+bot_file_handler.addFilter(logging.Filter("bot_logger"))
+
+# anche la console è scritta dal listener: i due logger non propagano al root (vedi sotto)
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+
+listener = DrainingQueueListener(log_queue, db_file_handler, bot_file_handler, console_handler,
+                                 respect_handler_level=True)
+listener.start()
+_listener_running = True
 
 db_logger = logging.getLogger("dblogger")
 db_logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler = RotatingFileHandler(os.path.join("logs", "database.log"), maxBytes=10000000, backupCount=0)
-file_handler.setFormatter(formatter)
-db_logger.addHandler(file_handler)
+db_logger.addHandler(queue_handler)
+db_logger.propagate = False
 
 bot_logger = logging.getLogger("bot_logger")
 bot_logger.setLevel(logging.INFO)
-file_handler = RotatingFileHandler(os.path.join("logs", "bot.log"), maxBytes=10000000, backupCount=0)
-file_handler.setFormatter(formatter)
-bot_logger.addHandler(file_handler)
+bot_logger.addHandler(queue_handler)
+bot_logger.propagate = False
+
+
+def log_queue_stats() -> dict:
+    return {"queued": log_queue.qsize(), "dropped": queue_handler.dropped}
+
+
+def stop_logging():
+    """
+    Svuota la coda e ferma il thread del listener. Chiamata allo spegnimento (più chiamate non hanno effetto).
+    """
+    global _listener_running
+    if _listener_running:
+        _listener_running = False
+        listener.stop()
+
+
+atexit.register(stop_logging)
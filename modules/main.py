@@ -1,18 +1,25 @@
 import os
 import logging
 import json
-from utils import save_persistence
-from modules.database import connect_to_database
+from modules.utils import save_persistence, flush_persistence, observed_users_flusher, flush_observed_users, \
+    load_admins, admins_refresher
+from modules.database import acquire, init_pool, close_pool, is_table_empty, run_migrations, load_table_columns, \
+    load_points_cache
 import core
-from loggers import db_logger, bot_logger
-from database import is_table_empty
+from modules.charts import shutdown_charts
+from modules.confirmations import load_confirmations, confirmations_sweeper
+from modules.ephemeral import ephemeral_sweeper
+from modules.metrics import InstrumentedClient, instrument_handler, metrics_exporter
+from modules.outbox import start_outbox, drain_outbox
+from modules.recorder import start_recording, record_update, stop_recording
+from modules.router import CallbackRouter
+from modules.loggers import db_logger, bot_logger, stop_logging
 
 from pyrogram import Client, filters
 from pyrogram.handlers import MessageHandler, CallbackQueryHandler, ChatMemberUpdatedHandler
 import asyncio
 
 import pyrogram.errors
-from dotenv import load_dotenv
 # noinspection PyUnusedImports
 from globals import bot_data
 
@@ -24,11 +31,20 @@ logging.basicConfig(
 httpx_logger = logging.getLogger('httpx')
 httpx_logger.setLevel(logging.WARNING)
 
+# task di background avviati in post_init e fermati allo spegnimento
+background_tasks: list[asyncio.Task] = []
+
 
 async def add_handlers(app: Client):
+    if os.getenv("RECORD_UPDATES"):
+        # prima di tutti gli altri gruppi: registra l'aggiornamento e lascia proseguire la propagazione
+        app.add_handler(MessageHandler(callback=record_update), group=-2)
+        app.add_handler(CallbackQueryHandler(callback=record_update), group=-2)
+        app.add_handler(ChatMemberUpdatedHandler(callback=record_update), group=-2)
+
     app.add_handler(
         MessageHandler(
-            callback=core.start,
+            callback=instrument_handler(core.start),
             filters=filters.command(
                 commands="start",
                 prefixes=list(".!/")
@@ -38,7 +54,7 @@ async def add_handlers(app: Client):
 
     app.add_handler(
         MessageHandler(
-            callback=core.exchange,
+            callback=instrument_handler(core.exchange),
             filters=filters.command(
                 commands="feedback",
                 prefixes=list(".!/")
@@ -47,62 +63,60 @@ async def add_handlers(app: Client):
     )
 
     app.add_handler(
-        CallbackQueryHandler(
-            callback=core.accept_gift,
-            filters=filters.regex(r"^accept_gift_for.*")
-        )
-    )
-
-    app.add_handler(
-        CallbackQueryHandler(
-            callback=core.accept_gift,
-            filters=filters.regex(r"^accepting_.*")
-        )
-    )
-
-    app.add_handler(
-        CallbackQueryHandler(
-            callback=core.accept_gift,
-            filters=filters.regex(r"^abort_.*")
+        MessageHandler(
+            callback=instrument_handler(core.request_gift),
+            filters=filters.command(
+                commands="request",
+                prefixes=list(".!/")
+            )
         )
     )
 
     app.add_handler(
         MessageHandler(
-            callback=core.request_gift,
+            callback=instrument_handler(core.user_exchanges),
             filters=filters.command(
-                commands="request",
+                commands="scambi",
                 prefixes=list(".!/")
             )
         )
     )
 
     app.add_handler(
-        CallbackQueryHandler(
-            callback=core.close_message,
-            filters=filters.regex(r"^close.*")
+        MessageHandler(
+            callback=instrument_handler(core.user_points),
+            filters=filters.command(
+                commands="punti",
+                prefixes=list(".!/")
+            )
         )
     )
 
     app.add_handler(
-        CallbackQueryHandler(
-            callback=core.cancel_exchange,
-            filters=filters.regex(r"^cancel_exchange.*")
+        MessageHandler(
+            callback=instrument_handler(core.user_gifts),
+            filters=filters.command(
+                commands="regali",
+                prefixes=list(".!/")
+            )
         )
     )
 
     app.add_handler(
-        CallbackQueryHandler(
-            callback=core.cancel_gift,
-            filters=filters.regex(r"^cancel_gift.*")
+        MessageHandler(
+            callback=instrument_handler(core.leaderboard),
+            filters=filters.command(
+                commands="classifica",
+                prefixes=list(".!/")
+            )
         )
     )
 
     app.add_handler(
         MessageHandler(
-            callback=core.user_exchanges,
+            callback=instrument_handler(core.chart),
             filters=filters.command(
-                commands="scambi",
+                commands="grafico",
                 prefixes=list(".!/")
             )
         )
@@ -110,9 +124,9 @@ async def add_handlers(app: Client):
 
     app.add_handler(
         MessageHandler(
-            callback=core.user_points,
+            callback=instrument_handler(core.stats),
             filters=filters.command(
-                commands="punti",
+                commands="stats",
                 prefixes=list(".!/")
             )
         )
@@ -120,9 +134,9 @@ async def add_handlers(app: Client):
 
     app.add_handler(
         MessageHandler(
-            callback=core.user_gifts,
+            callback=instrument_handler(core.refresh_schema),
             filters=filters.command(
-                commands="regali",
+                commands="schema",
                 prefixes=list(".!/")
             )
         )
@@ -130,48 +144,52 @@ async def add_handlers(app: Client):
 
     app.add_handler(
         ChatMemberUpdatedHandler(
-            callback=core.intercept_user_join,
-            filters=filters.chat(os.getenv("GROUP_ID"))
+            callback=instrument_handler(core.intercept_user_join),
+            filters=filters.chat(int(os.getenv("GROUP_ID")))
         ),
         group=-1
     )
 
     app.add_handler(
         MessageHandler(
-            callback=core.user_points,
-            filters=filters.chat(os.getenv("GROUP_ID"))
+            callback=instrument_handler(core.intercept_user_message),
+            filters=filters.chat(int(os.getenv("GROUP_ID")))
         ),
         group=-1
     )
 
-    app.add_handler(
-        CallbackQueryHandler(
-            callback=core.close_message,
-            filters=filters.regex(r"^cancel_admin.*")
-        ),
-    )
+    # un solo handler per tutti i pulsanti: l'azione viene scelta dal prefisso del callback_data
+    router = CallbackRouter()
+    router.add("accept_gift_for", instrument_handler(core.accept_gift))
+    router.add("accepting", instrument_handler(core.accept_gift))
+    router.add("abort", instrument_handler(core.accept_gift))
+    router.add("cancel_exchange", instrument_handler(core.cancel_exchange))
+    router.add("cancel_gift", instrument_handler(core.cancel_gift))
+    router.add("exchanges_page", instrument_handler(core.browse_exchanges), maxsplit=2)
+    router.add("confirm_exchange", instrument_handler(core.confirm_exchange), maxsplit=1)
+    router.add("close", instrument_handler(core.close_message))
+    router.add("close_admin", instrument_handler(core.close_message), maxsplit=0)
+    router.add("close_admin_gift", instrument_handler(core.close_message), maxsplit=0)
+    router.add("cancel_admin", instrument_handler(core.close_message))
+    router.add("confirm_and_close", instrument_handler(core.close_message))
 
     app.add_handler(
         CallbackQueryHandler(
-            callback=core.confirm_exchange,
-            filters=filters.regex(r"^confirm_exchange.*")
-        ),
-    )
-
-    app.add_handler(
-        CallbackQueryHandler(
-            callback=core.close_message,
-            filters=filters.regex(r"^confirm_and_close.*")
+            callback=router.dispatch
         )
     )
 
 
 async def post_init(app: Client):
     global bot_data
-    conn = await connect_to_database()
+    await init_pool()
+    await run_migrations()
+    await load_table_columns()
+    await load_points_cache()
 
     if await is_table_empty():
-        await conn.execute("INSERT INTO persistence (data) VALUES (DEFAULT);")
+        async with acquire() as conn:
+            await conn.execute("INSERT INTO persistence (data) VALUES (DEFAULT);")
         db_logger.warning("Persistence table was empty. Trying env Group ID.")
         bot_data["group_id"] = os.getenv("GROUP_ID")
         try:
@@ -187,28 +205,55 @@ async def post_init(app: Client):
 
             await save_persistence(bot_data)
     else:
-        res = await conn.fetch("SELECT data FROM persistence;")
+        async with acquire() as conn:
+            res = await conn.fetch("SELECT data FROM persistence;")
         data = json.loads(next(res[0].values()))["jsondata"]
+        # le chiavi numeriche sono gli ID degli scambi (vedi core.exchange)
+        bot_data.update({int(key) if key.isnumeric() else key: value for key, value in data.items()})
         for el in ["group_id", "owner_id", "admin_id"]:
             bot_data[el] = int(data[el]) if el in data else int(os.getenv(el.upper()))
-            await save_persistence(bot_data)
+        await save_persistence(bot_data, "group_id", "owner_id", "admin_id")
+
+    await load_confirmations()
+    await load_admins(app)
+
+    background_tasks.append(asyncio.create_task(observed_users_flusher()))
+    background_tasks.append(asyncio.create_task(admins_refresher(app)))
+    background_tasks.append(asyncio.create_task(confirmations_sweeper()))
+    background_tasks.extend(start_outbox())
+    background_tasks.append(asyncio.create_task(ephemeral_sweeper(app)))
+    background_tasks.append(asyncio.create_task(metrics_exporter(core.collect_metrics)))
 
     await add_handlers(app)
 
 
 async def main():
-    app = Client(
+    app = InstrumentedClient(
         "scambi_bot",
         api_id=os.getenv("API_ID"),
         api_hash=os.getenv("API_HASH"),
         bot_token=os.getenv("BOT_TOKEN")
     )
 
+    if record_path := os.getenv("RECORD_UPDATES"):
+        start_recording(record_path, group_id=int(os.getenv("GROUP_ID")))
+
     async with app:
-        await post_init(app)
-        await asyncio.Event().wait()
+        try:
+            await post_init(app)
+            await asyncio.Event().wait()
+        finally:
+            await drain_outbox()
+            for task in background_tasks:
+                task.cancel()
+            await flush_observed_users()
+            await flush_persistence()
+            shutdown_charts()
+            stop_recording()
+            await close_pool()
+            stop_logging()
 
 
 if __name__ == "__main__":
-    load_dotenv(".env")
-    asyncio.run(main())
+    # i processi dei grafici reimporterebbero questo file, con i suoi import e il thread dei log (vedi bot.py)
+    raise SystemExit("Avvia il bot con python bot.py")
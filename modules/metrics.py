@@ -0,0 +1,176 @@
+import asyncio
+import functools
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable
+
+from pyrogram import Client, StopPropagation, ContinuePropagation
+
+from globals import METRICS_FILE, METRICS_INTERVAL
+from modules.loggers import bot_logger
+
+# limiti superiori (in secondi) dei bucket degli istogrammi
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """
+    Istogramma a bucket fissi, come quelli di Prometheus: tiene solo i conteggi, non i singoli valori.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # l'ultimo contatore è il bucket +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Stima del quantile ``q``: il limite superiore del bucket che lo contiene (per +Inf, l'ultimo limite).
+        """
+        if self.count == 0:
+            return 0.0
+        target, seen = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+
+handler_latency: dict[str, Histogram] = defaultdict(Histogram)
+handler_errors: dict[str, int] = defaultdict(int)
+query_latency: dict[str, Histogram] = defaultdict(Histogram)
+query_errors: dict[str, int] = defaultdict(int)
+rpc_calls: dict[str, int] = defaultdict(int)
+
+
+def instrument_handler(callback: Callable, name: str | None = None) -> Callable:
+    """
+    Avvolge un handler di Pyrogram misurandone la durata e contando le eccezioni.
+    StopPropagation e ContinuePropagation non sono errori: servono a Pyrogram per gestire i gruppi di handler.
+    """
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except (StopPropagation, ContinuePropagation):
+            raise
+        except Exception:
+            handler_errors[name] += 1
+            raise
+        finally:
+            handler_latency[name].observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def timed_query(func: Callable) -> Callable:
+    """
+    Decoratore per le funzioni di database.py: misura la durata e conta gli errori, cioè le eccezioni
+    e i -1 con cui il modulo segnala che il database non ha risposto.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            query_errors[name] += 1
+            raise
+        finally:
+            query_latency[name].observe(time.perf_counter() - start)
+        if isinstance(result, int) and not isinstance(result, bool) and result == -1:
+            query_errors[name] += 1
+        return result
+
+    return wrapper
+
+
+class InstrumentedClient(Client):
+    """
+    Client che conta le chiamate all'API di Telegram per metodo (SendMessage, GetChatMember, ...).
+    """
+
+    async def invoke(self, query, *args, **kwargs):
+        rpc_calls[type(query).__name__] += 1
+        return await super().invoke(query, *args, **kwargs)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _histogram_lines(metric: str, label: str, histograms: dict[str, Histogram]) -> list[str]:
+    lines = [f"# TYPE {metric} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        labels = f"{label}=\"{_escape(key)}\""
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{metric}_bucket{{{labels},le=\"{le}\"}} {cumulative}")
+        lines.append(f"{metric}_sum{{{labels}}} {histogram.sum}")
+        lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def _counter_lines(metric: str, label: str, counters: dict[str, int], kind: str = "counter") -> list[str]:
+    lines = [f"# TYPE {metric} {kind}"]
+    for key, value in sorted(counters.items()):
+        lines.append(f"{metric}{{{label}=\"{_escape(key)}\"}} {value}")
+    return lines
+
+
+def render_prometheus(extra_gauges: dict[str, tuple[str, dict]] | None = None,
+                      extra_counters: dict[str, tuple[str, dict]] | None = None) -> str:
+    """
+    Tutte le metriche in formato Prometheus (text exposition).
+    :param extra_gauges: altri valori da esporre, come {nome metrica: (etichetta, {valore etichetta: valore})}
+    :param extra_counters: come extra_gauges, per valori che crescono soltanto (nome con il suffisso _total)
+    """
+    lines = []
+    lines += _histogram_lines("scambi_handler_latency_seconds", "handler", handler_latency)
+    lines += _counter_lines("scambi_handler_errors_total", "handler", handler_errors)
+    lines += _histogram_lines("scambi_db_query_latency_seconds", "query", query_latency)
+    lines += _counter_lines("scambi_db_query_errors_total", "query", query_errors)
+    lines += _counter_lines("scambi_telegram_rpc_total", "method", rpc_calls)
+    for metric, (label, values) in (extra_gauges or {}).items():
+        lines += _counter_lines(metric, label, values, kind="gauge")
+    for metric, (label, values) in (extra_counters or {}).items():
+        lines += _counter_lines(metric, label, values)
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(text: str, path: str = METRICS_FILE):
+    # scrivo su un file temporaneo e lo rinomino, così chi legge non vede mai un file a metà
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+async def metrics_exporter(collect: Callable[[], str], interval: float = METRICS_INTERVAL, path: str = METRICS_FILE):
+    """
+    Riscrive periodicamente il file delle metriche.
+    :param collect: funzione che restituisce il testo da scrivere (vedi render_prometheus)
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            write_prometheus(collect(), path)
+        except Exception as e:
+            bot_logger.error(f"error writing metrics to {path}: {e}")
@@ -0,0 +1,51 @@
+-- Tabelle del bot. IF NOT EXISTS perché i database già in uso le hanno create a mano prima delle migrazioni.
+
+CREATE TABLE IF NOT EXISTS main_table (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    points INTEGER NOT NULL DEFAULT 1,
+    total INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS exchanges (
+    id SERIAL PRIMARY KEY,
+    member_1 BIGINT NOT NULL,
+    username_1 TEXT,
+    member_2 BIGINT NOT NULL,
+    username_2 TEXT,
+    feedback TEXT,
+    screenshot TEXT,
+    exchange_time TIMESTAMP,
+    cancelled BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS gifts (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    username TEXT,
+    gifted_by_id BIGINT,
+    gifted_by_username TEXT,
+    gifted_at TIMESTAMP,
+    request_link TEXT,
+    cancelled BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT
+);
+
+CREATE TABLE IF NOT EXISTS persistence (
+    data JSONB NOT NULL DEFAULT '{"jsondata": {}}'
+);
+
+CREATE TABLE IF NOT EXISTS confirmations (
+    target_username TEXT PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    sender_id BIGINT NOT NULL,
+    caption TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS confirmations_sender_id_idx ON confirmations (sender_id);
@@ -0,0 +1,14 @@
+-- Indici per le ricerche dei comandi: /scambi pagina per id, /regali e i controlli sulle richieste ordinano
+-- per gifted_at. Gli indici sugli username (/punti, retrieve_user, ...) sono in 0003, sulla forma normalizzata.
+
+CREATE INDEX IF NOT EXISTS exchanges_member_1_id_idx ON exchanges (member_1, id DESC);
+CREATE INDEX IF NOT EXISTS exchanges_member_2_id_idx ON exchanges (member_2, id DESC);
+
+-- richiesti: /regali li vuole tutti, anche cancellati o non accettati
+CREATE INDEX IF NOT EXISTS gifts_user_id_gifted_at_idx ON gifts (user_id, gifted_at DESC);
+-- ricevuti davvero: il conteggio di can_request_gift legge solo questi
+CREATE INDEX IF NOT EXISTS gifts_received_idx ON gifts (user_id, gifted_at)
+    WHERE gifted_by_id IS NOT NULL AND cancelled = FALSE;
+-- donati: mai cancellati
+CREATE INDEX IF NOT EXISTS gifts_gifted_by_id_gifted_at_idx ON gifts (gifted_by_id, gifted_at DESC)
+    WHERE cancelled = FALSE;
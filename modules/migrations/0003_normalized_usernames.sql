@@ -0,0 +1,16 @@
+-- Gli username di Telegram non distinguono maiuscole e minuscole e nel codice arrivano con o senza '@':
+-- le ricerche confrontano normalize_username(colonna) con il valore già normalizzato (parser.normalize_username).
+
+-- come str.removeprefix("@") in Python: toglie al più una '@' iniziale
+CREATE OR REPLACE FUNCTION normalize_username(username TEXT) RETURNS TEXT
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT lower(CASE WHEN left(username, 1) = '@' THEN substr(username, 2) ELSE username END) $$;
+
+CREATE INDEX IF NOT EXISTS exchanges_username_1_id_idx ON exchanges (normalize_username(username_1), id DESC);
+CREATE INDEX IF NOT EXISTS exchanges_username_2_id_idx ON exchanges (normalize_username(username_2), id DESC);
+CREATE INDEX IF NOT EXISTS gifts_username_gifted_at_idx ON gifts (normalize_username(username), gifted_at DESC);
+CREATE INDEX IF NOT EXISTS gifts_gifted_by_username_gifted_at_idx
+    ON gifts (normalize_username(gifted_by_username), gifted_at DESC)
+    WHERE cancelled = FALSE;
+CREATE INDEX IF NOT EXISTS main_table_username_idx ON main_table (normalize_username(username));
+CREATE INDEX IF NOT EXISTS users_username_idx ON users (normalize_username(username));
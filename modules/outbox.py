@@ -0,0 +1,301 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Callable, Hashable, NamedTuple
+
+from pyrogram.errors import FloodWait
+
+from globals import OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_WORKERS, \
+    OUTBOX_MAX_RETRIES
+from modules.loggers import bot_logger
+
+# priorità: numeri più bassi escono prima
+PRIORITY_CONFIRMATION = 0
+PRIORITY_REPLY = 1
+PRIORITY_NOTIFICATION = 2
+PRIORITY_NAMES = {PRIORITY_CONFIRMATION: "confirmation", PRIORITY_REPLY: "reply", PRIORITY_NOTIFICATION: "notification"}
+
+
+class TokenBucket:
+    """
+    Token bucket che prenota i gettoni: take() ne consuma uno subito e restituisce quanto aspettare prima di usarlo,
+    così chi arriva dopo si mette in fila dietro senza bisogno di lock.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self) -> float:
+        """
+        :return: quanto manca al prossimo gettone libero, senza consumarlo
+        """
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float):
+        """
+        Svuota il bucket per ``seconds`` secondi: il primo gettone libero arriva dopo la pausa.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class _Job(NamedTuple):
+    call: Callable
+    args: tuple
+    kwargs: dict
+    chat_id: int | str | None
+    priority: int
+    future: asyncio.Future | None
+    attempts: int = 0
+
+
+_sequence = itertools.count()
+_workers: list[asyncio.Task] = []
+_global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST)
+# una coda (heap per priorità e ordine di arrivo) e un bucket per chat. Le chat in cui scrive il bot sono poche
+# (gruppo, chat di deposito e di notifica, privati delle admin), quindi i bucket non vengono mai rimossi
+_chat_queues: dict[Hashable, list[tuple[int, int, _Job]]] = {}
+_chat_buckets: dict[int | str, TokenBucket] = {}
+# chat pronte per un worker, come (priorità della prima chiamata, ordine di arrivo, generazione, chat). Una chat è
+# pronta, in mano a un worker o in pausa (bucket vuoto, FloodWait) al massimo una volta: così le chiamate verso la
+# stessa chat restano in ordine e una chat lenta non occupa un worker mentre aspetta.
+# Se in una chat pronta arriva una chiamata più urgente della prima, la chat rientra in _ready con la nuova
+# priorità: _waiting tiene la generazione valida di ogni chat pronta e i worker scartano le voci superate
+_ready: asyncio.PriorityQueue | None = None
+_scheduled: set = set()
+_waiting: dict[Hashable, tuple[int, int]] = {}
+_generations = itertools.count()
+_unfinished = 0
+_idle: asyncio.Event | None = None
+
+outbox_stats = {"sent": 0, "failed": 0, "flood_waits": 0, "retries": 0}
+_depth = {priority: 0 for priority in PRIORITY_NAMES}
+
+
+def _normalize_chat(chat_id):
+    # lo stesso gruppo può arrivare come -100... o come "-100...": deve finire nello stesso bucket
+    if isinstance(chat_id, str) and chat_id.removeprefix("-").isdigit():
+        return int(chat_id)
+    return chat_id
+
+
+def _chat_of(call: Callable, args: tuple, kwargs: dict) -> int | str | None:
+    if "chat_id" in kwargs:
+        return _normalize_chat(kwargs["chat_id"])
+    # metodi legati a un messaggio, come message.reply_text: il primo argomento è il testo, non la chat
+    chat = getattr(getattr(call, "__self__", None), "chat", None)
+    if args and (isinstance(args[0], int) or chat is None and isinstance(args[0], str)):
+        return _normalize_chat(args[0])
+    return chat.id if chat is not None else None
+
+
+def _bucket_of(chat_id) -> TokenBucket:
+    return _chat_buckets.setdefault(chat_id, TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST))
+
+
+def _finish(job: _Job, result: Any = None, error: Exception | None = None):
+    if error is not None:
+        outbox_stats["failed"] += 1
+        if job.future is not None and not job.future.done():
+            job.future.set_exception(error)
+        else:
+            bot_logger.error(f"outbox: {getattr(job.call, '__name__', job.call)} verso {job.chat_id} fallita: {error}")
+    else:
+        outbox_stats["sent"] += 1
+        if job.future is not None and not job.future.done():
+            job.future.set_result(result)
+
+
+async def _run_inline(job: _Job):
+    """
+    Esegue subito una chiamata, aspettando i bucket e i FloodWait: usata quando la coda non è avviata.
+    """
+    try:
+        for attempt in range(OUTBOX_MAX_RETRIES + 1):
+            if job.chat_id is not None:
+                await asyncio.sleep(_bucket_of(job.chat_id).take())
+            await asyncio.sleep(_global_bucket.take())
+            try:
+                result = await job.call(*job.args, **job.kwargs)
+                break
+            except FloodWait as e:
+                outbox_stats["flood_waits"] += 1
+                if attempt == OUTBOX_MAX_RETRIES:
+                    raise
+                outbox_stats["retries"] += 1
+                bot_logger.warning(f"FloodWait di {e.value}s su {getattr(job.call, '__name__', job.call)} "
+                                   f"(chat {job.chat_id}), riprovo")
+                _global_bucket.pause(e.value)
+    except asyncio.CancelledError:
+        if job.future is not None:
+            job.future.cancel()
+        raise
+    except Exception as e:
+        _finish(job, error=e)
+    else:
+        _finish(job, result)
+
+
+def _make_ready(key: Hashable):
+    priority, sequence, _ = _chat_queues[key][0]
+    generation = next(_generations)
+    _waiting[key] = (priority, generation)
+    _ready.put_nowait((priority, sequence, generation, key))
+
+
+def _push(key: Hashable, entry: tuple[int, int, _Job]):
+    heapq.heappush(_chat_queues.setdefault(key, []), entry)
+    _depth[entry[0]] += 1
+    if key not in _scheduled:
+        _scheduled.add(key)
+        _make_ready(key)
+    elif key in _waiting and entry[0] < _waiting[key][0]:
+        # la chat aspetta un worker con la priorità di una chiamata meno urgente
+        _make_ready(key)
+
+
+def _reschedule(key: Hashable):
+    """
+    La chat ha finito una chiamata (o una pausa): torna tra le pronte se ha altre chiamate in coda.
+    """
+    if _chat_queues.get(key):
+        _make_ready(key)
+    else:
+        _chat_queues.pop(key, None)
+        _scheduled.discard(key)
+
+
+def _pause(key: Hashable, delay: float):
+    asyncio.get_running_loop().call_later(delay, _reschedule, key)
+
+
+def _done():
+    global _unfinished
+    _unfinished -= 1
+    if _unfinished == 0:
+        _idle.set()
+
+
+async def _worker():
+    while True:
+        _, _, generation, key = await _ready.get()
+        if _waiting.get(key, (None, None))[1] != generation:
+            # voce superata da una con priorità più alta
+            continue
+        del _waiting[key]
+        entry = heapq.heappop(_chat_queues[key])
+        job = entry[2]
+        if job.chat_id is not None and (delay := _bucket_of(job.chat_id).delay()) > 0:
+            # la chat ha esaurito i suoi messaggi: la chiamata resta in testa e il worker passa ad altro
+            heapq.heappush(_chat_queues[key], entry)
+            _pause(key, delay)
+            continue
+        _depth[job.priority] -= 1
+        if job.chat_id is not None:
+            _bucket_of(job.chat_id).take()
+        try:
+            await asyncio.sleep(_global_bucket.take())
+            result = await job.call(*job.args, **job.kwargs)
+        except FloodWait as e:
+            outbox_stats["flood_waits"] += 1
+            if job.attempts < OUTBOX_MAX_RETRIES:
+                outbox_stats["retries"] += 1
+                bot_logger.warning(f"FloodWait di {e.value}s su {getattr(job.call, '__name__', job.call)} "
+                                   f"(chat {job.chat_id}), riprovo")
+                # di nuovo in testa alla sua chat, che resta ferma per la durata del FloodWait. Spesso il FloodWait
+                # vale per tutto il bot e non solo per la chat: si ferma anche il bucket globale, altrimenti le
+                # altre chat continuerebbero a chiamare e a prolungarlo
+                heapq.heappush(_chat_queues[key], (entry[0], entry[1], job._replace(attempts=job.attempts + 1)))
+                _depth[job.priority] += 1
+                _global_bucket.pause(e.value)
+                _pause(key, e.value)
+                continue
+            _finish(job, error=e)
+        except asyncio.CancelledError:
+            if job.future is not None:
+                job.future.cancel()
+            raise
+        except Exception as e:
+            _finish(job, error=e)
+        else:
+            _finish(job, result)
+        _done()
+        _reschedule(key)
+
+
+async def enqueue(call: Callable, *args, priority: int = PRIORITY_REPLY, wait: bool = False, **kwargs) -> Any:
+    """
+    Mette in coda una chiamata all'API di Telegram, es. ``enqueue(client.send_message, chat_id=..., text=...)``.
+    Le chiamate rispettano i limiti globali e per chat e vengono ripetute dopo un FloodWait.
+    :param call: metodo da chiamare (client.send_message, message.forward, ...)
+    :param priority: PRIORITY_CONFIRMATION, PRIORITY_REPLY o PRIORITY_NOTIFICATION
+    :param wait: se True aspetta la chiamata e ne restituisce il risultato (o solleva il suo errore),
+        altrimenti ritorna subito e gli errori finiscono nel log
+    :return: il risultato della chiamata se wait è True, altrimenti None
+    """
+    global _unfinished
+    future = asyncio.get_running_loop().create_future() if wait else None
+    job = _Job(call, args, kwargs, _chat_of(call, args, kwargs), priority, future)
+
+    if not _workers:
+        # coda non avviata (script, benchmark): la chiamata viene eseguita subito
+        await _run_inline(job)
+    else:
+        sequence = next(_sequence)
+        _unfinished += 1
+        _idle.clear()
+        # le chiamate senza chat non vanno messe in fila dietro a nessuno
+        _push(job.chat_id if job.chat_id is not None else ("job", sequence), (priority, sequence, job))
+
+    if future is not None:
+        return await future
+    return None
+
+
+def start_outbox(workers: int = OUTBOX_WORKERS) -> list[asyncio.Task]:
+    """
+    Avvia i worker della coda. Chiamata in post_init.
+    :return: i task dei worker, da cancellare allo spegnimento
+    """
+    global _ready, _idle
+    _ready = asyncio.PriorityQueue()
+    _idle = asyncio.Event()
+    _idle.set()
+    _workers[:] = [asyncio.create_task(_worker()) for _ in range(workers)]
+    return list(_workers)
+
+
+async def drain_outbox(timeout: float = 10):
+    """
+    Aspetta (al massimo timeout secondi) che la coda si svuoti, poi ferma i worker.
+    """
+    if _idle is not None:
+        try:
+            await asyncio.wait_for(_idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            bot_logger.warning(f"outbox: {_unfinished} chiamate ancora in coda allo spegnimento")
+    for task in _workers:
+        task.cancel()
+    _workers.clear()
+
+
+def outbox_depth() -> dict[str, int]:
+    """
+    :return: chiamate in attesa per priorità
+    """
+    return {PRIORITY_NAMES[priority]: count for priority, count in _depth.items()}
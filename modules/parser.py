@@ -0,0 +1,58 @@
+import re
+from typing import NamedTuple
+
+# [/.!]comando, poi il destinatario (@username, ID o text mention) e infine il feedback
+CAPTION_PATTERN = re.compile(
+    r"[/.!](\w+)(?:\s+(@\w+|(\d{7,})|<a\s+href=\"tg://user\?id=(\d{7,})\">.*?</a>))?\s*(.*)?"
+)
+USERNAME_PATTERN = re.compile(r"^@[a-z][a-z0-9_]{5,}$")
+
+TARGET_USERNAME = "username"
+TARGET_ID = "id"
+TARGET_MENTION = "mention"
+
+
+class ParsedCaption(NamedTuple):
+    command: str
+    # '@username' oppure l'ID (come stringa) dell'utente indicato
+    target: str | None
+    # TARGET_USERNAME, TARGET_ID o TARGET_MENTION
+    target_kind: str | None
+    feedback: str | None
+
+
+def parse_caption(caption: str | None) -> ParsedCaption | None:
+    """
+    Interpreta la didascalia di un comando come /feedback.
+    :param caption: testo della didascalia
+    :return: ParsedCaption, oppure None se il testo non inizia con un comando
+    """
+    if not caption or (match := CAPTION_PATTERN.match(caption)) is None:
+        return None
+
+    if match.group(3):
+        target, target_kind = match.group(3), TARGET_ID
+    elif match.group(4):
+        target, target_kind = match.group(4), TARGET_MENTION
+    elif match.group(2):
+        target, target_kind = match.group(2), TARGET_USERNAME
+    else:
+        target, target_kind = None, None
+
+    return ParsedCaption(
+        command=match.group(1),
+        target=target,
+        target_kind=target_kind,
+        feedback=match.group(5) or None
+    )
+
+
+def is_valid_username(username: str | None) -> bool:
+    return bool(username) and USERNAME_PATTERN.match(username) is not None
+
+
+def normalize_username(username: str) -> str:
+    """
+    Forma canonica di uno username, la stessa della funzione SQL normalize_username: senza '@' e minuscolo.
+    """
+    return username.removeprefix("@").lower()
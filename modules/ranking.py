@@ -0,0 +1,53 @@
+from bisect import bisect_left, insort
+
+
+class Ranking:
+    """
+    Classifica degli utenti per un campo numerico di main_table, tenuta ordinata in memoria.
+    Le chiavi sono (-valore, user_id): il primo elemento è il primo in classifica e, a parità di valore,
+    vince l'ID più basso. Aggiornare un utente costa una ricerca binaria più uno spostamento della lista.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self._keys: list[tuple[int, int]] = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def rebuild(self, rows):
+        """
+        Ricostruisce la classifica da zero, con un solo ordinamento.
+        """
+        self._keys = sorted((-row[self.field], row["user_id"]) for row in rows)
+
+    def _remove(self, user_id: int, value: int):
+        key = (-value, user_id)
+        index = bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            del self._keys[index]
+
+    def update(self, user_id: int, old: dict | None, new: dict | None):
+        """
+        Sposta un utente in classifica.
+        :param old: la sua riga prima della modifica, None se non c'era
+        :param new: la sua riga dopo la modifica, None se è stato rimosso
+        """
+        if old is not None:
+            if new is not None and old[self.field] == new[self.field]:
+                return
+            self._remove(user_id, old[self.field])
+        if new is not None:
+            insort(self._keys, (-new[self.field], user_id))
+
+    def top(self, limit: int) -> list[int]:
+        """
+        :return: gli ID dei primi ``limit`` utenti
+        """
+        return [user_id for _, user_id in self._keys[:limit]]
+
+    def rank(self, value: int) -> int:
+        """
+        :return: la posizione (da 1) di chi ha ``value``: a pari merito la posizione è la stessa
+        """
+        return bisect_left(self._keys, (-value,)) + 1
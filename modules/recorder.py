@@ -0,0 +1,189 @@
+import gzip
+import json
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Iterator
+
+from pyrogram import Client
+from pyrogram.types import Message, CallbackQuery, ChatMemberUpdated, User, Chat, ChatMember
+
+from globals import RECORDER_FLUSH_EVERY, RECORDER_QUEUE_SIZE
+from modules.loggers import bot_logger
+
+# versione del formato: cambia se cambiano i campi scritti da encode_update
+RECORDING_VERSION = 1
+
+# tipi di aggiornamento registrati (campo "k" di ogni riga)
+KIND_MESSAGE = "m"
+KIND_CALLBACK_QUERY = "q"
+KIND_CHAT_MEMBER = "j"
+
+# righe in attesa di essere scritte dal thread della registrazione: oltre RECORDER_QUEUE_SIZE vengono scartate
+_lines: queue.Queue | None = None
+_writer: threading.Thread | None = None
+_STOP = object()
+_started = 0.0
+recorder_stats = {"recorded": 0, "skipped": 0, "dropped": 0}
+
+
+def _user(user: User | None):
+    if user is None:
+        return None
+    return [user.id, user.username, user.first_name, bool(user.is_bot)]
+
+
+def _chat(chat: Chat | None):
+    if chat is None:
+        return None
+    return [chat.id, chat.type.value, chat.title]
+
+
+def _member(member: ChatMember | None):
+    if member is None:
+        return None
+    return [member.status.value, _user(member.user)]
+
+
+def _text_mentions(message: Message):
+    entities = (message.entities or []) + (message.caption_entities or [])
+    return [[el.offset, el.length, _user(el.user)] for el in entities if el.type.name == "TEXT_MENTION"] or None
+
+
+def _message(message: Message) -> dict:
+    return {
+        "id": message.id,
+        "c": _chat(message.chat),
+        "u": _user(message.from_user),
+        "x": message.text,
+        "p": message.caption,
+        "f": 1 if message.photo else None,
+        "r": message.message_thread_id,
+        "e": _text_mentions(message)
+    }
+
+
+def _compact(fields: dict) -> dict:
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def encode_update(update, offset: float) -> dict | None:
+    """
+    Riduce un aggiornamento ai soli campi letti dagli handler.
+    :param update: Message, CallbackQuery o ChatMemberUpdated
+    :param offset: secondi trascorsi dall'inizio della registrazione
+    :return: il dizionario da scrivere, o None per gli aggiornamenti di altro tipo
+    """
+    offset = round(offset, 3)
+    if isinstance(update, Message):
+        return _compact({"k": KIND_MESSAGE, "t": offset, **_message(update)})
+    if isinstance(update, CallbackQuery):
+        return _compact({
+            "k": KIND_CALLBACK_QUERY,
+            "t": offset,
+            "u": _user(update.from_user),
+            "d": update.data if isinstance(update.data, str) else None,
+            "m": _compact(_message(update.message)) if update.message else None
+        })
+    if isinstance(update, ChatMemberUpdated):
+        return _compact({
+            "k": KIND_CHAT_MEMBER,
+            "t": offset,
+            "c": _chat(update.chat),
+            "u": _user(update.from_user),
+            "o": _member(update.old_chat_member),
+            "n": _member(update.new_chat_member)
+        })
+    return None
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _write_lines(file, lines: queue.Queue):
+    """
+    Corpo del thread della registrazione: serializza e scrive le righe, come il listener di loggers.py.
+    """
+    unflushed = 0
+    with file:
+        while (line := lines.get()) is not _STOP:
+            file.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
+            unflushed += 1
+            if unflushed >= RECORDER_FLUSH_EVERY or lines.empty():
+                file.flush()
+                unflushed = 0
+
+
+def start_recording(path: str, group_id: int | None = None):
+    """
+    Apre il file della registrazione (compresso se finisce in .gz), ne scrive l'intestazione e avvia il thread che
+    scrive le righe: l'event loop si limita a metterle in coda.
+    ⚠️ Il file contiene ID, username e testi degli utenti: va trattato come i log.
+    """
+    global _lines, _writer, _started
+    file = _open(path, "w")
+    file.write(json.dumps({"v": RECORDING_VERSION, "group_id": group_id, "started": datetime.now().isoformat()})
+               + "\n")
+    _lines = queue.Queue(maxsize=RECORDER_QUEUE_SIZE)
+    _writer = threading.Thread(target=_write_lines, args=(file, _lines), name="update-recorder", daemon=True)
+    _writer.start()
+    _started = time.monotonic()
+    bot_logger.info(f"recording updates to {path}")
+
+
+async def record_update(client: Client, update):
+    """
+    Handler da registrare in un gruppo a priorità più alta di tutti gli altri: mette in coda l'aggiornamento e
+    lascia che la propagazione prosegua.
+    """
+    if _lines is None:
+        return
+    try:
+        line = encode_update(update, time.monotonic() - _started)
+    except Exception as e:
+        bot_logger.error(f"could not record update: {e}")
+        line = None
+    if line is None:
+        recorder_stats["skipped"] += 1
+        return
+    try:
+        _lines.put_nowait(line)
+    except queue.Full:
+        recorder_stats["dropped"] += 1
+    else:
+        recorder_stats["recorded"] += 1
+
+
+def stop_recording():
+    """
+    Aspetta che il thread scriva le righe in coda e chiude il file.
+    """
+    global _lines, _writer
+    if _lines is not None:
+        # bloccante: il thread sta svuotando la coda, quindi un posto si libera
+        _lines.put(_STOP)
+        _writer.join()
+        _lines = _writer = None
+
+
+def read_recording(path: str) -> tuple[dict, Iterator[dict]]:
+    """
+    :return: (intestazione, iteratore sulle righe nell'ordine in cui sono state registrate)
+    """
+    file = _open(path, "r")
+    header = json.loads(file.readline())
+    if header.get("v") != RECORDING_VERSION:
+        file.close()
+        raise ValueError(f"unsupported recording version {header.get('v')}")
+
+    def lines():
+        with file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    return header, lines()
@@ -0,0 +1,176 @@
+import html
+import re
+from typing import Iterable
+
+from pyrogram.types import ChatMember
+
+from modules.utils import add_fucking_at
+
+# lunghezza massima di un messaggio Telegram (in unità UTF-16)
+MESSAGE_LIMIT = 4096
+FOOTER = "\n\n🆘 Usa il tuo <b>bot di moderazione</b> per maggiori info sugli utenti citati."
+BOOKMARK = " 🔖"
+_TAG_PATTERN = re.compile(r"<[^>]+>")
+# tag, entità HTML o singolo carattere
+_TOKEN_PATTERN = re.compile(r"<[^>]+>|&#?\w+;|.", re.DOTALL)
+
+
+def text_length(text: str) -> int:
+    """
+    Lunghezza di ``text`` come la conta Telegram: unità UTF-16 del testo visibile, senza tag HTML.
+    """
+    return len(html.unescape(_TAG_PATTERN.sub("", text)).encode("utf-16-le")) // 2
+
+
+def _units(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _break_point(part: str, budget: int) -> int | None:
+    """
+    :return: la posizione subito dopo l'ultimo a capo o spazio entro ``budget`` che non sta dentro un tag né dentro
+        un elemento aperto (<b>...</b>), così i due pezzi restano HTML valido; None se non ce n'è
+    """
+    size, depth, cut = 0, 0, None
+    for token in _TOKEN_PATTERN.finditer(part):
+        text = token.group()
+        if text.startswith("<"):
+            depth += -1 if text.startswith("</") else 1
+            continue
+        size += text_length(text) if text.startswith("&") else _units(text)
+        if size > budget:
+            break
+        if text in ("\n", " ") and depth == 0:
+            cut = token.end()
+    return cut
+
+
+def _split_plain(text: str, budget: int):
+    """
+    Divide il testo senza markup in pezzi di al più ``budget`` unità, all'ultimo spazio o a capo se c'è.
+    """
+    start, size, cut = 0, 0, None
+    for position, char in enumerate(text):
+        size += _units(char)
+        if size > budget:
+            end = cut if cut is not None and cut > start else position
+            yield html.escape(text[start:end])
+            start, cut = end, None
+            size = _units(text[start:position + 1])
+        if char in "\n ":
+            cut = position + 1
+    if start < len(text):
+        yield html.escape(text[start:])
+
+
+def _split_oversized(part: str, budget: int):
+    while text_length(part) > budget:
+        cut = _break_point(part, budget)
+        if cut is None:
+            # nessun punto sicuro: meglio perdere la formattazione che mandare tag spezzati
+            yield from _split_plain(html.unescape(_TAG_PATTERN.sub("", part)), budget)
+            return
+        yield part[:cut]
+        part = part[cut:]
+    if part:
+        yield part
+
+
+def pack_messages(parts: Iterable[str], footer: str = FOOTER, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    Impacchetta le parti, nell'ordine, nel minor numero di messaggi che rispettano ``limit``.
+    Ogni messaggio termina con ``footer``.
+    :param parts: intestazioni e voci già formattate
+    :param footer: testo aggiunto in fondo a ogni messaggio
+    :param limit: lunghezza massima di un messaggio
+    :return: lista dei testi da mandare
+    """
+    budget = limit - text_length(footer)
+    chunks, current, size = [], [], 0
+    for part in parts:
+        for piece in _split_oversized(part, budget):
+            length = text_length(piece)
+            if current and size + length > budget:
+                chunks.append("".join(current) + footer)
+                current, size = [], 0
+            current.append(piece)
+            size += length
+    if current:
+        chunks.append("".join(current) + footer)
+    return chunks
+
+
+def fitting_count(parts: list[str], footer: str = FOOTER, limit: int = MESSAGE_LIMIT) -> int:
+    """
+    :return: quante delle prime parti stanno, insieme a ``footer``, in un solo messaggio
+    """
+    budget, size = limit - text_length(footer), 0
+    for count, part in enumerate(parts):
+        size += text_length(part)
+        if size > budget:
+            return count
+    return len(parts)
+
+
+def is_active(member: ChatMember | None) -> bool:
+    return member is not None and member.status.name != "LEFT" and member.status.name != "BANNED"
+
+
+def member_mention(member: ChatMember | None, user_id: int) -> str:
+    if is_active(member):
+        return f"{member.user.mention} (<code>{user_id}</code>)"
+    return f"<code>{user_id}</code>"
+
+
+def member_handle(member: ChatMember | None, user_id: int | None, username: str | None) -> str:
+    if is_active(member):
+        handle = add_fucking_at(member.user.username) if member.user.username else member.user.first_name
+        return f"{handle} (<code>{member.user.id}</code>)"
+    if username:
+        return f"{add_fucking_at(username)} (<code>{user_id}</code>)"
+    return f"<code>{user_id}</code>"
+
+
+def format_time(moment) -> str:
+    return moment.strftime('%a %d %b %Y, %H:%M') if moment is not None else "<code>None</code>"
+
+
+class SearchedUser:
+    """
+    L'utente cercato con /scambi o /regali, per marcarlo con 🔖 nelle voci.
+    """
+
+    def __init__(self, tagged: ChatMember | None, user: str):
+        self.user_id = tagged.user.id if tagged is not None else (int(user) if user.isnumeric() else None)
+        self.username = None if user.isnumeric() else user.removeprefix("@").lower()
+
+    def matches(self, user_id: int, username: str | None) -> bool:
+        if self.user_id is not None:
+            return int(user_id) == self.user_id
+        return username is not None and username.removeprefix("@").lower() == self.username
+
+
+def render_exchange(exchange, members: dict, searched: SearchedUser) -> str:
+    parts = [f"\n🧩. <b>Scambio {exchange['id']}</b>\n"]
+    for label, emoji, number in (("Sender", "🔹", 1), ("Recipient", "🔸", 2)):
+        user_id, username = exchange[f'member_{number}'], exchange[f'username_{number}']
+        member = members.get(user_id)
+        parts.append(f"\n\t{emoji} <u>{label}</u> – {member_mention(member, user_id)}")
+        if searched.matches(user_id, member.user.username if member is not None else username):
+            parts.append(BOOKMARK)
+    parts.append(f"\n\t🔹 <u>Feedback</u> – <i>{html.escape(exchange['feedback'] or '')}</i>"
+                 f"\n\t🔸 <u>Screenshot</u> – 🔗 <a href=\"{exchange['screenshot']}\">Link</a>"
+                 f"\n\t🔹 <u>Exchange Time</u> – {format_time(exchange['exchange_time'])}"
+                 f"\n\t🔸 <u>Cancelled</u> – <code>{exchange['cancelled']}</code>\n")
+    return "".join(parts)
+
+
+def render_gift(gift, requester: str, giver: str) -> str:
+    return "".join([
+        f"\n       🎁. <b>Regalo {gift['id']}</b>",
+        f"\n       🔹 <u>Richiesto Da</u> – {requester}",
+        f"\n       🔸 <u>Donato Da</u> – {giver}\n",
+        f"       ❔ <u>Richiesta</u> – 🔗 <a href=\"{gift['request_link']}\">Link</a>\n",
+        f"       📆 <u>Regalo in Data</u> – {format_time(gift['gifted_at'] if gift['gifted_by_id'] else None)}\n",
+        f"       ♻ <u>Cancellato</u> – <code>{gift['cancelled']}</code>\n"
+    ])
@@ -0,0 +1,70 @@
+from typing import NamedTuple, Callable, Awaitable
+
+from pyrogram import Client
+from pyrogram.types import CallbackQuery
+
+from modules.loggers import bot_logger
+
+# chiave riservata del trie sotto cui è salvata la rotta di un nodo
+_ROUTE = None
+
+
+class CallbackData(NamedTuple):
+    # azione registrata, es. 'cancel_exchange'
+    action: str
+    # argomenti che seguono l'azione nel callback_data
+    args: list[str]
+
+
+class Route(NamedTuple):
+    action: str
+    handler: Callable[[Client, CallbackQuery, CallbackData], Awaitable]
+    maxsplit: int
+
+
+class CallbackRouter:
+    """
+    Instrada tutte le callback query con un solo CallbackQueryHandler. Le azioni sono registrate in un trie
+    indicizzato sui token del callback_data separati da '_': il costo di una pressione dipende dalla lunghezza
+    dell'azione, non dal numero di azioni registrate. Vince il prefisso registrato più lungo.
+    """
+
+    def __init__(self):
+        self._trie: dict = {}
+
+    def add(self, action: str, handler: Callable[[Client, CallbackQuery, CallbackData], Awaitable],
+            maxsplit: int = -1):
+        """
+        :param action: prefisso dell'azione, es. 'accept_gift_for'
+        :param handler: coroutine chiamata come handler(client, callback_query, callback_data)
+        :param maxsplit: numero massimo di separazioni degli argomenti (0 per tenerli in un'unica stringa,
+            utile quando l'ultimo argomento è uno username che può contenere '_')
+        """
+        node = self._trie
+        for token in action.split("_"):
+            node = node.setdefault(token, {})
+        node[_ROUTE] = Route(action=action, handler=handler, maxsplit=maxsplit)
+
+    def parse(self, data: str) -> tuple[Route, CallbackData] | None:
+        node = self._trie
+        route, rest = None, ""
+        remaining = data
+        while remaining is not None:
+            token, separator, tail = remaining.partition("_")
+            node = node.get(token)
+            if node is None:
+                break
+            remaining = tail if separator else None
+            if _ROUTE in node:
+                route, rest = node[_ROUTE], remaining or ""
+        if route is None:
+            return None
+        args = rest.split("_", route.maxsplit) if rest else []
+        return route, CallbackData(action=route.action, args=args)
+
+    async def dispatch(self, client: Client, callback_query: CallbackQuery):
+        if (parsed := self.parse(callback_query.data or "")) is None:
+            bot_logger.warning(f"Unhandled callback data: {callback_query.data}")
+            return
+        route, data = parsed
+        await route.handler(client, callback_query, data)
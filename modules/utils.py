@@ -1,37 +1,234 @@
+import asyncio
 import json
 import os
 
 import asyncpg
 from pyrogram import Client
-from pyrogram.enums import ChatType
+from pyrogram.enums import ChatType, ChatMembersFilter, ChatMemberStatus
 from pyrogram.errors import MessageDeleteForbidden
-from pyrogram.types import Message, ChatMember
+from pyrogram.types import Message, ChatMember, ChatMemberUpdated
 
-from globals import bot_data
-from loggers import db_logger, bot_logger
-from modules.database import execute_query_for_value, connect_to_database, get_user_gifts
+from globals import bot_data, MEMBER_CACHE_TTL, MEMBER_CACHE_SIZE, MEMBER_RESOLVE_CONCURRENCY, \
+    USER_OBSERVATION_INTERVAL, PERSISTENCE_DEBOUNCE, ADMIN_REFRESH_INTERVAL
+from modules.loggers import db_logger, bot_logger
+from modules.cache import TTLCache
+from modules.outbox import enqueue, PRIORITY_NOTIFICATION
+from modules.parser import normalize_username
+from modules.database import acquire, can_request_gift, upsert_users, delete_unaccepted_gifts
 
+# membri risolti con get_chat_member, indicizzati sia per (chat_id, user_id) che per (chat_id, username)
+member_cache = TTLCache(maxsize=MEMBER_CACHE_SIZE, ttl=MEMBER_CACHE_TTL)
+
+# contatori dello stadio di ingresso del gruppo (core.intercept_user_message)
+ingress_stats = {"fast_path": 0, "commands": 0}
+# chiavi di bot_data modificate e non ancora scritte nella tabella 'persistence'
+_dirty_keys: set = set()
+_persistence_source: dict = bot_data
+_persistence_flush: asyncio.Task | None = None
+# una sola scrittura alla volta: chi chiama flush_persistence aspetta quella in corso
+_persistence_lock = asyncio.Lock()
+# utenti visti nel gruppo e non ancora scritti nella tabella 'users': user_id -> username
+_observed_users: dict[int, str] = {}
+# amministratori del gruppo più owner_id e admin_id di bot_data (vedi load_admins)
+_admins: frozenset[int] = frozenset()
+
+
+async def save_persistence(json_dict: dict, *keys):
+    """
+    Segna come modificate le chiavi indicate (tutte, se non ne viene indicata nessuna) e ne programma la scrittura:
+    le modifiche fatte entro PERSISTENCE_DEBOUNCE secondi finiscono in un'unica UPDATE.
+    :param json_dict: il dizionario da salvare (bot_data)
+    :param keys: le chiavi modificate o rimosse
+    """
+    global _persistence_source, _persistence_flush
+    _persistence_source = json_dict
+    _dirty_keys.update(keys if keys else json_dict.keys())
+    if _persistence_flush is None or _persistence_flush.done():
+        _persistence_flush = asyncio.create_task(_flush_persistence_later())
+
+
+async def _flush_persistence_later():
+    # le chiavi segnate mentre una scrittura è in corso non sono nella sua copia: ne serve un'altra
+    while True:
+        await asyncio.sleep(PERSISTENCE_DEBOUNCE)
+        if not await _write_dirty_keys() or not _dirty_keys:
+            return
 
-async def save_persistence(json_dict: dict):
-    if "confirmations" in json_dict:
-        del json_dict["confirmations"]
-    json_content = json.dumps({"jsondata": json_dict})
-    conn = await connect_to_database()
-    try:
-        # noinspection SqlWithoutWhere
-        await conn.execute("UPDATE persistence SET data = $1;", json_content)
-    except asyncpg.exceptions.PostgresError as err:
-        db_logger.error(err)
-    finally:
-        await conn.close()
+
+async def _write_dirty_keys() -> bool:
+    """
+    Scrive le chiavi modificate: quelle ancora presenti vengono unite a 'jsondata', quelle rimosse vengono
+    cancellate. Il resto del documento non viene riscritto. Se la scrittura non va a buon fine (o viene
+    interrotta) le chiavi restano da scrivere.
+    :return: False se la scrittura è fallita
+    """
+    async with _persistence_lock:
+        if not _dirty_keys:
+            return True
+        keys = set(_dirty_keys)
+        _dirty_keys.clear()
+        written = False
+        try:
+            changed = json.dumps({str(key): _persistence_source[key] for key in keys if key in _persistence_source})
+            removed = [str(key) for key in keys if key not in _persistence_source]
+            async with acquire() as conn:
+                # noinspection SqlWithoutWhere
+                await conn.execute(
+                    "UPDATE persistence SET data = jsonb_set("
+                    "COALESCE(data::jsonb, '{\"jsondata\": {}}'), '{jsondata}', "
+                    "(COALESCE(data::jsonb -> 'jsondata', '{}') || $1::jsonb) - $2::text[]);",
+                    changed,
+                    removed
+                )
+            written = True
+        except TypeError as err:
+            db_logger.error(f"bot_data non serializzabile: {err}")
+        except asyncpg.exceptions.PostgresError as err:
+            db_logger.error(err)
+        finally:
+            if not written:
+                # verranno riprovate alla prossima scrittura
+                _dirty_keys.update(keys)
+        return written
+
+
+async def flush_persistence():
+    """
+    Scrive subito le chiavi modificate, dopo aver aspettato l'eventuale scrittura in corso.
+    """
+    await _write_dirty_keys()
+    if _persistence_flush is not None and _persistence_flush is not asyncio.current_task():
+        # a questo punto la scrittura programmata può solo essere in attesa: nessuna chiave va persa
+        _persistence_flush.cancel()
 
 
 def add_fucking_at(username_without_at: str):
     return '@' + username_without_at.removeprefix("@")
 
 
+def _member_key(chat_id: int | str, user: int | str):
+    if isinstance(user, int) or user.isnumeric():
+        return int(chat_id), int(user)
+    return int(chat_id), normalize_username(user)
+
+
+def cache_member(chat_id: int | str, member: ChatMember):
+    member_cache.set(_member_key(chat_id, member.user.id), member)
+    if member.user.username is not None:
+        member_cache.set(_member_key(chat_id, member.user.username), member)
+
+
+def invalidate_member(chat_id: int | str, user_id: int, username: str | None = None):
+    member = member_cache.pop(_member_key(chat_id, user_id))
+    if member is not None and member.user.username is not None:
+        member_cache.pop(_member_key(chat_id, member.user.username))
+    if username is not None:
+        member_cache.pop(_member_key(chat_id, username))
+
+
+async def get_chat_member(client: Client, chat_id: int | str, user_id: int | str) -> ChatMember:
+    """
+    Come client.get_chat_member, ma prima cerca il membro nella cache.
+    :param client: client pyrogram
+    :param chat_id: ID della chat
+    :param user_id: ID o username (con o senza '@') dell'utente
+    :return: il ChatMember richiesto; le eccezioni di pyrogram sono propagate
+    """
+    if (member := member_cache.get(_member_key(chat_id, user_id))) is not None:
+        return member
+    member = await client.get_chat_member(chat_id=chat_id, user_id=user_id)
+    cache_member(chat_id, member)
+    return member
+
+
+async def resolve_members(client: Client, chat_id: int | str, users, concurrency: int = MEMBER_RESOLVE_CONCURRENCY):
+    """
+    Risolve in parallelo (al massimo ``concurrency`` richieste alla volta) i membri indicati, ognuno una volta sola.
+    :param client: client pyrogram
+    :param chat_id: ID della chat
+    :param users: ID o username degli utenti, anche ripetuti
+    :return: dizionario {utente: ChatMember}, con None per gli utenti non trovati
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve(user):
+        async with semaphore:
+            try:
+                return await get_chat_member(client=client, chat_id=chat_id, user_id=user)
+            except Exception:
+                return None
+
+    users = list(dict.fromkeys(users))
+    members = await asyncio.gather(*(resolve(user) for user in users))
+    return dict(zip(users, members))
+
+
+def observe_user(user_id: int, username: str | None):
+    if username is not None:
+        _observed_users[user_id] = add_fucking_at(username)
+
+
+async def flush_observed_users():
+    if not _observed_users:
+        return
+    users = list(_observed_users.items())
+    _observed_users.clear()
+    try:
+        await upsert_users(users)
+    except Exception as e:
+        bot_logger.error(f"error saving {len(users)} observed users: {e}")
+
+
+async def observed_users_flusher(interval: float = USER_OBSERVATION_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await flush_observed_users()
+
+
+def _bot_admins() -> set[int]:
+    return {int(bot_data[key]) for key in ("owner_id", "admin_id") if bot_data.get(key)}
+
+
+async def load_admins(client: Client):
+    """
+    Ricarica gli amministratori del gruppo con una sola chiamata a get_chat_members. Se la chiamata fallisce
+    resta valido l'insieme precedente.
+    """
+    global _admins
+    try:
+        admins = {
+            member.user.id async for member in
+            client.get_chat_members(chat_id=int(bot_data["group_id"]), filter=ChatMembersFilter.ADMINISTRATORS)
+        }
+    except Exception as e:
+        bot_logger.error(f"could not load group admins: {e}")
+        _admins = _admins | _bot_admins()
+        return
+    _admins = frozenset(admins | _bot_admins())
+
+
+async def admins_refresher(client: Client, interval: float = ADMIN_REFRESH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await load_admins(client)
+
+
+def observe_admin_change(chat_member: ChatMemberUpdated):
+    """
+    Aggiorna gli amministratori quando un membro del gruppo viene promosso o perde i permessi.
+    """
+    global _admins
+    if chat_member.new_chat_member is None:
+        return
+    user_id = chat_member.new_chat_member.user.id
+    if chat_member.new_chat_member.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+        _admins = _admins | {user_id}
+    elif user_id in _admins and user_id not in _bot_admins():
+        _admins = _admins - {user_id}
+
+
 async def is_admin(user_id: int | str) -> bool:
-    return int(user_id) in [538590507, 8101457635, 6710922454, 6565193110, 1059198431]
+    return int(user_id) in _admins
 
 
 async def safe_delete(message):
@@ -71,7 +268,8 @@ async def safety_check(client: Client, message: Message):
         bot_logger.error("❌ Non è stato possibile uscire da tale chat: " + str(e))
         text += "❌ Non è stato possibile uscire da tale chat: " + str(e)
     try:
-        sender = await client.get_chat_member(
+        sender = await get_chat_member(
+            client=client,
             chat_id=bot_data["group_id"],
             user_id=message.from_user.id
         )
@@ -81,38 +279,24 @@ async def safety_check(client: Client, message: Message):
         text += "\n\nSembra che tale utente non sia nel gruppo ufficiale."
 
     bot_logger.warning(text)
-    try:
-        await client.send_message(
-            chat_id=bot_data["admin_id"],
-            text=text
-        )
-    except Exception as e:
-        bot_logger.error(f"Non è stato possibile mandare il messaggio all'admin {e}")
+    # senza wait: se l'invio fallisce l'errore finisce nel log della coda in uscita
+    await enqueue(
+        client.send_message,
+        chat_id=bot_data["admin_id"],
+        text=text,
+        priority=PRIORITY_NOTIFICATION
+    )
 
     return False
 
 
 async def delete_user_unaccepted_requests(user: str | int):
-    if isinstance(user, int):
-        await execute_query_for_value(f"DELETE FROM gifts WHERE gifted_by_id IS NULL AND user_id = {user}", False)
-    else:
-        await execute_query_for_value(f"DELETE FROM gifts WHERE gifted_by_id IS NULL AND username = {user}", False)
+    await delete_unaccepted_gifts(user=user)
 
 
 async def check_request_requirements(user_id: int):
-    gifts = await get_user_gifts(user=user_id)
-
-    if len(gifts["given"]) == 0 and len(gifts["requested"]) >= 2:
+    res = await can_request_gift(user_id=user_id)
+    if res == -1:
+        bot_logger.error(f"could not check gift requirements for {user_id}")
         return False
-
-    if len(gifts["given"]) > 0:
-        last_given = gifts["given"][0]
-
-        valid_received = [
-            dict(item) for item in gifts["requested"] if dict(item)["gifted_at"] > dict(last_given)["gifted_at"]
-        ]
-
-        if len(valid_received) >= 2:
-            return False
-
-    return True
+    return res